@@ -0,0 +1,128 @@
+"""Writes validated AIS messages to columnar Parquet files
+
+Rather than csv text, the valid rows can be written by
+:py:class:`ParquetWriter` into a Parquet file, in which each of the
+``AIS_CSV_COLUMNS`` is stored with its type, compressed and in row groups of
+``row_group_size`` rows.  Such files are several times smaller than the clean
+csv files, and can be scanned column by column without parsing any text.
+
+The columns have the types of those of ``ais_clean``: integers as int32,
+floats as float64, ``Time`` as a timestamp (which Parquet keeps in
+milliseconds) and the strings as utf-8 text.
+
+PyArrow is an optional dependency, and is only needed if this output format is
+used.
+"""
+from datetime import datetime
+from pyrate.algorithms.aisparser import AIS_CSV_COLUMNS
+from superpyrate.vectorised import INT_COLUMNS, FLOAT_COLUMNS
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+#: The number of rows in each row group
+ROW_GROUP_SIZE = 500000
+#: The compression codec of the columns
+COMPRESSION = 'zstd'
+
+
+def check_pyarrow():
+    """Raises an error if PyArrow, required by this output format, is not
+    installed
+    """
+    if pa is None:
+        raise RuntimeError("The parquet output format requires pyarrow, "
+                           "which is not installed")
+
+
+def get_schema():
+    """Returns the schema of the ``AIS_CSV_COLUMNS`` in a Parquet file
+    """
+    check_pyarrow()
+    fields = []
+    for col in AIS_CSV_COLUMNS:
+        if col in INT_COLUMNS:
+            data_type = pa.int32()
+        elif col in FLOAT_COLUMNS:
+            data_type = pa.float64()
+        elif col == 'Time':
+            data_type = pa.timestamp('s')
+        else:
+            data_type = pa.string()
+        fields.append(pa.field(col, data_type))
+    return pa.schema(fields)
+
+
+def to_datetime(value):
+    """Converts a time written as ``%Y-%m-%d %H:%M:%S`` by the numpy engine
+    into a datetime, passing datetimes through
+    """
+    if isinstance(value, str):
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]),
+                        int(value[17:19]))
+    return value
+
+
+class ParquetWriter(object):
+    """Writes validated rows to a Parquet file in row groups
+
+    Used in place of the writer of the clean csv file by
+    :py:func:`superpyrate.tasks.produce_valid_csv_file`.  The rows are
+    gathered until there are ``row_group_size`` of them, and then written as a
+    row group.  :py:meth:`finish` must be called to write the last row group
+    and the footer of the file.
+
+    Arguments
+    ---------
+    output_file : str or file object
+        A file path, or a file object open for writing bytes
+    row_group_size : int, default=ROW_GROUP_SIZE
+    compression : str, default=COMPRESSION
+    """
+    def __init__(self, output_file, row_group_size=ROW_GROUP_SIZE,
+                 compression=COMPRESSION):
+        self.schema = get_schema()
+        self.writer = pq.ParquetWriter(output_file, self.schema,
+                                       compression=compression)
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        """Writes the rows gathered so far as a row group
+        """
+        if not self.rows:
+            return
+        columns = [list(column) for column in zip(*self.rows)]
+        time = AIS_CSV_COLUMNS.index('Time')
+        columns[time] = [to_datetime(value) for value in columns[time]]
+        try:
+            arrays = [pa.array(column, type=field.type)
+                      for column, field in zip(columns, self.schema)]
+        except (pa.ArrowException, ValueError, TypeError,
+                OverflowError) as error:
+            # Not a ValueError, which the row engine would take to be a
+            # problem with the row being written
+            raise RuntimeError("Could not convert a row group of {} rows: "
+                               "{}".format(len(self.rows), error)) from error
+        self.writer.write_table(pa.Table.from_arrays(arrays,
+                                                     schema=self.schema))
+        self.rows = []
+
+    def finish(self):
+        """Writes the last row group and closes the Parquet file
+        """
+        self.flush()
+        self.writer.close()
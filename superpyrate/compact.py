@@ -0,0 +1,228 @@
+"""Row by row validation of AIS messages carried as plain sequences
+
+An alternative engine for :py:func:`superpyrate.tasks.produce_valid_csv_file`.
+The row engine builds a dictionary of the raw values of each row, which
+:py:func:`pyrate.algorithms.aisparser.parse_raw_row` converts into another
+dictionary before it is validated and looked up field by field on writing.
+This engine instead keeps each row in the fixed positions of the
+``AIS_CSV_COLUMNS`` from the csv reader to the writer.  Each value is
+converted by a converter chosen once per column, and the row is validated in
+place, so a row costs a single list.
+
+The conversions and checks mirror those of
+:py:func:`pyrate.algorithms.aisparser.parse_raw_row` and
+:py:func:`pyrate.algorithms.aisparser.validate_row`, as do those of
+:py:mod:`superpyrate.vectorised`, so that the engine writes exactly the same
+rows as the row engine.
+"""
+from datetime import datetime
+from pyrate.algorithms.aisparser import AIS_CSV_COLUMNS
+from superpyrate.vectorised import INT_COLUMNS, FLOAT_COLUMNS, \
+                                   MAX_STRING_LENGTH, VALID_MESSAGE_IDS, \
+                                   VALID_NAVIGATIONAL_STATUSES, \
+                                   POSITION_MESSAGES, ETA_RANGES, CHUNKSIZE
+from superpyrate.stats import ValidationCounts, PARSE_ERROR, VALIDATION
+import logging
+
+LOGGER = logging.getLogger('luigi-interface')
+LOGGER.setLevel(logging.INFO)
+
+MMSI = AIS_CSV_COLUMNS.index('MMSI')
+MESSAGE_ID = AIS_CSV_COLUMNS.index('Message_ID')
+IMO = AIS_CSV_COLUMNS.index('IMO')
+LONGITUDE = AIS_CSV_COLUMNS.index('Longitude')
+LATITUDE = AIS_CSV_COLUMNS.index('Latitude')
+
+MESSAGE_IDS = frozenset(VALID_MESSAGE_IDS)
+NAVIGATIONAL_STATUSES = frozenset(VALID_NAVIGATIONAL_STATUSES)
+POSITIONS = frozenset(POSITION_MESSAGES)
+
+
+def int_or_null(value):
+    return int(value) if value else None
+
+
+def float_or_null(value):
+    return float(value) if value and value != 'None' else None
+
+
+def parse_timestamp(value):
+    """Parses a ``%Y%m%d_%H%M%S`` timestamp
+
+    Timestamps in the canonical fifteen character form can only be read one
+    way by :py:func:`datetime.strptime`, so are read by position, which is
+    much quicker.  Others are left to :py:func:`datetime.strptime`.
+    """
+    if len(value) == 15 and value[8] == '_' and value.isascii() and \
+            value[:8].isdigit() and value[9:].isdigit():
+        return datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                        int(value[9:11]), int(value[11:13]),
+                        int(value[13:15]))
+    return datetime.strptime(value, '%Y%m%d_%H%M%S')
+
+
+def truncate(value):
+    return value[:MAX_STRING_LENGTH]
+
+
+#: The bounds of the integers which may be written for a rejected row, which
+#: are those held by a postgres bigint
+MIN_INT = -2 ** 63
+MAX_INT = 2 ** 63
+
+
+def get_converter(column):
+    """Returns the function which converts a raw value of a column
+    """
+    if column in INT_COLUMNS:
+        return int_or_null
+    elif column in FLOAT_COLUMNS:
+        return float_or_null
+    elif column == 'Time':
+        return parse_timestamp
+    else:
+        return truncate
+
+
+def salvage_values(values):
+    """Converts the raw values of a rejected row as far as possible
+
+    Used for the rows written to the dirty output, where a value which cannot
+    be converted, or an integer too large for a postgres bigint, is set to
+    None rather than rejecting the row
+
+    Arguments
+    ---------
+    values : sequence
+        The raw strings of the ``AIS_CSV_COLUMNS``
+
+    Returns
+    -------
+    list
+        The converted values of the ``AIS_CSV_COLUMNS``
+    """
+    row = []
+    for column, value in zip(AIS_CSV_COLUMNS, values):
+        try:
+            value = get_converter(column)(value)
+        except ValueError:
+            value = None
+        if isinstance(value, int) and not MIN_INT < value < MAX_INT:
+            value = None
+        row.append(value)
+    return row
+
+
+def valid_mmsi(mmsi):
+    """Checks that an MMSI number is nine characters long when printed
+    """
+    return (mmsi is not None and
+            (100000000 <= mmsi <= 999999999 or -99999999 <= mmsi <= -10000000))
+
+
+def valid_imo(imo):
+    """Checks a seven digit IMO number using its check digit
+    """
+    if not 1000000 <= imo <= 9999999:
+        return False
+    digits = str(imo)
+    checksum = sum(weight * int(digit)
+                   for weight, digit in zip(range(7, 1, -1), digits))
+    return checksum % 10 == int(digits[6])
+
+
+#: The fields set to null if they fail a test, by position
+NULL_ON_FAIL = [(AIS_CSV_COLUMNS.index('Navigational_status'),
+                 lambda x: x in NAVIGATIONAL_STATUSES),
+                (AIS_CSV_COLUMNS.index('SOG'), lambda x: 0 <= x <= 102.2),
+                (AIS_CSV_COLUMNS.index('COG'), lambda x: 0 <= x < 360),
+                (AIS_CSV_COLUMNS.index('Heading'),
+                 lambda x: 0 <= x < 360 or x == 511)]
+NULL_ON_FAIL += [(AIS_CSV_COLUMNS.index(col),
+                  lambda x, lower=lower, upper=upper: lower <= x <= upper)
+                 for col, (lower, upper) in sorted(ETA_RANGES.items())]
+
+
+def validate_values(row):
+    """Validates a converted row in place
+
+    Arguments
+    ---------
+    row : list
+        The converted values of the ``AIS_CSV_COLUMNS``
+
+    Returns
+    -------
+    bool
+        False if the row is invalid, otherwise True, in which case fields
+        out of range have been set to None
+    """
+    message_id = row[MESSAGE_ID]
+    if not (valid_mmsi(row[MMSI]) and message_id in MESSAGE_IDS and
+            (row[IMO] is None or valid_imo(row[IMO]))):
+        return False
+    if message_id in POSITIONS:
+        longitude, latitude = row[LONGITUDE], row[LATITUDE]
+        if longitude is None or latitude is None or \
+                not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+            return False
+    else:
+        row[LONGITUDE] = None
+        row[LATITUDE] = None
+    for index, test in NULL_ON_FAIL:
+        if row[index] is not None and not test(row[index]):
+            row[index] = None
+    return True
+
+
+def write_valid_compact(rows, writer, chunksize=CHUNKSIZE, counts=None,
+                        rejects=None):
+    """Validates rows one at a time and writes those which are valid
+
+    Arguments
+    ---------
+    rows : iterable
+        Sequences of the raw strings of the ``AIS_CSV_COLUMNS``, or empty
+        sequences for rows which could not be read
+    writer : csv.writer or superpyrate.pgcopy.BinaryCopyWriter
+        The writer for the output file
+    chunksize : int, default=CHUNKSIZE
+        The number of valid rows gathered before each write
+    counts : superpyrate.stats.ValidationCounts, default=None
+        Counts of the rows rejected and written, which are added to
+    rejects : csv.writer, default=None
+        If given, the rows which could be read but were rejected are written
+        to it, as by :py:func:`salvage_values`, followed by the reason for
+        their rejection
+    """
+    if counts is None:
+        counts = ValidationCounts()
+    converters = [get_converter(col) for col in AIS_CSV_COLUMNS]
+    valid_rows = []
+    for values in rows:
+        if not values:
+            # The error has been counted by category as the row was read
+            counts.invalid += 1
+            continue
+        try:
+            row = [convert(value) for convert, value
+                   in zip(converters, values)]
+        except ValueError as e:
+            counts.reject(PARSE_ERROR, "Invalid data in row {}: {}", values, e)
+            if rejects is not None:
+                rejects.writerow(salvage_values(values) + [PARSE_ERROR])
+            continue
+        if validate_values(row):
+            valid_rows.append(row)
+            if len(valid_rows) >= chunksize:
+                writer.writerows(valid_rows)
+                counts.clean += len(valid_rows)
+                valid_rows = []
+        else:
+            counts.reject(VALIDATION, "Error in validating the converted row "
+                          "{}", values)
+            if rejects is not None:
+                rejects.writerow(salvage_values(values) + [VALIDATION])
+    if valid_rows:
+        writer.writerows(valid_rows)
+        counts.clean += len(valid_rows)
@@ -1,7 +1,12 @@
 """Sets up the tables in a newly created database, ready for data ingest
+
+Pass ``--partitioned`` to partition ``ais_clean`` by month, see
+:py:mod:`superpyrate.partitions`
 """
 from pyrate.repositories.aisdb import AISdb
 from superpyrate.pipeline import get_environment_variable
+from superpyrate.partitions import partition_table
+import sys
 
 def make_options():
     options = {}
@@ -11,12 +16,14 @@ def make_options():
     options['pass'] = get_environment_variable('DBUSERPASS')
     return options
 
-def main():
+def main(partitioned=False):
     options = make_options()
     db = AISdb(options)
     with db:
         db.create()
         db.clean.drop_indices()
+        if partitioned:
+            partition_table(db.conn, 'ais_clean')
 
 if __name__ == '__main__':
-    main()
+    main('--partitioned' in sys.argv[1:])
@@ -0,0 +1,360 @@
+"""A pool of postgres connections shared by the database tasks of a process
+
+Each luigi task which touches the database would otherwise open a new
+connection to run, and another each time luigi checks whether it is complete.
+With many workers this churns through connections against the fixed
+``max_connections`` of the server.  Instead, tasks which inherit from
+:py:class:`PooledConnectionMixin` borrow connections from a pool kept by each
+process, and ``connection.close()`` returns a connection to the pool.
+
+The pool is configured in the ``[postgres_pool]`` section of the luigi
+configuration:
+
+``max_connections``
+    the most connections a process holds at once, both borrowed and idle.
+    Borrowing blocks for up to ``timeout`` seconds while all are in use
+``check_interval``
+    connections which have been idle for longer than this many seconds are
+    checked with ``SELECT 1`` before being lent again
+
+Connections are only reused within a process, and luigi runs each task of a
+multi-worker run (``--workers`` more than 1, or ``force_multiprocessing`` in
+the ``[worker]`` section) in a process forked for that task alone.  So the
+pool reuses connections:
+
+* for the checks of whether tasks are complete, which are made by the
+  scheduling process whatever the number of workers
+* across all the tasks of a run with a single worker, the default, which
+  luigi runs in its own process
+* within a task which borrows several times, such as
+  :py:class:`~superpyrate.pipeline.LoadCleanedArchive`
+
+With several workers, each task opens its connections afresh and they are
+closed when its process exits.  To reuse server connections across such
+tasks, run `PgBouncer <https://www.pgbouncer.org>`_ in front of the server,
+in session or transaction pooling mode, and point ``DBHOSTNAME`` (and the
+``PGPORT`` environment variable, which is read by ``libpq`` as no port is
+given) at PgBouncer rather than at postgres.  PgBouncer then bounds the
+connections to the server, whatever the number of workers.
+
+Connections are never shared with a forked process: a child process starts a
+new pool, and leaves those inherited from its parent untouched.
+
+Checking whether a task is complete looks for its row in the marker table,
+which is one query for each task.  Instead, the first check of a task writing
+to a table reads the ids of all the markers of that table in one query, and
+the other tasks of the table are checked against these.  Only the markers
+found are trusted, as those of other processes are written in their own
+transactions, and a task whose marker is missing is checked again with its
+own query.
+"""
+from functools import partial
+import os
+import threading
+import time
+import luigi
+from luigi.postgres import PostgresTarget
+import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+import logging
+LOGGER = logging.getLogger('luigi-interface')
+
+
+class postgres_pool(luigi.Config):
+    max_connections = luigi.IntParameter(default=4)
+    check_interval = luigi.FloatParameter(default=30.0)
+    timeout = luigi.FloatParameter(default=300.0)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """A connection which returns itself to its pool when closed
+    """
+    pool = None
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.putconn(self)
+
+    def discard(self):
+        """Closes the connection for good
+        """
+        super().close()
+
+
+class ConnectionPool(object):
+    """A bounded pool of connections, lent out to one borrower at a time
+
+    Arguments
+    ---------
+    connect : callable
+        Returns a new connection, which must have ``pool`` and ``discard``
+        attributes like a :py:class:`PooledConnection`
+    max_connections : int, default=4
+    check_interval : float, default=30.0
+    timeout : float, default=300.0
+    """
+    def __init__(self, connect, max_connections=4, check_interval=30.0,
+                 timeout=300.0):
+        self.connect = connect
+        self.max_connections = max_connections
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.pid = os.getpid()
+
+    def getconn(self):
+        """Lends an idle connection which passes its health check, or a new one
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise RuntimeError("All {} pooled connections have been in use "
+                               "for {} seconds".format(self.max_connections,
+                                                       self.timeout))
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    connection, last_used = self.idle.pop()
+                if self.is_healthy(connection, last_used):
+                    connection.borrowed = True
+                    return connection
+                LOGGER.debug("Discarding an unhealthy pooled connection")
+                self.discard(connection)
+            connection = self.connect()
+            connection.pool = self
+            connection.borrowed = True
+            return connection
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def putconn(self, connection):
+        """Takes back a borrowed connection, rolling back anything uncommitted
+        """
+        if not getattr(connection, 'borrowed', False):
+            return
+        connection.borrowed = False
+        try:
+            if connection.closed:
+                return
+            try:
+                if connection.get_transaction_status() != \
+                        psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                connection.autocommit = False
+            except psycopg2.Error:
+                self.discard(connection)
+                return
+            with self.lock:
+                self.idle.append((connection, time.monotonic()))
+        finally:
+            self.slots.release()
+
+    def is_healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def discard(self, connection):
+        try:
+            connection.discard()
+        except psycopg2.Error:
+            pass
+
+    def closeall(self):
+        """Closes the idle connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            self.discard(connection)
+
+
+_pools = {}
+_inherited = []
+_pools_lock = threading.Lock()
+
+
+def new_connection(**kwargs):
+    connection = psycopg2.connect(connection_factory=PooledConnection,
+                                  **kwargs)
+    connection.set_client_encoding('utf-8')
+    return connection
+
+
+def get_pool(host, port, database, user, password):
+    """Returns the pool of this process for a database, creating it if needed
+    """
+    kwargs = {'host': host, 'port': port, 'database': database,
+              'user': user, 'password': password}
+    key = tuple(sorted(kwargs.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.pid != os.getpid():
+            if pool is not None:
+                # The connections of the parent process must not be closed
+                # by this one, so are kept from being garbage collected
+                _inherited.append(pool)
+            config = postgres_pool()
+            pool = ConnectionPool(partial(new_connection, **kwargs),
+                                  config.max_connections,
+                                  config.check_interval,
+                                  config.timeout)
+            _pools[key] = pool
+        return pool
+
+
+#: The update ids of the markers read by this process, by the database, the
+#: marker table and the table written by the tasks
+_markers = {}
+_markers_lock = threading.Lock()
+
+
+def find_markers(connection, marker_table, table):
+    """Returns the update ids of the markers of the tasks writing to a table
+
+    Returns
+    -------
+    set
+        Empty if the marker table does not exist yet
+    """
+    sql = "SELECT update_id FROM {} WHERE target_table = %s;".format(
+        marker_table)
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute(sql, (table,))
+        except psycopg2.ProgrammingError as error:
+            if error.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE:
+                return set()
+            raise
+        return set(row[0] for row in cursor.fetchall())
+
+
+def clear_markers():
+    """Forgets the markers read by this process
+    """
+    with _markers_lock:
+        _markers.clear()
+
+
+class PooledPostgresTarget(PostgresTarget):
+    """A :py:class:`luigi.postgres.PostgresTarget` whose connections are pooled
+
+    The existence of the marker is first checked against those of the table
+    read in bulk, see :py:func:`find_markers`.  The marker is written, and the
+    marker table created if need be, on the connection passed to
+    :py:meth:`touch`, so that a task marking itself complete in the
+    transaction of its load does not borrow a second connection
+    """
+    def connect(self):
+        return get_pool(self.host, self.port, self.database, self.user,
+                        self.password).getconn()
+
+    def exists(self, connection=None):
+        if connection is not None:
+            return super().exists(connection)
+        key = (self.host, self.port, self.database, self.marker_table,
+               self.table)
+        connection = self.connect()
+        try:
+            connection.autocommit = True
+            with _markers_lock:
+                markers = _markers.get(key)
+                if markers is None:
+                    markers = find_markers(connection, self.marker_table,
+                                           self.table)
+                    _markers[key] = markers
+            if self.update_id in markers:
+                return True
+            exists = super().exists(connection)
+            if exists:
+                with _markers_lock:
+                    markers.add(self.update_id)
+            return exists
+        finally:
+            connection.close()
+
+    def touch(self, connection=None):
+        if connection is None:
+            connection = self.connect()
+            try:
+                self.touch(connection)
+                connection.commit()
+            finally:
+                connection.close()
+            return
+        self.create_marker_table(connection)
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO {} "
+                           "(update_id, target_table, inserted) "
+                           "VALUES (%s, %s, now());".format(self.marker_table),
+                           (self.update_id, self.table))
+
+    def create_marker_table(self, connection=None):
+        """Creates the marker table if it does not exist
+
+        Arguments
+        ---------
+        connection : psycopg2.extensions.connection, default=None
+            If given, the table is created in the transaction of this
+            connection, under a savepoint so that the transaction survives
+            another process creating the table at the same time.  Otherwise a
+            connection is borrowed from the pool
+        """
+        if connection is None:
+            connection = self.connect()
+            try:
+                self.create_marker_table(connection)
+                connection.commit()
+            finally:
+                connection.close()
+            return
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s);", (self.marker_table,))
+            if cursor.fetchone()[0] is not None:
+                return
+            cursor.execute("SAVEPOINT create_marker_table;")
+            try:
+                cursor.execute("CREATE TABLE IF NOT EXISTS {} ("
+                               "update_id TEXT PRIMARY KEY, "
+                               "target_table TEXT, "
+                               "inserted TIMESTAMP DEFAULT NOW());".format(
+                                   self.marker_table))
+            except psycopg2.Error as error:
+                if error.pgcode not in (psycopg2.errorcodes.DUPLICATE_TABLE,
+                                        psycopg2.errorcodes.UNIQUE_VIOLATION):
+                    raise
+                # Created by another process since
+                cursor.execute("ROLLBACK TO SAVEPOINT create_marker_table;")
+            else:
+                cursor.execute("RELEASE SAVEPOINT create_marker_table;")
+
+
+class PooledConnectionMixin(object):
+    """Has a luigi postgres task borrow its connections from the pool
+
+    Must come before :py:class:`~luigi.postgres.CopyToTable` or
+    :py:class:`~luigi.postgres.PostgresQuery` in the bases of a task
+    """
+    def output(self):
+        target = super().output()
+        return PooledPostgresTarget(host=target.host,
+                                    database=target.database,
+                                    user=target.user,
+                                    password=target.password,
+                                    table=target.table,
+                                    update_id=target.update_id,
+                                    port=target.port)
@@ -0,0 +1,185 @@
+"""Extracts the csv files of zipped archives in this process
+
+Rather than starting a ``7za e`` process for each archive, which inflates one
+member after another on a single core, the members of an archive are
+extracted by :py:func:`extract_archive` on a pool of threads, each of which
+reads the archive through its own file handle.  :py:mod:`zlib`, :py:mod:`bz2`
+and :py:mod:`lzma` release the GIL while decompressing, so the members are
+inflated in parallel.  The CRC-32 of each member is checked by
+:py:mod:`zipfile` as it is read, and a member whose contents do not match the
+central directory raises an error once its last block is read.  The SHA-256
+of the contents of each member is computed as it is extracted, for the
+manifest of :py:mod:`superpyrate.manifest`.
+
+The degree of parallelism is set in the ``[unzip]`` section of the luigi
+configuration:
+
+``workers``
+    the threads extracting the members of each archive, by default as many as
+    the cores of this machine.  No more threads are started than the archive
+    has members
+
+Python's :py:mod:`zipfile` does not support every compression method which
+``7za`` does (e.g. deflate64), so :py:func:`can_extract` checks whether an
+archive can be extracted in this process.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from superpyrate.intermediates import EXTENSIONS, open_intermediate
+from superpyrate.manifest import save_member_hashes
+import hashlib
+import os
+import shutil
+import zipfile
+import luigi
+import logging
+LOGGER = logging.getLogger('luigi-interface')
+
+
+class unzip(luigi.Config):
+    workers = luigi.IntParameter(default=0)
+
+
+#: The compression methods of the members which can be extracted
+SUPPORTED_METHODS = {zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED,
+                     zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA}
+
+#: The size of the blocks in which members are copied
+BLOCK_SIZE = 1024 * 1024
+
+
+def get_workers():
+    """Returns the number of threads extracting the members of an archive
+    """
+    workers = unzip().workers
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def list_members(archive, extension='.csv'):
+    """Returns the members of an archive to extract, by their file name
+
+    As with ``7za e``, any folder structure within the archive is ignored, so
+    of several members with the same name, the last in the archive is kept.
+
+    Arguments
+    ---------
+    archive : zipfile.ZipFile
+    extension : str, default='.csv'
+
+    Returns
+    -------
+    dict
+        The :py:class:`zipfile.ZipInfo` of each member, by its file name
+    """
+    members = {}
+    for info in archive.infolist():
+        name = os.path.basename(info.filename)
+        if os.path.splitext(name)[1] == extension:
+            members[name] = info
+    return members
+
+
+def can_extract(zip_file, extension='.csv'):
+    """Checks whether all the members of an archive use a compression method
+    supported by :py:mod:`zipfile`
+    """
+    with zipfile.ZipFile(zip_file) as archive:
+        return all(info.compress_type in SUPPORTED_METHODS
+                   for info in list_members(archive, extension).values())
+
+
+def extract_member(zip_file, info, path, compression='', level=None):
+    """Extracts a member of an archive to a file, hashing its contents
+
+    Arguments
+    ---------
+    zip_file : str
+    info : zipfile.ZipInfo
+    path : str
+        The path of the extracted file
+    compression : str, default=''
+        The codec with which the file is compressed, if any
+    level : int, default=None
+        The compression level, by default that of the configuration
+
+    Returns
+    -------
+    str
+        The SHA-256 of the uncompressed contents of the member, as by
+        :py:func:`superpyrate.manifest.hash_member`
+    """
+    if compression:
+        output_file = open_intermediate(path, 'wb', level)
+    else:
+        output_file = open(path, 'wb')
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(zip_file) as archive, \
+            archive.open(info) as member, output_file:
+        for block in iter(lambda: member.read(BLOCK_SIZE), b''):
+            digest.update(block)
+            output_file.write(block)
+    return 'sha256:' + digest.hexdigest()
+
+
+def extract_archive(zip_file, folder, extension='.csv', workers=None,
+                    compression='', level=None, cache_folder=None):
+    """Extracts the csv files of an archive into a folder on a pool of threads
+
+    The files are extracted into a temporary folder, which is renamed to
+    ``folder`` once they are all written, so a folder which exists holds all
+    the members of the archive.  The largest members are started first, so
+    that the threads finish at much the same time.
+
+    Arguments
+    ---------
+    zip_file : str
+    folder : str
+    extension : str, default='.csv'
+        Only the members with this extension are extracted
+    workers : int, default=None
+        The number of threads, by default that of the configuration
+    compression : str, default=''
+        The codec with which the extracted files are compressed, named with
+        its extension after that of the csv file.  By default the files are
+        not compressed
+    level : int, default=None
+        The compression level, by default that of the configuration
+    cache_folder : str, default=None
+        If given, the SHA-256 of each member is kept in this folder, see
+        :py:func:`superpyrate.manifest.read_member_hashes`
+
+    Returns
+    -------
+    list
+        The paths of the extracted files
+    """
+    if workers is None:
+        workers = get_workers()
+    suffix = EXTENSIONS[compression] if compression else ''
+    with zipfile.ZipFile(zip_file) as archive:
+        members = list_members(archive, extension)
+    order = sorted(members, key=lambda name: members[name].file_size,
+                   reverse=True)
+
+    temporary_folder = '{}.{}.tmp'.format(folder, os.getpid())
+    os.makedirs(temporary_folder, exist_ok=True)
+    try:
+        with ThreadPoolExecutor(max(1, min(workers, len(order)))) as executor:
+            futures = [executor.submit(extract_member, zip_file, members[name],
+                                       os.path.join(temporary_folder,
+                                                    name + suffix),
+                                       compression, level)
+                       for name in order]
+            hashes = {name: future.result()
+                      for name, future in zip(order, futures)}
+        os.rename(temporary_folder, folder)
+    except BaseException:
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        raise
+    if cache_folder:
+        save_member_hashes(zip_file, cache_folder, hashes)
+    LOGGER.debug("Extracted {} bytes in {} files from {}".format(
+        sum(info.file_size for info in members.values()), len(order),
+        zip_file))
+    return [os.path.join(folder, name + suffix) for name in sorted(order)]
@@ -0,0 +1,154 @@
+"""Sorts clean csv files by MMSI and Time in bounded memory
+
+``ais_clean`` is clustered on its MMSI index so that the messages of a vessel
+are read from neighbouring pages.  Rather than rewriting the whole table with
+``CLUSTER`` once it has been loaded, the clean csv files can be loaded in this
+order in the first place.
+
+The rows of all the files are sorted by an external merge sort: at most
+``buffer_rows`` rows are sorted in memory at once and spilled to a run file,
+and the run files are then merged, at most ``max_open`` at a time, into a
+single sorted stream.
+"""
+from pyrate.algorithms.aisparser import AIS_CSV_COLUMNS
+from superpyrate.intermediates import open_intermediate
+from tempfile import mkstemp
+import csv
+import heapq
+import os
+import logging
+LOGGER = logging.getLogger('luigi-interface')
+
+MMSI = AIS_CSV_COLUMNS.index('MMSI')
+TIME = AIS_CSV_COLUMNS.index('Time')
+
+#: The number of rows sorted in memory before they are spilled to a run file
+BUFFER_ROWS = 1000000
+#: The most run files merged at once
+MAX_OPEN = 256
+
+
+def sort_key(row):
+    """Orders the rows of a clean csv file by MMSI and then by Time
+
+    Times are written as ``YYYY-MM-DD HH:MM:SS``, which sort as text
+    """
+    return int(row[MMSI]), row[TIME]
+
+
+def read_clean_rows(csvfiles):
+    """Yields the rows of clean csv files, without their headers
+
+    The files may be compressed, see :py:mod:`superpyrate.intermediates`
+    """
+    for csvfile in csvfiles:
+        with open_intermediate(csvfile, 'r', newline='') as open_file:
+            reader = csv.reader(open_file, dialect="excel")
+            next(reader, None)
+            yield from reader
+
+
+def write_run(rows, folder):
+    """Writes rows to a new run file in ``folder``, returning its path
+    """
+    handle, path = mkstemp(suffix='.csv', prefix='run', dir=folder)
+    with open(handle, 'w', newline='') as run_file:
+        csv.writer(run_file, dialect="excel").writerows(rows)
+    return path
+
+
+def write_sorted_runs(rows, folder, buffer_rows=BUFFER_ROWS):
+    """Sorts rows in batches of ``buffer_rows``, spilling each to a run file
+
+    Returns
+    -------
+    list
+        The paths of the run files, each sorted by :py:func:`sort_key`
+    """
+    runs = []
+    buffer = []
+    try:
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) >= buffer_rows:
+                buffer.sort(key=sort_key)
+                runs.append(write_run(buffer, folder))
+                buffer = []
+        if buffer:
+            buffer.sort(key=sort_key)
+            runs.append(write_run(buffer, folder))
+    except BaseException:
+        remove_runs(runs)
+        raise
+    return runs
+
+
+def merge_runs(runs, writer):
+    """Merges sorted run files into a csv writer
+    """
+    open_files = [open(run, 'r', newline='') for run in runs]
+    try:
+        readers = [csv.reader(open_file, dialect="excel")
+                   for open_file in open_files]
+        writer.writerows(heapq.merge(*readers, key=sort_key))
+    finally:
+        for open_file in open_files:
+            open_file.close()
+
+
+def remove_runs(runs):
+    for run in runs:
+        try:
+            os.remove(run)
+        except FileNotFoundError:
+            pass
+
+
+def sort_csv_files(csvfiles, outfile, folder, buffer_rows=BUFFER_ROWS,
+                   max_open=MAX_OPEN):
+    """Writes the rows of clean csv files to a single file, sorted by MMSI and
+    Time
+
+    Arguments
+    ---------
+    csvfiles : list
+        The paths of clean csv files, each with a header of the
+        ``AIS_CSV_COLUMNS``
+    outfile : file object
+        An open text file object, such as a
+        :py:class:`~superpyrate.tasks.BoundedPipe`, to which a header and the
+        sorted rows are written
+    folder : str
+        The folder in which the run files are spilled, which are removed
+        once merged
+    buffer_rows : int, default=BUFFER_ROWS
+        The number of rows sorted in memory at once
+    max_open : int, default=MAX_OPEN
+        The most run files merged at once
+    """
+    os.makedirs(folder, exist_ok=True)
+    runs = write_sorted_runs(read_clean_rows(csvfiles), folder, buffer_rows)
+    LOGGER.info("Sorted {} files into {} runs".format(len(csvfiles),
+                                                      len(runs)))
+    try:
+        while len(runs) > max_open:
+            merged = []
+            try:
+                for start in range(0, len(runs), max_open):
+                    group = runs[start:start + max_open]
+                    handle, path = mkstemp(suffix='.csv', prefix='run',
+                                           dir=folder)
+                    merged.append(path)
+                    with open(handle, 'w', newline='') as run_file:
+                        merge_runs(group,
+                                   csv.writer(run_file, dialect="excel"))
+                    remove_runs(group)
+            except BaseException:
+                remove_runs(merged)
+                raise
+            runs = merged
+        writer = csv.writer(outfile, dialect="excel")
+        writer.writerow(AIS_CSV_COLUMNS)
+        merge_runs(runs, writer)
+    finally:
+        remove_runs(runs)
@@ -0,0 +1,101 @@
+"""Plans how the indices of a table are built
+
+Building an index sorts the whole table, so it is much quicker when given
+enough ``maintenance_work_mem`` to sort in memory, and when postgres may use
+parallel workers to scan the table.  Each build is given its share of the
+memory and cores available for building indices, and as many builds run at
+once as can be given at least ``min_memory_mb`` and two cores each.
+
+The resources are configured in the ``[index_build]`` section of the luigi
+configuration:
+
+``memory_mb``
+    the memory available to all the builds running at once, by default
+    4096MB
+``memory_fraction``
+    if more than 0, the memory available is instead this fraction of the
+    physical memory of this machine, for when the database runs on the same
+    host
+``cores``
+    the cores available to all the builds running at once, by default all
+    those of this machine
+``min_memory_mb``
+    the least memory given to each build
+"""
+import os
+import luigi
+
+
+class index_build(luigi.Config):
+    memory_mb = luigi.IntParameter(default=4096)
+    memory_fraction = luigi.FloatParameter(default=0.0)
+    cores = luigi.IntParameter(default=0)
+    min_memory_mb = luigi.IntParameter(default=1024)
+
+
+#: The index over which ``ais_clean`` is clustered, which is built first
+CLUSTER_INDEX = 'mmsi_idx'
+
+
+def get_physical_memory_mb():
+    """Returns the physical memory of this machine, or None if unknown
+    """
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+    return pages * page_size // (1024 * 1024)
+
+
+def get_index_resources():
+    """Returns the memory in MB and the cores available for building indices
+
+    Returns
+    -------
+    tuple
+        The memory, the number of cores and the least memory for each build
+    """
+    config = index_build()
+    memory_mb = config.memory_mb
+    if config.memory_fraction > 0:
+        physical_memory_mb = get_physical_memory_mb()
+        if physical_memory_mb:
+            memory_mb = int(physical_memory_mb * config.memory_fraction)
+    cores = config.cores
+    if cores <= 0:
+        cores = os.cpu_count() or 1
+    return memory_mb, cores, config.min_memory_mb
+
+
+def plan_index_builds(number, memory_mb, cores, min_memory_mb=1024):
+    """Chooses how many indices are built at once, and the resources of each
+
+    Arguments
+    ---------
+    number : int
+        The number of indices to build
+    memory_mb : int
+        The memory available to all the builds running at once
+    cores : int
+        The cores available to all the builds running at once
+    min_memory_mb : int, default=1024
+        The least memory given to each build
+
+    Returns
+    -------
+    tuple
+        The number of builds run at once, the ``maintenance_work_mem`` in MB
+        and the ``max_parallel_maintenance_workers`` of each build
+    """
+    concurrent = max(1, min(number, cores // 2, memory_mb // min_memory_mb))
+    build_memory_mb = max(1, memory_mb // concurrent)
+    # Each build runs in its own process besides its parallel workers
+    workers = max(0, cores // concurrent - 1)
+    return concurrent, build_memory_mb, workers
+
+
+def order_indices(indices):
+    """Puts the index over which ``ais_clean`` is clustered first
+    """
+    return sorted(indices, key=lambda index: index[0] != CLUSTER_INDEX)
@@ -0,0 +1,126 @@
+"""Compression of the intermediate files kept in ``LUIGIWORK/files``
+
+The csv files extracted into ``files/unzipped``, and the clean and rejected
+rows written to ``files/cleancsv`` and ``files/dirtycsv``, are as large as the
+raw data, which limits how many archives can be processed at once.  These can
+instead be kept compressed, with a ``.gz`` extension after that of the csv
+file, by setting ``compression`` in the ``[intermediates]`` section of the
+luigi configuration:
+
+``compression``
+    ``gzip`` to compress the intermediate files, or empty (the default) to
+    leave them uncompressed
+``level``
+    the compression level, by default 1, which is the quickest
+
+The tasks are still named after the csv files, and every task reading an
+intermediate file finds it whether it is compressed or not, so the files of a
+working folder need not all have been written with the same setting.  Files
+are read and written through :py:func:`open_intermediate`, which compresses
+and decompresses them as a stream.
+"""
+from superpyrate.targets import file_exists
+import gzip
+import os
+import luigi
+
+
+class intermediates(luigi.Config):
+    compression = luigi.Parameter(default='')
+    level = luigi.IntParameter(default=1)
+
+
+#: The extension added to the files compressed with each codec
+EXTENSIONS = {'gzip': '.gz'}
+
+
+def get_compression():
+    """Returns the codec of the intermediate files, or '' if uncompressed
+    """
+    compression = intermediates().compression
+    if compression and compression not in EXTENSIONS:
+        raise ValueError("Unknown compression of intermediate files: "
+                         "{}".format(compression))
+    return compression
+
+
+def is_compressed(path):
+    """Checks whether a file path is that of a compressed file
+    """
+    return isinstance(path, str) and \
+        os.path.splitext(path)[1] in EXTENSIONS.values()
+
+
+def intermediate_path(path):
+    """Returns the path to which an intermediate file is written
+
+    Arguments
+    ---------
+    path : str
+        The path of the uncompressed file
+
+    Returns
+    -------
+    str
+        ``path``, with the extension of the codec added if the intermediate
+        files are compressed
+    """
+    compression = get_compression()
+    if compression:
+        return path + EXTENSIONS[compression]
+    return path
+
+
+def find_intermediate(path):
+    """Returns the path of an intermediate file, compressed or not
+
+    Arguments
+    ---------
+    path : str
+        The path of the uncompressed file
+
+    Returns
+    -------
+    str
+        The path of the file which exists, preferring the uncompressed file,
+        or if neither exists the path to which it would be written
+    """
+    if file_exists(path):
+        return path
+    for extension in EXTENSIONS.values():
+        if file_exists(path + extension):
+            return path + extension
+    return intermediate_path(path)
+
+
+def uncompressed_name(name):
+    """Removes the extension of a codec from a file name
+    """
+    base, extension = os.path.splitext(name)
+    if extension in EXTENSIONS.values():
+        return base
+    return name
+
+
+def open_intermediate(path, mode='r', level=None, **kwargs):
+    """Opens a file, through gzip if its name ends with ``.gz``
+
+    Arguments
+    ---------
+    path : str
+    mode : str, default='r'
+        As for :py:func:`open`.  Compressed files are opened in text mode
+        unless ``'b'`` is given
+    level : int, default=None
+        The compression level, by default that of the configuration
+    kwargs
+        Passed to :py:func:`open` or :py:func:`gzip.open`, e.g. ``newline``
+    """
+    if not is_compressed(path):
+        return open(path, mode, **kwargs)
+    if 'b' not in mode:
+        mode += 't'
+    if level is None:
+        level = intermediates().level
+    return gzip.open(path, mode, compresslevel=level, **kwargs)
+
@@ -0,0 +1,320 @@
+"""A manifest of the content already ingested into the database
+
+The markers of luigi are keyed on the paths of the files, so a renamed copy of
+an archive, or the same archive in another folder, would otherwise be
+ingested again, duplicating its rows in ``ais_clean``.  Instead, the content
+of each archive and of each csv file within it is recorded in the
+``ais_manifest`` table, next to ``ais_sources``, once it is loaded, and
+content already in the manifest is skipped whatever its name.
+
+An archive is identified by the SHA-256 of the file, and a csv file within an
+archive by the SHA-256 of its uncompressed contents.  The hashes of the
+members are computed as they are read, so no member is decompressed just to
+hash it: by :py:func:`superpyrate.extract.extract_archive` as they are
+extracted, and kept with :py:func:`save_member_hashes`, or as a member
+streamed from its archive is validated, and kept with
+:py:func:`save_member_hash`.  The files which ``7za`` extracts are hashed by
+:py:func:`hash_files` straight after.  Both kinds of hash are kept in a cache
+folder, and read from it again by :py:func:`read_member_hashes` while the
+size and modification time of the archive are unchanged.
+
+The hash of a csv file is only known once it has been read, so a csv file is
+added to the manifest in the transaction which copies its rows, and those
+rows are rolled back if :py:func:`record_ingested` finds its content already
+there.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values
+import hashlib
+import json
+import os
+import zipfile
+
+MANIFEST_TABLE = 'ais_manifest'
+
+#: The size of the blocks in which archives and their members are hashed
+BLOCK_SIZE = 1024 * 1024
+
+
+def get_cache_file(zip_file, cache_folder, suffix):
+    """Returns the file caching a hash of an archive, and the stamp of the
+    archive
+
+    Returns
+    -------
+    cache_file : str
+    stamp : list
+        The size and modification time of the archive
+    """
+    stat = os.stat(zip_file)
+    key = hashlib.sha1(os.path.abspath(zip_file).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(cache_folder, key + suffix)
+    return cache_file, [stat.st_size, stat.st_mtime_ns]
+
+
+def get_member_cache_file(zip_file, cache_folder, name):
+    """Returns the file caching the hash of a single member of an archive,
+    and the stamp of the archive, as by :py:func:`get_cache_file`
+    """
+    return get_cache_file(zip_file, cache_folder, '.{}.json'.format(name))
+
+
+def read_cache(cache_file, stamp):
+    """Returns the hash kept in a cache file, or None if it is out of date
+    """
+    try:
+        with open(cache_file, 'r') as cached:
+            entry = json.load(cached)
+        if entry['stamp'] == stamp:
+            return entry['hash']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_cache(cache_file, stamp, value):
+    """Keeps a hash in a cache file
+    """
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temporary_file = '{}.{}'.format(cache_file, os.getpid())
+    with open(temporary_file, 'w') as cached:
+        json.dump({'stamp': stamp, 'hash': value}, cached)
+    os.replace(temporary_file, cache_file)
+
+
+def hash_file(file_object):
+    """Returns the SHA-256 of the rest of an open binary file
+    """
+    digest = hashlib.sha256()
+    for block in iter(lambda: file_object.read(BLOCK_SIZE), b''):
+        digest.update(block)
+    return 'sha256:' + digest.hexdigest()
+
+
+def hash_archive(zip_file, cache_folder=None):
+    """Returns the SHA-256 of an archive
+
+    Arguments
+    ---------
+    zip_file : str
+    cache_folder : str, default=None
+        If given, the hash is kept in a file in this folder, and read from it
+        again while the size and modification time of the archive are
+        unchanged
+    """
+    if cache_folder:
+        cache_file, stamp = get_cache_file(zip_file, cache_folder, '.json')
+        archive_hash = read_cache(cache_file, stamp)
+        if archive_hash:
+            return archive_hash
+
+    with open(zip_file, 'rb') as archive:
+        archive_hash = hash_file(archive)
+
+    if cache_folder:
+        write_cache(cache_file, stamp, archive_hash)
+    return archive_hash
+
+
+def hash_archives(zip_files, cache_folder=None, workers=None):
+    """Returns the SHA-256 of several archives, hashed on a pool of threads
+
+    :py:mod:`hashlib` releases the GIL while hashing large blocks, so the
+    archives are read and hashed in parallel
+
+    Arguments
+    ---------
+    zip_files : list
+    cache_folder : str, default=None
+        See :py:func:`hash_archive`
+    workers : int, default=None
+        The number of threads, by default as many as the cores
+
+    Returns
+    -------
+    list
+        The hash of each archive, in the order of ``zip_files``
+    """
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max(1, min(workers, len(zip_files)))) as executor:
+        return list(executor.map(lambda zip_file: hash_archive(zip_file,
+                                                               cache_folder),
+                                 zip_files))
+
+
+def hash_member(zip_file, info):
+    """Returns the SHA-256 of the uncompressed contents of a member of an
+    archive, given its :py:class:`zipfile.ZipInfo`
+    """
+    with zipfile.ZipFile(zip_file) as archive, archive.open(info) as member:
+        return hash_file(member)
+
+
+def hash_files(paths, workers=None):
+    """Returns the SHA-256 of several files, read on a pool of threads
+
+    Arguments
+    ---------
+    paths : list
+    workers : int, default=None
+        The number of threads, by default as many as the cores
+
+    Returns
+    -------
+    list
+        The hash of each file, in the order of ``paths``
+    """
+    return hash_archives(paths, workers=workers)
+
+
+def save_member_hashes(zip_file, cache_folder, hashes):
+    """Keeps the hashes of the members of an archive, as computed while they
+    are extracted, for :py:func:`read_member_hashes`
+    """
+    cache_file, stamp = get_cache_file(zip_file, cache_folder, '.members.json')
+    write_cache(cache_file, stamp, hashes)
+
+
+def save_member_hash(zip_file, cache_folder, name, member_hash):
+    """Keeps the hash of a single member of an archive, as computed while it
+    is streamed from the archive, for :py:func:`read_member_hashes`
+
+    Each member is kept in a file of its own, as the members of an archive
+    may be read by several processes at once
+    """
+    cache_file, stamp = get_member_cache_file(zip_file, cache_folder, name)
+    write_cache(cache_file, stamp, member_hash)
+
+
+def read_member_hashes(zip_file, cache_folder, names):
+    """Returns the hashes of those members of an archive which have been
+    kept, without decompressing any member
+
+    Arguments
+    ---------
+    zip_file : str
+    cache_folder : str
+    names : list
+        The names of the members without their folder
+
+    Returns
+    -------
+    dict
+        The hash of each member which was kept by :py:func:`save_member_hashes`
+        or :py:func:`save_member_hash`, by its name
+    """
+    cache_file, stamp = get_cache_file(zip_file, cache_folder, '.members.json')
+    extracted = read_cache(cache_file, stamp) or {}
+    hashes = {}
+    for name in names:
+        if name in extracted:
+            hashes[name] = extracted[name]
+            continue
+        member_hash = read_cache(*get_member_cache_file(zip_file, cache_folder,
+                                                        name))
+        if member_hash:
+            hashes[name] = member_hash
+    return hashes
+
+
+def hash_members(zip_file, extension='.csv', cache_folder=None, workers=None):
+    """Returns the SHA-256 of the contents of each member of an archive
+
+    The members are named without any folder, so of several members with the
+    same name the last in the archive is kept, as by
+    :py:func:`superpyrate.extract.list_members`.  They are decompressed and
+    hashed on a pool of threads.
+
+    Arguments
+    ---------
+    zip_file : str
+    extension : str, default='.csv'
+    cache_folder : str, default=None
+        If given, the hashes are kept in a file in this folder, and read from
+        it again while the size and modification time of the archive are
+        unchanged
+    workers : int, default=None
+        The number of threads, by default as many as the cores
+
+    Returns
+    -------
+    dict
+        The hash of each member, by the name of the member without its folder
+    """
+    if cache_folder:
+        cache_file, stamp = get_cache_file(zip_file, cache_folder,
+                                           '.members.json')
+        hashes = read_cache(cache_file, stamp)
+        if hashes is not None:
+            return hashes
+
+    with zipfile.ZipFile(zip_file) as archive:
+        members = {os.path.basename(info.filename): info
+                   for info in archive.infolist()
+                   if os.path.splitext(info.filename)[1] == extension}
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max(1, min(workers, len(members)))) as executor:
+        futures = {name: executor.submit(hash_member, zip_file, info)
+                   for name, info in members.items()}
+        hashes = {name: future.result() for name, future in futures.items()}
+
+    if cache_folder:
+        write_cache(cache_file, stamp, hashes)
+    return hashes
+
+
+def create_manifest_table(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS {} ("
+                   "hash text PRIMARY KEY, "
+                   "kind text NOT NULL, "
+                   "name text NOT NULL, "
+                   "ingested timestamp NOT NULL DEFAULT now());".format(
+                       MANIFEST_TABLE))
+
+
+def find_ingested(cursor, hashes):
+    """Returns those of the hashes which are in the manifest
+    """
+    cursor.execute("SELECT hash FROM {} WHERE hash = ANY(%s);".format(
+        MANIFEST_TABLE), (list(hashes),))
+    return set(row[0] for row in cursor.fetchall())
+
+
+def find_ingested_name(cursor, content_hash):
+    """Returns the name under which content was added to the manifest, or
+    None if it is not in the manifest
+    """
+    cursor.execute("SELECT name FROM {} WHERE hash = %s;".format(
+        MANIFEST_TABLE), (content_hash,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def record_ingested(cursor, entries):
+    """Adds content to the manifest
+
+    Content already in the manifest is left as it is.  An insert of the same
+    content by another transaction which has not yet committed blocks until
+    it does, so that only one of two concurrent loads of the same content
+    finds it added
+
+    Arguments
+    ---------
+    cursor : psycopg2.extensions.cursor
+    entries : list
+        Tuples of the hash, the kind (``'archive'`` or ``'member'``) and the
+        file name of each ingested piece of content
+
+    Returns
+    -------
+    set
+        The hashes which were added, rather than found in the manifest
+    """
+    if not entries:
+        return set()
+    rows = execute_values(cursor,
+                          "INSERT INTO {} (hash, kind, name) VALUES %s "
+                          "ON CONFLICT (hash) DO NOTHING "
+                          "RETURNING hash".format(MANIFEST_TABLE),
+                          entries, fetch=True)
+    return set(row[0] for row in rows)
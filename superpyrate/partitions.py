@@ -0,0 +1,204 @@
+"""Monthly partitions of ``ais_clean`` on ``Time``
+
+In a partitioned database, ``ais_clean`` is a table partitioned by range of
+``Time``, with a partition for each month named as ``ais_clean_y2013m09``.
+Partitions are created as the rows of their month are first loaded.  Each
+partition is indexed through the indices of ``ais_clean`` and clustered on
+its own, so the partitions of months already loaded are never rewritten.
+
+A database is partitioned after it has been set up with
+``python -m superpyrate.db_setup --partitioned``, which replaces the empty
+``ais_clean`` table with a partitioned one.
+
+The validated rows of a csv file are routed into a csv file for each of its
+months by :py:class:`PartitionRouter`, and each of these is copied straight
+into its partition, so that the server need not route the rows itself.
+"""
+from pyrate.algorithms.aisparser import AIS_CSV_COLUMNS
+from superpyrate.tables import check_replaceable, copy_grants
+import csv
+import os
+import logging
+LOGGER = logging.getLogger('luigi-interface')
+
+TIME = AIS_CSV_COLUMNS.index('Time')
+
+
+def partition_name(table, year, month):
+    """Returns the name of the partition of a table for a month
+    """
+    return "{}_y{:04d}m{:02d}".format(table, year, month)
+
+
+def month_bounds(year, month):
+    """Returns the first day of a month and of the next month, as text
+    """
+    if month == 12:
+        next_year, next_month = year + 1, 1
+    else:
+        next_year, next_month = year, month + 1
+    return ("{:04d}-{:02d}-01".format(year, month),
+            "{:04d}-{:02d}-01".format(next_year, next_month))
+
+
+def get_month(time):
+    """Returns the (year, month) of a ``Time``
+
+    Arguments
+    ---------
+    time : datetime or str
+        A datetime, as given by the row and compact engines, or text as
+        ``%Y-%m-%d %H:%M:%S``, as given by the numpy engine
+    """
+    if isinstance(time, str):
+        return int(time[0:4]), int(time[5:7])
+    return time.year, time.month
+
+
+class PartitionRouter(object):
+    """Writes validated rows to a csv file for each month of their ``Time``
+
+    Used in place of the writer of the clean csv file by
+    :py:func:`superpyrate.tasks.produce_valid_csv_file`, with any of its
+    engines.  The files have no header.
+
+    Arguments
+    ---------
+    folder : str
+        The folder in which the csv files of the partitions are written
+    table : str, default='ais_clean'
+    """
+    def __init__(self, folder, table='ais_clean'):
+        self.folder = folder
+        self.table = table
+        self.files = {}
+        self.writers = {}
+        self.paths = {}
+
+    def writer_for(self, month):
+        writer = self.writers.get(month)
+        if writer is None:
+            name = partition_name(self.table, *month)
+            path = os.path.join(self.folder, name + '.csv')
+            self.files[month] = open(path, 'w', newline='')
+            writer = csv.writer(self.files[month], dialect="excel")
+            self.writers[month] = writer
+            self.paths[month] = path
+        return writer
+
+    def writerow(self, row):
+        self.writer_for(get_month(row[TIME])).writerow(row)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        for partition_file in self.files.values():
+            partition_file.close()
+        self.files = {}
+        self.writers = {}
+
+    def partitions(self):
+        """Returns the paths of the csv files written, by (year, month)
+        """
+        return dict(self.paths)
+
+
+def create_partitions(connection, table, months):
+    """Creates the partitions of a table for the months which do not exist yet
+
+    Each partition is created under an advisory lock on its name, so tasks
+    loading the same month at once do not both try to create it.  The
+    transaction is committed, so that the lock on ``table`` is released
+    before the partitions are loaded.
+
+    Arguments
+    ---------
+    connection : psycopg2.extensions.connection
+    table : str
+    months : iterable
+        Tuples of (year, month)
+    """
+    with connection.cursor() as cursor:
+        for year, month in sorted(months):
+            name = partition_name(table, year, month)
+            start, end = month_bounds(year, month)
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));",
+                           (name,))
+            cursor.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+                           "FOR VALUES FROM (%s) TO (%s);".format(name, table),
+                           (start, end))
+    connection.commit()
+
+
+def is_partitioned(connection, table):
+    """Checks whether a table is partitioned
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s;",
+                       (table,))
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def list_partitions(connection, table):
+    """Returns the names of the partitions of a table
+
+    Returns
+    -------
+    list
+        Empty if the table is not partitioned
+    """
+    sql = "SELECT child.relname FROM pg_inherits " \
+          "JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid " \
+          "JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent " \
+          "WHERE parent.relname = %s AND parent.relkind = 'p' " \
+          "ORDER BY child.relname;"
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (table,))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_partition_index(connection, index, partition):
+    """Returns the name of the index of a partition attached to ``index``
+    """
+    sql = "SELECT child.relname FROM pg_inherits " \
+          "JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid " \
+          "JOIN pg_index ON pg_index.indexrelid = child.oid " \
+          "WHERE pg_inherits.inhparent = %s::regclass " \
+          "AND pg_index.indrelid = %s::regclass;"
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (index, partition))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def partition_table(connection, table='ais_clean'):
+    """Replaces an empty table with one partitioned by range of ``Time``
+
+    The definition of the table, including its constraints and indices, and
+    the privileges granted on it are kept, see :py:mod:`superpyrate.tables`.
+    Primary keys and unique constraints must then include ``Time``
+
+    Arguments
+    ---------
+    connection : psycopg2.extensions.connection
+    table : str, default='ais_clean'
+    """
+    if is_partitioned(connection, table):
+        LOGGER.info("{} is already partitioned".format(table))
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM {});".format(table))
+        if cursor.fetchone()[0]:
+            raise ValueError("Only an empty table can be partitioned, but {} "
+                             "holds rows".format(table))
+        check_replaceable(connection, table)
+        old_table = table + "_unpartitioned"
+        cursor.execute("ALTER TABLE {} RENAME TO {};".format(table, old_table))
+        cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING ALL) "
+                       "PARTITION BY RANGE (time);".format(table, old_table))
+        copy_grants(cursor, old_table, table)
+        cursor.execute("DROP TABLE {};".format(old_table))
+    connection.commit()
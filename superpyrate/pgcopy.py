@@ -0,0 +1,172 @@
+"""Writes validated AIS messages in PostgreSQL's binary ``COPY`` format
+
+Rather than writing the validated values as csv text, which postgres must
+then parse again, :py:class:`BinaryCopyWriter` encodes the typed values
+directly into the binary format read by ``COPY ... FROM STDIN WITH (FORMAT
+binary)``.  The binary format must match the types of the columns in the
+table exactly, so these are read from the database with
+:py:func:`get_column_types`.
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import partial
+import struct
+
+#: The signature, flags and header extension length which start every file
+HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+TRAILER = struct.pack('>h', -1)
+NULL = struct.pack('>i', -1)
+
+POSTGRES_EPOCH = datetime(2000, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+
+def get_column_types(cursor, table, columns):
+    """Reads the types of the columns of a table from the database
+
+    Arguments
+    ---------
+    cursor : psycopg2.extensions.cursor
+    table : str
+        The name of the table
+    columns : list
+        The names of the columns
+
+    Returns
+    -------
+    list
+        The type of each column, as named by ``format_type``,
+        e.g. ``'double precision'`` or ``'character varying(255)'``
+    """
+    sql = "SELECT attname, format_type(atttypid, atttypmod) " \
+          "FROM pg_attribute " \
+          "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped"
+    cursor.execute(sql, (table,))
+    types = dict(cursor.fetchall())
+    return [types[column] for column in columns]
+
+
+def encode_timestamp(value):
+    """Encodes a timestamp as microseconds since the postgres epoch
+
+    Arguments
+    ---------
+    value : datetime or str
+        A datetime, or a string formatted as ``%Y-%m-%d %H:%M:%S``
+    """
+    if isinstance(value, str):
+        value = datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                         int(value[11:13]), int(value[14:16]),
+                         int(value[17:19]))
+    microseconds = (value - POSTGRES_EPOCH) // ONE_MICROSECOND
+    return struct.pack('>iq', 8, microseconds)
+
+
+def encode_numeric(value):
+    """Encodes a number in the base 10000 digits of a postgres numeric
+    """
+    number = Decimal(repr(value))
+    if number.is_nan():
+        return struct.pack('>ihhHh', 8, 0, 0, 0xC000, 0)
+    integer, _, fraction = format(abs(number), 'f').partition('.')
+    dscale = len(fraction)
+    # Pad the digits so that they split into groups of four either side of
+    # the decimal point
+    integer = integer.lstrip('0')
+    integer = '0' * (-len(integer) % 4) + integer
+    fraction = fraction + '0' * (-len(fraction) % 4)
+    digits = integer + fraction
+    groups = [int(digits[i:i + 4]) for i in range(0, len(digits), 4)]
+    weight = len(integer) // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    sign = 0x4000 if number.is_signed() and groups else 0
+    body = struct.pack('>hhHh', len(groups), weight, sign, dscale)
+    body += struct.pack('>{}h'.format(len(groups)), *groups)
+    return struct.pack('>i', len(body)) + body
+
+
+def encode_text(value, encoding='utf-8'):
+    """Encodes a string in the client encoding of the connection
+    """
+    data = str(value).encode(encoding)
+    return struct.pack('>i', len(data)) + data
+
+
+def get_encoder(column_type, encoding='utf-8'):
+    """Returns a function which encodes a value of a postgres type
+
+    Arguments
+    ---------
+    column_type : str
+        The type of the column, as returned by :py:func:`get_column_types`
+    encoding : str, default='utf-8'
+        The Python name of the client encoding of the connection
+    """
+    fixed_size = {'smallint': '>ih',
+                  'integer': '>ii',
+                  'bigint': '>iq',
+                  'real': '>if',
+                  'double precision': '>id',
+                  'boolean': '>i?'}
+    if column_type in fixed_size:
+        packer = struct.Struct(fixed_size[column_type])
+        return partial(packer.pack, packer.size - 4)
+    elif column_type == 'timestamp without time zone':
+        return encode_timestamp
+    elif column_type.startswith('numeric'):
+        return encode_numeric
+    elif column_type == 'text' or column_type.startswith('character'):
+        return partial(encode_text, encoding=encoding)
+    else:
+        raise ValueError("Columns of type {} cannot be written in binary "
+                         "copy format".format(column_type))
+
+
+class BinaryCopyWriter(object):
+    """Writes rows to a binary file in PostgreSQL's binary ``COPY`` format
+
+    Has the same ``writerow`` and ``writerows`` methods as a
+    :py:func:`csv.writer`, and :py:meth:`finish` must be called once all the
+    rows have been written.
+
+    Arguments
+    ---------
+    binary_file : file object
+        A file object opened for writing bytes
+    column_types : list
+        The postgres type of each value in a row
+    encoding : str, default='utf-8'
+        The Python name of the client encoding of the connection
+    """
+    def __init__(self, binary_file, column_types, encoding='utf-8'):
+        self.binary_file = binary_file
+        self.encoders = [get_encoder(column_type, encoding)
+                         for column_type in column_types]
+        self.field_count = struct.pack('>h', len(column_types))
+        self.binary_file.write(HEADER)
+
+    def encode(self, row):
+        fields = [self.field_count]
+        for encoder, value in zip(self.encoders, row):
+            if value is None:
+                fields.append(NULL)
+            else:
+                fields.append(encoder(value))
+        return b''.join(fields)
+
+    def writerow(self, row):
+        self.binary_file.write(self.encode(row))
+
+    def writerows(self, rows):
+        self.binary_file.write(b''.join(self.encode(row) for row in rows))
+
+    def finish(self):
+        """Writes the trailer which marks the end of the data
+        """
+        self.binary_file.write(TRAILER)
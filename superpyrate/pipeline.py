@@ -35,18 +35,56 @@ unzipped, tasks are spawned dynamically.
         WriteCsvToDb [label="WriteCsvToDb", href="superpyrate.html#superpyrate.pipeline.WriteCsvToDb", target="_top", shape=diamond, colorscheme=dark26, color=4, style=filled];
         WriteCsvToDb -> UnzippedArchive;
         WriteCsvToDb -> LoadCleanedAIS [arrowhead=dot,arrowtail=dot];
+        LoadCleanedArchive [label="LoadCleanedArchive",
+            href="superpyrate.html#superpyrate.pipeline.LoadCleanedArchive",
+            target="_top", shape=diamond];
+        LoadCleanedArchive -> ValidMessages [arrowhead=dot,arrowtail=dot];
+        LoadCleanedArchive -> db [arrowhead=odot];
+        WriteCsvToDb -> LoadCleanedArchive [arrowhead=dot,arrowtail=dot];
+        GetDirtyCsvFile [label="GetDirtyCsvFile",
+            href="superpyrate.html#superpyrate.pipeline.GetDirtyCsvFile",
+            target="_top", shape=box];
+        LoadDirtyAIS [label="LoadDirtyAIS",
+            href="superpyrate.html#superpyrate.pipeline.LoadDirtyAIS",
+            target="_top", shape=diamond];
+        LoadDirtyAIS -> GetDirtyCsvFile;
+        LoadDirtyAIS -> db [arrowhead=odot];
+        WriteCsvToDb -> LoadDirtyAIS [arrowhead=dot,arrowtail=dot];
+        LoadSortedAIS [label="LoadSortedAIS",
+            href="superpyrate.html#superpyrate.pipeline.LoadSortedAIS",
+            target="_top", shape=diamond];
+        LoadSortedAIS -> GetFolderOfArchives;
+        LoadSortedAIS -> ProcessCsv [arrowhead=dot,arrowtail=dot];
+        LoadSortedAIS -> db [arrowhead=odot];
         ProcessZipArchives [label="ProcessZipArchives", href="superpyrate.html#superpyrate.pipeline.ProcessZipArchives", target="_top", shape=diamond, colorscheme=dark26, color=3, style=filled];
         ProcessZipArchives -> GetFolderOfArchives;
         ProcessZipArchives -> ProcessCsv [arrowhead=dot, arrowtail=dot];
         ProcessZipArchives -> WriteCsvToDb [arrowhead=dot, arrowtail=dot];
+        ProcessZipArchives -> LoadSortedAIS [arrowhead=dot, arrowtail=dot];
+        RebuildAisClean [label="RebuildAisClean",
+            href="superpyrate.html#superpyrate.pipeline.RebuildAisClean",
+            target="_top", shape=diamond, colorscheme=dark26, color=1,
+            style=filled];
+        RebuildAisClean -> GetFolderOfArchives;
+        RebuildAisClean -> ProcessCsv [arrowhead=dot,arrowtail=dot];
+        RebuildAisClean -> db [arrowhead=odot];
         RunQueryOnTable [label="RunQueryOnTable", href="superpyrate.html#superpyrate.pipeline.RunQueryOnTable", target="_top", shape=diamond];
         RunQueryOnTable -> db [arrowhead=odot];
-        MakeAllIndices [label="MakeAllIndices", href="superpyrate.html#superpyrate.pipeline.MakeAllIndices", target="_top", shape=diamond, colorscheme=dark26, color=2, style=filled];
-        MakeAllIndices -> RunQueryOnTable [arrowhead=dot, arrowtail=dot];
-        MakeAllIndices -> ProcessZipArchives;
+        BuildIndex [label="BuildIndex",
+            href="superpyrate.html#superpyrate.pipeline.BuildIndex",
+            target="_top", shape=diamond];
+        BuildIndex -> db [arrowhead=odot];
+        MakeClusteringIndex [label="MakeClusteringIndex",
+            href="superpyrate.html#superpyrate.pipeline.MakeClusteringIndex",
+            target="_top", shape=diamond];
+        MakeClusteringIndex -> BuildIndex [arrowhead=dot, arrowtail=dot];
+        MakeClusteringIndex -> ProcessZipArchives;
         ClusterAisClean [label="ClusterAisClean", href="superpyrate.html#superpyrate.pipeline.ClusterAisClean", target="_top", shape=diamond, colorscheme=dark26, color=1, style=filled];
-        ClusterAisClean -> MakeAllIndices;
+        ClusterAisClean -> MakeClusteringIndex;
         ClusterAisClean -> db [arrowhead=odot];
+        MakeAllIndices [label="MakeAllIndices", href="superpyrate.html#superpyrate.pipeline.MakeAllIndices", target="_top", shape=diamond, colorscheme=dark26, color=2, style=filled];
+        MakeAllIndices -> BuildIndex [arrowhead=dot, arrowtail=dot];
+        MakeAllIndices -> ClusterAisClean;
 
         db [label="database", shape=cylinder];
         fs [label="filesystem", shape=folder];
@@ -61,10 +99,10 @@ idempotent.  This means that a task only runs if required.  Luigi only runs the
 tasks necessary to produce the files which are required for the specified entry
 point.
 
-For example, to run the entire pipeline, producing a full ingested and clustered
-database, run::
+For example, to run the entire pipeline, producing a fully ingested, clustered
+and indexed database, run::
 
-    luigi --module superpyrate.pipeline ClusterAisClean
+    luigi --module superpyrate.pipeline MakeAllIndices
           --workers 12
           --folder-of-zips /folder/of/zips/
           --with_db
@@ -76,14 +114,191 @@ If only the validated csv files are required, run::
           --folder-of-zips /folder/of/zips/
           --with_db
 
+Planning
+========
+The csv files of each archive are read from its central directory, without
+extracting it, into a plan kept in ``tmp/archives``, see
+:py:mod:`superpyrate.planning`.  :py:class:`ProcessZipArchives` plans all the
+archives first, and logs how many csv files and bytes they hold.  The tasks of
+every csv file are then built from the plans when the graph is scheduled, and
+each requires the extraction of its archive, so :py:class:`ProcessCsv` and
+:py:class:`LoadCleanedArchive` have no dynamic dependencies.
+:py:class:`WriteCsvToDb` still yields its tasks from ``run``, as it first
+consults the manifest of ingested content in the database.
+
+The tasks are given a ``priority`` from the sizes in the plans, so that the
+largest archives and csv files are started first.  The time taken to
+validate each csv file is kept in ``tmp/timings``, and once all the archives
+are processed :py:class:`ProcessZipArchives` logs the makespan achieved
+against that expected of scheduling the files largest first, saving the
+report next to its output.  Set ``priority`` in the ``[planning]`` section of
+the configuration to choose the size used, see :py:mod:`superpyrate.planning`.
+
+With very many small csv files, setting ``batch_bytes`` in the same section
+instead validates the csv files of each archive in batches of up to that many
+bytes, each by a single :py:class:`ValidateBatch` task, so that far fewer
+tasks are scheduled.  Archives are then loaded into the database by
+:py:class:`LoadCleanedArchive`.
+
+Before scheduling, luigi checks whether every task is complete.  The files
+written by the tasks of each csv file are looked up in a single listing of
+their folder, see :py:mod:`superpyrate.targets`, and the markers of the
+database tasks in a single query for each table, see
+:py:mod:`superpyrate.dbpool`, so a re-run over many files starts quickly.
+The listings are only kept up to date with the files each process writes
+itself, so files must not be added to or removed from ``LUIGIWORK`` by
+hand while the pipeline runs.
+
+Streaming
+=========
+By default each archive is extracted into ``files/unzipped`` before
+validation, by :py:func:`~superpyrate.extract.extract_archive` on as many
+threads as set by ``workers`` in the ``[unzip]`` section of the configuration
+(``7za`` is only used for archives whose compression method :py:mod:`zipfile`
+does not support).  Passing ``--stream`` to any of the entry points instead
+reads the members of each archive through the zip central directory and
+validates each csv file from a decompressing file object, so no unzipped copy
+is written to disk.  Python's :py:mod:`zipfile` does not support every
+compression method which ``7za`` does (e.g. deflate64), so archives using
+these must be processed without ``--stream``.
+
+When loading into the database, the clean csv files in ``files/cleancsv`` can
+also be skipped by passing ``--ValidMessagesToDatabase-direct-copy``, in which
+case the validated rows are piped straight into the ``COPY`` command.  With
+``--ValidMessagesToDatabase-copy-format binary`` as well, the rows are encoded
+in postgres' binary ``COPY`` format, so that the server does not have to parse
+csv text.  Alternatively, when the database runs on the same host as the
+pipeline, ``--ValidMessagesToDatabase-server-side`` has the server read each
+clean csv file itself with ``COPY ... FROM '<path>'``, which requires the
+database user to be allowed to read server files (e.g. a member of
+``pg_read_server_files``).
+
+Passing ``--presort`` as well as ``--with_db`` instead validates all the
+archives first, and then loads all their clean rows at once, sorted by MMSI
+and Time with :py:class:`LoadSortedAIS`.  If ``ais_clean`` was empty before
+the load, it is then already in the order of its clustering index, so
+:py:class:`ClusterAisClean` does not rewrite it.  Rows loaded into a table
+which already held some are still clustered, as is a table into which any
+rows have since been loaded unsorted, one csv file or archive at a time.  The
+rows are sorted in bounded memory, spilling sorted runs to ``tmp/sort``, which
+needs about as much free space as the clean csv files.
+
+By default each csv file is loaded by its own :py:class:`LoadCleanedAIS` task,
+with its own connection and transaction.  Passing
+``--WriteCsvToDb-per-archive`` instead loads all the csv files of an archive
+over one connection and in one transaction with
+:py:class:`LoadCleanedArchive`, which is much quicker for archives of many
+small files.
+
+Columnar output
+===============
+Without a database, the valid rows can instead be written to typed and
+compressed Parquet files in ``files/cleanparquet`` by passing
+``--ValidMessages-output-format parquet``, which requires ``pyarrow``.  See
+:py:mod:`superpyrate.columnar`.  The database is only loaded from clean csv
+files, so this cannot be used with ``--with_db`` unless the rows are copied
+straight into the database with ``--ValidMessagesToDatabase-direct-copy`` or
+``--ValidMessagesToDatabase-partitioned``.
+
+Compressed intermediate files
+=============================
+The csv files in ``files/unzipped``, ``files/cleancsv`` and ``files/dirtycsv``
+can be kept compressed with gzip by setting ``compression=gzip`` in the
+``[intermediates]`` section of the luigi configuration.  Every task then reads
+and writes these files through the codec, and archives which :py:mod:`zipfile`
+cannot extract are not supported.  See :py:mod:`superpyrate.intermediates`.
+Compressed clean csv files cannot be read by the server with
+``--ValidMessagesToDatabase-server-side``.
+
+Rejected rows
+=============
+Passing ``--ValidMessages-dirty`` also writes the rows which fail to convert
+or validate to a csv file in ``files/dirtycsv``, in the same pass as the
+valid rows are written.  Each row holds the fields which could be converted
+and a ``reason`` for its rejection, see
+:py:func:`~superpyrate.tasks.produce_valid_csv_file`.  When loading into the
+database, the rejected rows of each csv file are then copied into
+``ais_dirty`` by :py:class:`LoadDirtyAIS`, which adds the ``reason`` column
+to the table if it is missing.  Records which could not be read at all are
+only counted, see :py:mod:`superpyrate.stats`.
+
+Rebuilding
+==========
+To re-ingest everything from scratch, run :py:class:`RebuildAisClean` with
+``--folder-of-zips``.  The clean rows are loaded into an unlogged staging
+table with ``COPY ... FREEZE``, indexed once and swapped in place of
+``ais_clean`` in a single transaction, so readers use the old table until the
+rebuild commits.  With ``--presort`` the rows are loaded sorted by MMSI and
+Time, so the rebuilt table need not be clustered.
+
+Partitions
+==========
+``ais_clean`` may instead be partitioned by month of ``Time``, by setting up
+the database with ``python -m superpyrate.db_setup --partitioned`` and
+passing ``--ValidMessagesToDatabase-partitioned``.  The rows of each csv file
+are then routed into the partition of their month, which is created when
+first needed, and :py:class:`ClusterAisClean` clusters each partition in a
+task of its own, so partitions which are already clustered are not rewritten.
+Copying rows into a partition removes the marker of its clustering, so that
+it is clustered again.  See :py:mod:`superpyrate.partitions`.
+
+Already ingested content
+========================
+When loading into the database, the content of each archive and of each csv
+file within it is recorded in the ``ais_manifest`` table once loaded.
+Archives and csv files whose content is already in the manifest are skipped,
+even if they have been renamed or moved, or the working folder has changed.
+The content of a csv file is hashed as it is extracted, or as it is validated
+when streamed, and is recorded in the transaction which copies its rows, see
+:py:meth:`ValidMessagesToDatabase.load_once`.  See
+:py:mod:`superpyrate.manifest`.
+
+Database connections
+====================
+Each process keeps a pool of connections to the database, which the database
+tasks running in that process borrow from.  A task marks itself complete on
+the connection of its load, rather than borrowing another.  The size of the
+pool is set in the ``[postgres_pool]`` section of the luigi configuration,
+see :py:mod:`superpyrate.dbpool`.  The server's ``max_connections`` must
+allow for ``max_connections`` connections for each worker, and for the
+scheduling process.
+
+The pool reuses connections across the tasks of a run with a single worker.
+With ``--workers`` more than 1, luigi forks a process for each task, so its
+connections are not reused by the next task.  Run PgBouncer in front of the
+server, and point ``DBHOSTNAME`` and ``PGPORT`` at it, to pool the server
+connections of such runs.
+
+Indices
+=======
+The index over which ``ais_clean`` is clustered is built first by
+:py:class:`MakeClusteringIndex`, with a higher priority than any other build
+and all the memory and cores for building indices, and it is all that
+:py:class:`ClusterAisClean` waits for.  The remaining indices are built by
+:py:class:`MakeAllIndices` once the table has been clustered, as ``CLUSTER``
+rebuilds every index of the table.  They are all scheduled at once, and luigi
+runs as many at a time as it has workers free, each with its share of the
+memory and cores set in the ``[index_build]`` section of the luigi
+configuration, see :py:mod:`superpyrate.indexing`.  Each build takes one unit
+of the ``index_build`` resource, so setting ``index_build`` in the
+``[resources]`` section of the luigi configuration to the number of builds
+planned at once keeps more workers from oversubscribing the memory.
+
 Working folder
 ==============
 The working folder ``LUIGIWORK`` must contain two subfolders - files and tmp.
-The ``files`` subfolder contains the ``unzipped`` and ``cleancsv`` folders,
-with all of the respective temporary files stored within.
+The ``files`` subfolder contains the ``unzipped``, ``cleancsv``,
+``cleanparquet`` and ``dirtycsv`` folders, with all of the respective
+temporary files stored within.
 The ``tmp`` subfolder contains ``processcsv``, ``writecsv``, ``archives`` and ``database``
 folders and contains files which are generated by the tasks which do not produce
-an actual file as output, rather spawn child-tasks.
+an actual file as output, rather spawn child-tasks.  It also contains a
+``headers`` folder caching the columns found in each distinct csv header,
+a ``stats`` folder of the counts of the records of each validated csv file,
+a ``sort`` folder for the runs spilled when sorting the clean csv files, a
+``partitions`` folder for the rows of each month of a csv file as they are
+loaded into a partitioned table, and a ``hashes`` folder caching the hash of
+each archive and of the csv files within it.
 
 Environment Variables
 =====================
@@ -107,13 +322,42 @@ import luigi
 from luigi.contrib.external_program import ExternalProgramTask
 from luigi.postgres import CopyToTable, PostgresQuery
 from luigi import six
-from luigi.util import requires
-from superpyrate.tasks import produce_valid_csv_file
+from luigi.util import requires, inherits
+from superpyrate.tasks import produce_valid_csv_file, open_zip_member, \
+                              PARALLEL_THRESHOLD, \
+                              BoundedPipe, PipeWriterThread
+from superpyrate.pgcopy import get_column_types
+from superpyrate.dbpool import PooledConnectionMixin, get_pool
+from superpyrate.manifest import hash_archives, hash_files, \
+                                 read_member_hashes, save_member_hash, \
+                                 save_member_hashes, create_manifest_table, \
+                                 find_ingested, find_ingested_name, \
+                                 record_ingested
+from superpyrate.indexing import get_index_resources, plan_index_builds, \
+                                 order_indices
+from superpyrate.stats import ValidationCounts, MAX_EXAMPLES
+from superpyrate.intermediates import get_compression, find_intermediate, \
+                                      open_intermediate, is_compressed
+from superpyrate.extract import extract_archive, can_extract
+from superpyrate.planning import plan_archive, get_priority, \
+                                 makespan_report, save_timing, load_timing, \
+                                 get_batch_bytes, batch_members, plan_by_name
+from superpyrate.targets import ListedLocalTarget, add_file, forget_file
+from superpyrate.extsort import sort_csv_files, BUFFER_ROWS
+from superpyrate.partitions import PartitionRouter, create_partitions, \
+                                   partition_name, list_partitions, \
+                                   get_partition_index, is_partitioned
+from superpyrate.tables import check_replaceable, copy_grants, copy_indices
 from pyrate.repositories.aisdb import AISdb
 import csv
+import hashlib
+import json
 import psycopg2
+from psycopg2.extras import execute_values
 import logging
 import os
+import shutil
+import time
 LOGGER = logging.getLogger('luigi-interface')
 LOGGER.setLevel(logging.INFO)
 
@@ -130,9 +374,12 @@ def setup_working_folder():
     """
 
     working_folder = get_working_folder()
-    folder_structure = {'files': ['unzipped', 'cleancsv'],
-                        'tmp': ['processcsv', 'writecsv',
-                                'archives', 'database', 'countraw']}
+    folder_structure = {'files': ['unzipped', 'cleancsv', 'cleanparquet',
+                                  'dirtycsv'],
+                        'tmp': ['processcsv', 'writecsv', 'archives',
+                                'database', 'countraw', 'headers', 'stats',
+                                'sort', 'partitions', 'hashes', 'timings',
+                                'batches']}
     for folder, subfolders in folder_structure.items():
         [os.makedirs(os.path.join(working_folder, folder, subfolder),
                      exist_ok=True) for subfolder in subfolders]
@@ -176,6 +423,273 @@ def get_working_folder(folder_of_zips=None):
     return working_folder
 
 
+def connect_to_database():
+    """Borrows a connection to the database from the pool of this process
+
+    The connection is returned to the pool by ``connection.close()``
+    """
+    return get_pool(get_environment_variable('DBHOSTNAME'), None,
+                    get_environment_variable('DBNAME'),
+                    get_environment_variable('DBUSER'),
+                    get_environment_variable('DBUSERPASS')).getconn()
+
+
+def get_hash_folder():
+    """Returns the folder in which the hashes of archives and of their csv
+    files are kept
+
+    See :py:func:`superpyrate.manifest.hash_archive` and
+    :py:func:`superpyrate.manifest.read_member_hashes`
+    """
+    return os.path.join(get_working_folder(), 'tmp', 'hashes')
+
+
+def get_plan_folder():
+    """Returns the folder in which the plans of archives are kept
+
+    See :py:func:`superpyrate.planning.plan_archive`
+    """
+    return os.path.join(get_working_folder(), 'tmp', 'archives')
+
+
+def get_archive_plan(zip_file):
+    """Returns the csv files of an archive as read from its central directory
+
+    See :py:func:`superpyrate.planning.plan_archive`
+    """
+    return plan_archive(zip_file, get_plan_folder())
+
+
+def get_archive_priority(zip_file):
+    """Returns the priority of the tasks working on a whole archive
+
+    See :py:func:`superpyrate.planning.get_priority`
+    """
+    return get_priority(get_archive_plan(zip_file))
+
+
+def get_csv_member(csvfile, zip_file=''):
+    """Returns the entry of a csv file in the plan of its archive
+
+    Arguments
+    =========
+    csvfile : str
+        The path of the raw csv file
+    zip_file : str, default=''
+        The archive holding the csv file.  If not given, the sizes are those
+        of the csv file on disk, or 0 if it does not exist
+
+    Returns
+    =======
+    dict
+        See :py:mod:`superpyrate.planning`
+    """
+    name = os.path.basename(csvfile)
+    if zip_file:
+        member = plan_by_name(zip_file, get_plan_folder()).get(name)
+        if member is not None:
+            return member
+    path = find_intermediate(csvfile)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    return {'name': name, 'size': size, 'compressed_size': size}
+
+
+def get_csv_priority(csvfile, zip_file=''):
+    """Returns the priority of the tasks working on a csv file
+
+    See :py:func:`get_csv_member` and
+    :py:func:`superpyrate.planning.get_priority`
+    """
+    return get_priority([get_csv_member(csvfile, zip_file)])
+
+
+def get_archive_batches(zip_file):
+    """Returns the batches in which the csv files of an archive are validated
+
+    See :py:func:`superpyrate.planning.batch_members`
+
+    Returns
+    =======
+    list
+        The lists of the csv files of each batch, as in the plan of the
+        archive, or an empty list if the csv files are not batched
+    """
+    batch_bytes = get_batch_bytes()
+    if batch_bytes <= 0:
+        return []
+    return batch_members(get_archive_plan(zip_file), batch_bytes)
+
+
+def get_member_hashes(zip_file):
+    """Returns the hash of each csv file of an archive, by its file name
+
+    Only the hashes computed so far are returned, as the csv files were
+    extracted or streamed, so nothing is decompressed.  See
+    :py:func:`superpyrate.manifest.read_member_hashes`
+    """
+    return read_member_hashes(zip_file, get_hash_folder(),
+                              [member['name']
+                               for member in get_archive_plan(zip_file)])
+
+
+def get_csv_hash(csvfile, zip_file=''):
+    """Returns the hash of a csv file of an archive, or '' if it is not known
+
+    See :py:func:`get_member_hashes`
+
+    Arguments
+    =========
+    csvfile : str
+        The path of the raw csv file
+    zip_file : str, default=''
+        The archive holding the csv file
+    """
+    if not zip_file:
+        return ''
+    name = os.path.basename(csvfile)
+    return read_member_hashes(zip_file, get_hash_folder(),
+                              [name]).get(name, '')
+
+
+def get_unzipped_folder(zip_file):
+    """Returns the folder into which a zipped archive is extracted
+
+    Arguments
+    =========
+    zip_file : str
+        The file path of the zipped archive
+
+    Returns
+    =======
+    str
+        The path of a folder of the same name as the archive in the
+        subdirectory ``files/unzipped`` of ``LUIGIWORK``
+    """
+    out_root_dir = os.path.splitext(zip_file)[0]
+    _, out_folder_name = os.path.split(out_root_dir)
+    rootdir = get_working_folder()
+    return os.path.join(rootdir, 'files', 'unzipped', out_folder_name)
+
+
+def get_stats_file(csvfile):
+    """Returns the file of counts saved when a csv file is validated
+
+    Arguments
+    =========
+    csvfile : str
+        The path of the raw csv file
+
+    Returns
+    =======
+    str
+        The path of a json file named as the csv file in the subdirectory
+        ``tmp/stats`` of ``LUIGIWORK``
+    """
+    name = os.path.basename(csvfile)
+    return os.path.join(get_working_folder(), 'tmp', 'stats', name + '.json')
+
+
+def get_timing_file(csvfile):
+    """Returns the file in which the time taken to validate a csv file is kept
+
+    Arguments
+    =========
+    csvfile : str
+        The path of the raw csv file
+
+    Returns
+    =======
+    str
+        The path of a json file named as the csv file in the subdirectory
+        ``tmp/timings`` of ``LUIGIWORK``
+    """
+    name = os.path.basename(csvfile)
+    return os.path.join(get_working_folder(), 'tmp', 'timings', name + '.json')
+
+
+def get_load_order_file(table):
+    """Returns the file which records that a table was loaded in order
+
+    The file exists while all the rows of the table were loaded sorted by
+    MMSI and Time, so that :py:class:`ClusterAisClean` need not rewrite it.
+    See :py:func:`mark_loaded_in_order`
+
+    Arguments
+    =========
+    table : str
+
+    Returns
+    =======
+    str
+        The path of a file in the subdirectory ``tmp/database`` of
+        ``LUIGIWORK``
+    """
+    return os.path.join(get_working_folder(), 'tmp', 'database',
+                        '{}_in_order.txt'.format(table))
+
+
+def mark_loaded_in_order(table, in_order):
+    """Records whether all the rows of a table were loaded in order
+
+    Arguments
+    =========
+    table : str
+    in_order : bool
+        Whether the table was loaded sorted by MMSI and Time, and held no
+        other rows
+    """
+    path = get_load_order_file(table)
+    if in_order:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as order_file:
+            order_file.write(table)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def get_dirty_file(csvfile):
+    """Returns the file of the rows rejected when a csv file is validated
+
+    Arguments
+    =========
+    csvfile : str
+        The path of the raw csv file
+
+    Returns
+    =======
+    str
+        The path of a csv file named as the raw csv file in the subdirectory
+        ``files/dirtycsv`` of ``LUIGIWORK``, compressed as by
+        :py:func:`~superpyrate.intermediates.find_intermediate`
+    """
+    name = os.path.basename(csvfile)
+    return find_intermediate(os.path.join(get_working_folder(), 'files',
+                                          'dirtycsv', name))
+
+
+def list_csv_files(zip_file):
+    """Lists the csv files held in a zipped archive
+
+    The names are those in the plan of the archive, read from its central
+    directory, so the archive need not have been extracted yet.  The paths
+    are the same whether or not the csv files are streamed from the archive
+
+    Arguments
+    =========
+    zip_file : str
+        The file path of the zipped archive
+
+    Returns
+    =======
+    list
+        The paths of the csv files in the folder the archive is (or would be)
+        extracted into, without the extension of any compression
+    """
+    unzipped_folder = get_unzipped_folder(zip_file)
+    return [os.path.join(unzipped_folder, member['name'])
+            for member in get_archive_plan(zip_file)]
+
+
 class GetZipArchive(luigi.ExternalTask):
     """Returns a zipped archive as a luigi.file.LocalTarget
     """
@@ -202,6 +716,13 @@ class UnzippedArchive(ExternalProgramTask):
     """Unzips the zipped archive into a folder of AIS csv format files the same
     name as the original file
 
+    The members are extracted in this process on a pool of threads by
+    :py:func:`~superpyrate.extract.extract_archive`, which checks their
+    CRC-32 and keeps their SHA-256 for the manifest of ingested content.
+    Archives using a compression method which :py:mod:`zipfile` does
+    not support are extracted by ``7za`` instead, and the extracted files are
+    then hashed while they are likely still in the page cache.
+
     Arguments
     =========
     zip_file : str
@@ -210,6 +731,10 @@ class UnzippedArchive(ExternalProgramTask):
     """
     zip_file = luigi.Parameter(description='The file path of the archive to unzip')
 
+    @property
+    def priority(self):
+        return get_archive_priority(self.zip_file)
+
     def requires(self):
         return GetZipArchive(self.zip_file)
 
@@ -231,40 +756,71 @@ class UnzippedArchive(ExternalProgramTask):
                                                   output_folder))
         return ['7za', 'e' , self.input().fn, '-o{}'.format(output_folder), '-y']
 
+    def run(self):
+        if can_extract(self.input().fn):
+            LOGGER.info('Unzipping {0} to {1}'.format(self.input().fn,
+                                                      self.output().fn))
+            extract_archive(self.input().fn, self.output().fn,
+                            compression=get_compression(),
+                            cache_folder=get_hash_folder())
+        elif get_compression():
+            raise ValueError("{} cannot be extracted into compressed "
+                             "files".format(self.input().fn))
+        else:
+            super().run()
+            names = [member['name']
+                     for member in get_archive_plan(self.input().fn)]
+            paths = [os.path.join(self.output().fn, name) for name in names]
+            save_member_hashes(self.input().fn, get_hash_folder(),
+                               dict(zip(names, hash_files(paths))))
+        add_file(self.output().fn)
+
     def output(self):
         """Outputs the files into a folder of the same name as the zip file
 
         The files are placed in a subdirectory of ``LUIGIWORK`` called ``files/unzipped``
         """
-        out_root_dir = os.path.splitext(self.input().fn)[0]
-        _, out_folder_name = os.path.split(out_root_dir)
-        rootdir = get_working_folder()
-        output_folder = os.path.join(rootdir,'files', 'unzipped', out_folder_name)
+        output_folder = get_unzipped_folder(self.input().fn)
         # LOGGER.debug("Unzipped {}".format(output_folder))
-        return luigi.file.LocalTarget(output_folder)
+        return ListedLocalTarget(output_folder)
 
 
 class ProcessCsv(luigi.Task):
-    """
+    """Validates all the csv files of an archive
 
-    Yields
-    ======
-    `ValidMessages`
+    The csv files are those of the plan of the archive, see
+    :py:func:`get_archive_plan`, so the tasks are known before the archive is
+    extracted
+
+    Parameters
+    ==========
+    stream : bool
+        Read the csv files directly from the zipped archive rather than
+        extracting it first
+
+    Requires
+    ========
+    `ValidMessages`, or `ValidateBatch` if the csv files are batched
     """
     zip_file = luigi.Parameter()
+    stream = luigi.BoolParameter(significant=False)
+
+    @property
+    def priority(self):
+        return get_archive_priority(self.zip_file)
 
     def requires(self):
-        return UnzippedArchive(self.zip_file)
+        batches = get_archive_batches(self.zip_file)
+        if batches:
+            return [ValidateBatch(self.zip_file, index, self.stream)
+                    for index in range(len(batches))]
+        zip_file = self.zip_file if self.stream else ''
+        return [ValidMessages(csvfilepath, zip_file, archive=self.zip_file)
+                for csvfilepath in list_csv_files(self.zip_file)]
 
     def run(self):
-        list_of_csvpaths = []
-        LOGGER.debug("Processing csvs from {}".format(self.input().fn))
-        for csvfile in os.listdir(self.input().fn):
-            if os.path.splitext(csvfile)[1] == '.csv':
-                list_of_csvpaths.append(os.path.join(self.input().fn, csvfile))
-
-        yield [ValidMessages(csvfilepath) for csvfilepath in list_of_csvpaths]
-
+        LOGGER.debug("Processed csvs from {}".format(self.zip_file))
+        list_of_csvpaths = list_csv_files(self.zip_file)
         with self.output().open('w') as outfile:
             outfile.write("\n".join(list_of_csvpaths))
 
@@ -278,57 +834,339 @@ class ProcessCsv(luigi.Task):
         name = os.path.splitext(filename)[0]
         rootdir = get_working_folder()
         path = os.path.join(rootdir, 'tmp','processcsv', name)
-        return luigi.file.LocalTarget(path)
+        return ListedLocalTarget(path)
 
 
 class GetCsvFile(luigi.ExternalTask):
+    """A raw csv file, which may be compressed
     """
+    csvfile = luigi.Parameter()
+
+    def output(self):
+        return ListedLocalTarget(find_intermediate(self.csvfile))
+
+
+def get_clean_csv_file(csvfile, zip_file=''):
+    """Returns the clean csv file written by :py:class:`ValidMessages`
+
+    Raises
+    ======
+    ValueError
+        If :py:class:`ValidMessages` writes parquet rather than csv files,
+        which cannot be copied into the database
+    """
+    validator = ValidMessages(csvfile, zip_file)
+    if validator.output_format != 'csv':
+        raise ValueError("Only clean csv files can be loaded into the "
+                         "database, but ValidMessages writes {} "
+                         "files".format(validator.output_format))
+    return validator.output()
+
+
+class GetDirtyCsvFile(luigi.ExternalTask):
+    """The rows rejected when a csv file was validated by
+    :py:class:`ValidMessages`
     """
     csvfile = luigi.Parameter()
 
     def output(self):
-        return luigi.file.LocalTarget(self.csvfile)
+        return ListedLocalTarget(get_dirty_file(self.csvfile))
 
 
 class ValidMessages(luigi.Task):
     """ Takes AIS messages and runs validation functions, generating valid csv
     files in folder called 'cleancsv' at the same level as unzipped_ais_path
+
+    The counts of the records read, rejected and written are saved to
+    ``tmp/stats``, see :py:func:`get_stats_file`.  A csv file streamed from
+    its archive is hashed as it is read, for the manifest of ingested content,
+    see :py:func:`get_csv_hash`
+
+    Parameters
+    ==========
+    csvfile : str
+        The raw csvfile containing AIS data
+    zip_file : str, default=''
+        If given, ``csvfile`` is read directly out of this zipped archive
+        instead of from disk
+    archive : str, default=''
+        The archive which ``csvfile`` is extracted from, if the task is
+        planned before the archive is extracted.  The task then requires
+        :py:class:`UnzippedArchive`
+    engine : str, default='row'
+        The validation engine passed to
+        :py:func:`~superpyrate.tasks.produce_valid_csv_file`, usually set in
+        the ``[ValidMessages]`` section of the luigi configuration
+    processes : int, default=1
+        The number of processes used to validate csv files larger than
+        ``parallel_threshold`` bytes, with 0 using all cores.  The default
+        of 1 turns off parallel validation, as each of the ``--workers`` of
+        luigi would otherwise start a process on every core.  Files streamed
+        from an archive are always validated in a single process
+    parallel_threshold : int, default=PARALLEL_THRESHOLD
+    max_examples : int, default=MAX_EXAMPLES
+        The number of rejected records logged for each category of error in
+        a csv file, see :py:mod:`superpyrate.stats`
+    dirty : bool
+        Also write the rejected rows to ``files/dirtycsv``, see
+        :py:func:`get_dirty_file`, usually set with ``--ValidMessages-dirty``
+    output_format : str, default='csv'
+        ``'parquet'`` writes the valid rows to a Parquet file in
+        ``files/cleanparquet`` rather than to a csv file, see
+        :py:mod:`superpyrate.columnar`
     """
     csvfile = luigi.Parameter()
+    zip_file = luigi.Parameter(default='', significant=False)
+    archive = luigi.Parameter(default='', significant=False)
+    engine = luigi.Parameter(default='row', significant=False)
+    processes = luigi.IntParameter(default=1, significant=False)
+    parallel_threshold = luigi.IntParameter(default=PARALLEL_THRESHOLD,
+                                            significant=False)
+    max_examples = luigi.IntParameter(default=MAX_EXAMPLES, significant=False)
+    dirty = luigi.BoolParameter(significant=False)
+    output_format = luigi.Parameter(default='csv', significant=False)
+
+    @property
+    def priority(self):
+        return get_csv_priority(self.csvfile, self.zip_file or self.archive)
 
     def requires(self):
+        if self.zip_file:
+            return GetZipArchive(self.zip_file)
+        if self.archive:
+            return UnzippedArchive(self.archive)
         return GetCsvFile(self.csvfile)
 
     def run(self):
-        LOGGER.debug("Processing {}.  Output to: {}".format(self.input().fn, self.output().fn))
-        infile = self.input().fn
-        outfile = self.output().fn
-        produce_valid_csv_file(infile, outfile)
+        LOGGER.debug("Processing {}.  Output to: {}".format(
+            self.csvfile, self.output().fn))
+        self.validate_to(self.output().fn, output_format=self.output_format)
+        add_file(self.output().fn)
+
+    def validate_to(self, outfile, column_types=None, encoding='utf-8',
+                    output_format='csv'):
+        """Validates the raw csv file, writing the valid rows to ``outfile``
+
+        The time taken is saved to ``tmp/timings``, see
+        :py:func:`get_timing_file`, whether the rows are written to a clean
+        csv file or copied straight into the database
+
+        Arguments
+        =========
+        outfile : str or file object
+            A file path or an open text file object
+        column_types : list, default=None
+            If given, the rows are written in postgres' binary ``COPY``
+            format to ``outfile``, which must then be a binary file object
+        encoding : str, default='utf-8'
+            The encoding of text in the binary ``COPY`` format
+        output_format : str, default='csv'
+            ``'csv'`` or ``'parquet'``
+        """
+        start = time.time()
+        stats_file = get_stats_file(self.csvfile)
+        dirty_file = get_dirty_file(self.csvfile) if self.dirty else None
+        if self.zip_file:
+            member = get_csv_member(self.csvfile, self.zip_file)
+            digest = hashlib.sha256()
+            with open_zip_member(self.zip_file, member['member'],
+                                 digest) as infile:
+                produce_valid_csv_file(infile, outfile, self.engine,
+                                       column_types=column_types,
+                                       encoding=encoding,
+                                       stats_file=stats_file,
+                                       max_examples=self.max_examples,
+                                       dirty_file=dirty_file,
+                                       output_format=output_format)
+            save_member_hash(self.zip_file, get_hash_folder(), member['name'],
+                             'sha256:' + digest.hexdigest())
+        else:
+            infile = find_intermediate(self.csvfile)
+            produce_valid_csv_file(infile, outfile, self.engine,
+                                   processes=self.processes,
+                                   parallel_threshold=self.parallel_threshold,
+                                   column_types=column_types,
+                                   encoding=encoding,
+                                   stats_file=stats_file,
+                                   max_examples=self.max_examples,
+                                   dirty_file=dirty_file,
+                                   output_format=output_format)
+        if dirty_file:
+            add_file(dirty_file)
+        member = get_csv_member(self.csvfile, self.zip_file or self.archive)
+        save_timing(get_timing_file(self.csvfile), member['size'], start,
+                    time.time())
 
     def output(self):
         """Validated files are named as the original csv file
 
         The files are placed in a subdirectory of ``LUIGIWORK`` called
-        ``files/cleancsv``
+        ``files/cleancsv``, compressed as by
+        :py:func:`~superpyrate.intermediates.find_intermediate`, or in
+        ``files/cleanparquet`` with the extension ``.parquet`` if the output
+        format is parquet
         """
-        name = os.path.basename(self.input().fn)
+        name = os.path.basename(self.csvfile)
         rootdir = get_working_folder()
-        path = os.path.join(rootdir, 'files','cleancsv', name)
+        if self.output_format == 'parquet':
+            name = os.path.splitext(name)[0] + '.parquet'
+            path = os.path.join(rootdir, 'files', 'cleanparquet', name)
+        else:
+            path = find_intermediate(os.path.join(rootdir, 'files','cleancsv',
+                                                  name))
         clean_file_out = os.path.join(path)
         LOGGER.info("Clean file saved to {}".format(clean_file_out))
-        return luigi.file.LocalTarget(clean_file_out)
+        return ListedLocalTarget(clean_file_out)
+
+
+class ValidateBatch(luigi.Task):
+    """Validates a batch of the csv files of an archive in a single task
+
+    With hundreds of thousands of small csv files, scheduling a task for each
+    takes longer than validating them, so the files are instead grouped into
+    batches of up to ``batch_bytes``, see :py:func:`get_archive_batches`.  The
+    :py:class:`ValidMessages` of each file in the batch is run in this process,
+    skipping those already complete, so the files have the same outputs as
+    when validated by their own tasks.
+
+    The outcome of each file is written to the output of the task, a json file
+    in ``tmp/batches``.  If any file fails, its partial output is removed, the
+    outcomes are written to a file with the extension ``.failed.json`` instead,
+    and the task fails once the rest of the batch is validated.  Running it
+    again validates only the files which failed.
+
+    Parameters
+    ==========
+    zip_file : str
+        The file path of the archive
+    index : int
+        The index of the batch among those of the archive
+    stream : bool
+        Read the csv files directly from the zipped archive rather than
+        extracting it first
+    """
+    zip_file = luigi.Parameter()
+    index = luigi.IntParameter()
+    stream = luigi.BoolParameter(significant=False)
+
+    @property
+    def priority(self):
+        return get_priority(self.members())
+
+    def members(self):
+        """Returns the csv files of the batch, as in the plan of the archive
+        """
+        return get_archive_batches(self.zip_file)[self.index]
 
+    def validators(self):
+        """Returns the :py:class:`ValidMessages` of each csv file of the batch
+        """
+        folder = get_unzipped_folder(self.zip_file)
+        zip_file = self.zip_file if self.stream else ''
+        return [ValidMessages(os.path.join(folder, member['name']), zip_file,
+                              archive=self.zip_file)
+                for member in self.members()]
+
+    def requires(self):
+        if self.stream:
+            return GetZipArchive(self.zip_file)
+        return UnzippedArchive(self.zip_file)
 
-class ValidMessagesToDatabase(CopyToTable):
+    def run(self):
+        outcomes = {}
+        failed = []
+        for validator in self.validators():
+            name = os.path.basename(validator.csvfile)
+            if validator.complete():
+                outcomes[name] = {'status': 'complete'}
+                continue
+            start = time.time()
+            try:
+                validator.run()
+            except Exception as error:
+                LOGGER.exception("Failed to validate {}".format(
+                    validator.csvfile))
+                output_file = validator.output().fn
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                forget_file(output_file)
+                outcomes[name] = {'status': 'failed', 'error': repr(error)}
+                failed.append(name)
+            else:
+                counts = ValidationCounts.load(
+                    get_stats_file(validator.csvfile))
+                outcomes[name] = {'status': 'validated',
+                                  'seconds': time.time() - start,
+                                  'counts': counts.as_dict()}
+
+        failed_file = os.path.splitext(self.output().fn)[0] + '.failed.json'
+        if failed:
+            os.makedirs(os.path.dirname(failed_file), exist_ok=True)
+            with open(failed_file, 'w') as outfile:
+                json.dump(outcomes, outfile, indent=1)
+            raise RuntimeError("{} of the {} csv files of batch {} of {} "
+                               "failed: {}".format(len(failed), len(outcomes),
+                                                   self.index, self.zip_file,
+                                                   ", ".join(failed)))
+        if os.path.exists(failed_file):
+            os.remove(failed_file)
+            forget_file(failed_file)
+        with self.output().open('w') as outfile:
+            json.dump(outcomes, outfile, indent=1)
+
+    def output(self):
+        """The outcomes are written to a json file named by the index of the
+        batch in a folder of the same name as the zip file
+
+        The files are placed in a subdirectory of ``LUIGIWORK`` called
+        ``tmp/batches``
+        """
+        filename = os.path.split(self.zip_file)[1]
+        name = os.path.splitext(filename)[0]
+        rootdir = get_working_folder()
+        path = os.path.join(rootdir, 'tmp', 'batches', name,
+                            '{}.json'.format(self.index))
+        return ListedLocalTarget(path)
+
+
+class ValidMessagesToDatabase(PooledConnectionMixin, CopyToTable):
     """Writes the valid csv files to the postgres database
 
     Parameters
     ==========
     original_csvfile : luigi.Parameter
         The raw csvfile containing AIS data
+    zip_file : luigi.Parameter, default=''
+        The zipped archive to stream ``original_csvfile`` from, if any
+    archive : luigi.Parameter, default=''
+        The archive which ``original_csvfile`` is extracted from, as for
+        :py:class:`ValidMessages`
+    direct_copy : luigi.BoolParameter
+        Validate the raw csv file straight into the ``COPY`` stream through
+        a bounded in-memory buffer, rather than copying from a clean csv file
+        written by :py:class:`ValidMessages`.  Usually set with
+        ``--ValidMessagesToDatabase-direct-copy`` or in the luigi configuration
+    copy_format : luigi.Parameter, default='csv'
+        ``'binary'`` sends the rows in postgres' binary ``COPY`` format, which
+        is only possible together with ``direct_copy``
+    server_side : luigi.BoolParameter
+        Have the database server read the clean csv file itself, for when it
+        runs on the same host.  Cannot be used with ``direct_copy``
+    partitioned : luigi.BoolParameter
+        Validate the rows of each month into a file of their own in
+        ``tmp/partitions``, and copy each into its monthly partition of the
+        table, see :py:mod:`superpyrate.partitions`.  The partitions copied
+        into are clustered again by the next :py:class:`ClusterAisClean`.
+        Cannot be used with the other options
     """
 
     original_csvfile = luigi.Parameter()
+    zip_file = luigi.Parameter(default='', significant=False)
+    archive = luigi.Parameter(default='', significant=False)
+    direct_copy = luigi.BoolParameter(significant=False)
+    copy_format = luigi.Parameter(default='csv', significant=False)
+    server_side = luigi.BoolParameter(significant=False)
+    partitioned = luigi.BoolParameter(significant=False)
 
     # resources = {'postgres': 1}
 
@@ -348,8 +1186,21 @@ class ValidMessagesToDatabase(CopyToTable):
     columns = [x.lower() for x in cols]
     # LOGGER.debug("Columns: {}".format(columns))
 
+    @property
+    def priority(self):
+        return self.validator().priority
+
     def requires(self):
-        return ValidMessages(self.original_csvfile)
+        validator = self.validator()
+        if self.direct_copy or self.partitioned:
+            return validator.requires()
+        return validator
+
+    def validator(self):
+        """Returns the :py:class:`ValidMessages` of the raw csv file
+        """
+        return ValidMessages(self.original_csvfile, self.zip_file,
+                             archive=self.archive)
 
     def rows(self):
         """Return/yield tuples or lists corresponding to each row to be inserted.
@@ -358,24 +1209,148 @@ class ValidMessagesToDatabase(CopyToTable):
         ======
         row : iterable
         """
-        with self.input().open('r') as csvfile:
+        with open_intermediate(self.input().fn) as csvfile:
             reader = csv.reader(csvfile)
             for row in reader:
                 yield row
                 # LOGGER.debug(line)
                 # yield [x for x in line.strip('\n').split(',') ]
 
-    def copy(self, cursor, clean_file):
+    def column_names(self):
         if isinstance(self.columns[0], six.string_types):
             column_names = self.columns
         elif len(self.columns[0]) == 2:
             column_names = [c[0] for c in self.columns]
         else:
             raise Exception('columns must consist of column strings or (column string, type string) tuples (was %r ...)' % (self.columns[0],))
+        return column_names
+
+    def copy(self, cursor, clean_file):
+        """Copies from an open file, or has the server read a file path
+        """
+        column_names = self.column_names()
         LOGGER.debug(column_names)
-        sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, HEADER true)".format(self.table, ",".join(column_names), clean_file)
+        if self.copy_format == 'binary':
+            options = "FORMAT binary"
+        else:
+            options = "FORMAT csv, HEADER true"
         LOGGER.debug("File: {}".format(clean_file))
-        cursor.copy_expert(sql, clean_file)
+        if isinstance(clean_file, str):
+            sql = "COPY {} ({}) FROM %s WITH ({})".format(
+                self.table, ",".join(column_names), options)
+            cursor.execute(sql, (clean_file,))
+        else:
+            sql = "COPY {} ({}) FROM STDIN WITH ({})".format(
+                self.table, ",".join(column_names), options)
+            cursor.copy_expert(sql, clean_file)
+
+    def copy_with_retry(self, connection, csvfile):
+        """Copies the csv file, creating the table if it does not exist
+        """
+        for attempt in range(2):
+            try:
+                cursor = connection.cursor()
+                # self.init_copy(connection)
+                self.copy(cursor, csvfile)
+                # self.post_copy(connection)
+            except psycopg2.ProgrammingError as e:
+                if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE and \
+                        attempt == 0:
+                    # if first attempt fails with "relation not found", try
+                    # creating table
+                    LOGGER.info("Creating table %s", self.table)
+                    connection.reset()
+                    self.create_table(connection)
+                else:
+                    raise
+            else:
+                break
+
+    def copy_validated(self, connection):
+        """Validates the raw csv file in a thread, copying the rows as they
+        come
+
+        The rows pass through a :py:class:`~superpyrate.tasks.BoundedPipe`,
+        so no clean csv file is written.  If validation fails, the error is
+        raised before the transaction is committed.
+        """
+        validator = self.validator()
+        if self.copy_format == 'binary':
+            column_types = get_column_types(connection.cursor(), self.table,
+                                            self.column_names())
+            encoding = psycopg2.extensions.encodings[connection.encoding]
+            pipe = BoundedPipe(binary=True)
+            writer = PipeWriterThread(
+                lambda pipe: validator.validate_to(pipe, column_types,
+                                                   encoding), pipe)
+        else:
+            pipe = BoundedPipe()
+            writer = PipeWriterThread(validator.validate_to, pipe)
+        writer.start()
+        try:
+            self.copy_with_retry(connection, pipe)
+        finally:
+            pipe.abort()
+            writer.join()
+        if writer.error is not None:
+            raise writer.error
+
+    def copy_partitioned(self, connection):
+        """Validates the raw csv file into a file for each month, and copies
+        each into its partition, creating those which do not exist
+        """
+        folder = os.path.join(get_working_folder(), 'tmp', 'partitions',
+                              os.path.basename(self.original_csvfile))
+        os.makedirs(folder, exist_ok=True)
+        try:
+            router = PartitionRouter(folder, self.table)
+            try:
+                self.validator().validate_to(router)
+            finally:
+                router.close()
+            partitions = router.partitions()
+
+            partition_connection = self.output().connect()
+            try:
+                create_partitions(partition_connection, self.table, partitions)
+            finally:
+                partition_connection.close()
+
+            sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)"
+            names = []
+            with connection.cursor() as cursor:
+                for (year, month), path in sorted(partitions.items()):
+                    partition = partition_name(self.table, year, month)
+                    LOGGER.debug("Copying {} into {}".format(path, partition))
+                    with open(path, 'r', newline='') as partition_file:
+                        cursor.copy_expert(
+                            sql.format(partition,
+                                       ",".join(self.column_names())),
+                            partition_file)
+                    names.append(partition)
+            self.forget_clustered(connection, names)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def forget_clustered(self, connection, partitions):
+        """Removes the markers of the partitions clustered by
+        :py:class:`ClusterAisClean`, in the transaction of the copy, so that
+        partitions which have been given more rows are clustered again
+
+        Arguments
+        =========
+        connection : psycopg2.extensions.connection
+        partitions : list
+            The names of the partitions
+        """
+        marker_table = self.output().marker_table
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s);", (marker_table,))
+            if cursor.fetchone()[0] is None:
+                return
+            cursor.execute("DELETE FROM {} WHERE update_id = ANY(%s);".format(
+                marker_table), ([get_cluster_update_id(partition)
+                                 for partition in partitions],))
 
     def run(self):
         """Inserts data generated by rows() into target table.
@@ -389,41 +1364,115 @@ class ValidMessagesToDatabase(CopyToTable):
             raise Exception("table and columns need to be specified")
 
         connection = self.output().connect()
-
-        with self.input().open('r') as csvfile:
-            for attempt in range(2):
-                try:
-                    cursor = connection.cursor()
-                    # self.init_copy(connection)
-                    self.copy(cursor, csvfile)
-                    # self.post_copy(connection)
-                except psycopg2.ProgrammingError as e:
-                    if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE and attempt == 0:
-                        # if first attempt fails with "relation not found", try creating table
-                        LOGGER.info("Creating table %s", self.table)
-                        connection.reset()
-                        self.create_table(connection)
-                    else:
-                        raise
-                else:
-                    break
-
-        # mark as complete in same transaction
-        self.output().touch(connection)
-        # commit and clean up
-        connection.commit()
-        connection.close()
+        try:
+            self.load_once(connection)
+
+            # mark as complete in same transaction
+            self.output().touch(connection)
+            connection.commit()
+        finally:
+            # an uncommitted load is rolled back as the connection is returned
+            # to the pool
+            connection.close()
+
+    def load_once(self, connection):
+        """Copies the valid rows into the table without committing, unless
+        their content is already in the database
+
+        The content of the raw csv file is added to the manifest of
+        :py:mod:`superpyrate.manifest` in the same transaction as its rows.
+        Its hash is only known once the file has been read, so if the content
+        turns out to be in the manifest already, such as from a copy of the
+        file in another archive, the rows are rolled back to a savepoint.
+
+        The rows are not sorted, so the record that the table was loaded in
+        order is removed first, see :py:func:`mark_loaded_in_order`.  Should
+        the load then fail, the table is merely clustered when it need not
+        have been.
+
+        Arguments
+        =========
+        connection : psycopg2.extensions.connection
+
+        Returns
+        =======
+        bool
+            Whether the rows were copied
+        """
+        mark_loaded_in_order(self.table, False)
+        with connection.cursor() as cursor:
+            cursor.execute("SAVEPOINT load_once;")
+        self.load(connection)
+        content_hash = get_csv_hash(self.original_csvfile,
+                                    self.zip_file or self.archive)
+        if not content_hash:
+            return True
+        name = os.path.basename(self.original_csvfile)
+        with connection.cursor() as cursor:
+            create_manifest_table(cursor)
+            if record_ingested(cursor, [(content_hash, 'member', name)]):
+                return True
+            cursor.execute("ROLLBACK TO SAVEPOINT load_once;")
+        LOGGER.info("Skipping {}, whose content is already loaded".format(
+            self.original_csvfile))
+        return False
+
+    def load(self, connection):
+        """Copies the valid rows into the table without committing
+
+        Arguments
+        =========
+        connection : psycopg2.extensions.connection
+        """
+        if self.copy_format not in ('csv', 'binary'):
+            raise ValueError("Unknown copy format: {}".format(
+                self.copy_format))
+        if self.copy_format == 'binary' and not self.direct_copy:
+            raise ValueError("The binary copy format requires direct_copy")
+        if self.server_side and self.direct_copy:
+            raise ValueError("server_side cannot be used with direct_copy")
+        if self.partitioned and (self.direct_copy or self.server_side or
+                                 self.copy_format != 'csv'):
+            raise ValueError("partitioned cannot be used with direct_copy, "
+                             "server_side or the binary copy format")
+
+        if self.partitioned:
+            self.copy_partitioned(connection)
+        elif self.direct_copy:
+            self.copy_validated(connection)
+        else:
+            clean_file = get_clean_csv_file(self.original_csvfile,
+                                            self.zip_file)
+            if self.server_side:
+                if is_compressed(clean_file.fn):
+                    raise ValueError("server_side cannot read the compressed "
+                                     "file {}".format(clean_file.fn))
+                self.copy_with_retry(connection,
+                                     os.path.abspath(clean_file.fn))
+            else:
+                with open_intermediate(clean_file.fn) as csvfile:
+                    self.copy_with_retry(connection, csvfile)
 
 
-class LoadCleanedAIS(CopyToTable):
+class LoadCleanedAIS(PooledConnectionMixin, CopyToTable):
     """Update ``ais_sources`` table with name of CSV file processed
 
     After the valid csv files are successfully written to the database,
     this function updates the ``sources`` table with the name of the file
-    which has been written
+    which has been written.  No row is added for a file which
+    :py:class:`ValidMessagesToDatabase` skipped, as its content was already
+    loaded under another name, see :py:mod:`superpyrate.manifest`
+
+    Parameters
+    ==========
+    archive : str, default=''
+        The archive which ``csvfile`` is extracted from, as for
+        :py:class:`ValidMessages`
     """
 
     csvfile = luigi.Parameter()
+    zip_file = luigi.Parameter(default='', significant=False)
+    archive = luigi.Parameter(default='', significant=False)
 
     # resources = {'postgres': 1}
 
@@ -437,24 +1486,27 @@ class LoadCleanedAIS(CopyToTable):
     table = "ais_sources"
 
     def requires(self):
-        return ValidMessagesToDatabase(self.csvfile)
+        return ValidMessagesToDatabase(self.csvfile, self.zip_file,
+                                       archive=self.archive)
 
     def run(self):
         # Prepare source data to add to ais_sources
-        source_data = {'filename': os.path.basename(self.csvfile),
-                       'ext': os.path.splitext(self.csvfile)[1],
-                       'invalid': 0,
-                       'clean': 0,
-                       'dirty': 0,
-                       'source': 0}
+        source_data = get_source_data(self.csvfile)
 
         columns = '(' + ','.join([c.lower() for c in source_data.keys()]) + ')'
 
         connection = self.output().connect()
         cursor = connection.cursor()
         with cursor:
-            tuplestr = "(" + ",".join("%({})s".format(i) for i in source_data.keys()) + ")"
-            cursor.execute("INSERT INTO " + self.table + " "+ columns + " VALUES "+ tuplestr, source_data)
+            if self.loaded_as_other_file(cursor, source_data['filename']):
+                LOGGER.info("Not adding {} to {}, whose content was loaded "
+                            "from another file".format(self.csvfile,
+                                                       self.table))
+            else:
+                tuplestr = "(" + ",".join("%({})s".format(i)
+                                          for i in source_data.keys()) + ")"
+                cursor.execute("INSERT INTO " + self.table + " " + columns +
+                               " VALUES " + tuplestr, source_data)
 
         # mark as complete
         self.output().touch(connection)
@@ -463,18 +1515,512 @@ class LoadCleanedAIS(CopyToTable):
         connection.commit()
         connection.close()
 
+    def loaded_as_other_file(self, cursor, filename):
+        """Returns whether the content of the csv file is in the manifest
+        under the name of another file
+        """
+        content_hash = get_csv_hash(self.csvfile,
+                                    self.zip_file or self.archive)
+        if not content_hash:
+            return False
+        create_manifest_table(cursor)
+        name = find_ingested_name(cursor, content_hash)
+        return name is not None and name != filename
+
+
+def get_source_data(csvfile):
+    """Returns the row of the ``ais_sources`` table for a csv file
+
+    Arguments
+    =========
+    csvfile : str
+        The path of the raw csv file
+
+    The counts of invalid, dirty and clean rows are those saved by
+    :py:class:`ValidMessages`
+
+    Returns
+    =======
+    dict
+    """
+    stats_file = get_stats_file(csvfile)
+    if os.path.exists(stats_file):
+        counts = ValidationCounts.load(stats_file)
+    else:
+        LOGGER.warning("No counts were saved when validating {}".format(
+            csvfile))
+        counts = ValidationCounts()
+    return {'filename': os.path.basename(csvfile),
+            'ext': os.path.splitext(csvfile)[1],
+            'invalid': counts.invalid,
+            'clean': counts.clean,
+            'dirty': counts.dirty,
+            'source': 0}
+
+
+class LoadDirtyAIS(PooledConnectionMixin, CopyToTable):
+    """Copies the rows rejected when a csv file was validated into
+    ``ais_dirty``
+
+    The rows are those written to ``files/dirtycsv`` by
+    :py:class:`ValidMessages` with ``dirty`` set, and are copied in bulk with
+    their ``reason``, which is added as a column of ``ais_dirty`` if it is
+    missing.
+
+    Parameters
+    ==========
+    csvfile : str
+        The raw csv file
+    """
+    csvfile = luigi.Parameter()
+
+    host = get_environment_variable('DBHOSTNAME')
+    database = get_environment_variable('DBNAME')
+    user = get_environment_variable('DBUSER')
+    password = get_environment_variable('DBUSERPASS')
+    table = "ais_dirty"
+    columns = ValidMessagesToDatabase.columns + ['reason']
+
+    def requires(self):
+        return GetDirtyCsvFile(self.csvfile)
+
+    def run(self):
+        connection = self.output().connect()
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE {} ADD COLUMN IF NOT EXISTS "
+                           "reason text;".format(self.table))
+            sql = "COPY {} ({}) FROM STDIN WITH " \
+                  "(FORMAT csv, HEADER true)".format(self.table,
+                                                     ",".join(self.columns))
+            with open_intermediate(self.input().fn) as dirty_file:
+                cursor.copy_expert(sql, dirty_file)
+
+        # mark as complete in same transaction
+        self.output().touch(connection)
+        # commit and clean up
+        connection.commit()
+        connection.close()
+
+
+class LoadCleanedArchive(PooledConnectionMixin, CopyToTable):
+    """Loads all the valid csv files of an archive over a single connection
+
+    Each csv file is copied into ``ais_clean`` as by
+    :py:class:`ValidMessagesToDatabase`, honouring its ``direct_copy``,
+    ``copy_format`` and ``server_side`` configuration, and all of the files
+    are then added to ``ais_sources`` in one statement.  Everything is
+    committed in a single transaction together with the marker of this task,
+    so an archive is either loaded completely or not at all.
+
+    Files already loaded by :py:class:`ValidMessagesToDatabase` or
+    :py:class:`LoadCleanedAIS` are skipped, so that an archive partially
+    loaded one file at a time can be finished with this task, as are files
+    whose content is in the manifest of :py:mod:`superpyrate.manifest`.
+    The content of the files loaded is added to the manifest, see
+    :py:meth:`ValidMessagesToDatabase.load_once`.
+
+    Parameters
+    ==========
+    zip_file : str
+        The file path of the archive
+    stream : bool
+        Read the csv files directly from the zipped archive rather than
+        extracting it first
+    """
+    zip_file = luigi.Parameter()
+    stream = luigi.BoolParameter(significant=False)
+
+    host = get_environment_variable('DBHOSTNAME')
+    database = get_environment_variable('DBNAME')
+    user = get_environment_variable('DBUSER')
+    password = get_environment_variable('DBUSERPASS')
+    table = "ais_clean"
+    columns = ValidMessagesToDatabase.columns
+
+    @property
+    def priority(self):
+        return get_archive_priority(self.zip_file)
+
+    def requires(self):
+        loaders = self.loaders()
+        batches = get_archive_batches(self.zip_file)
+        if batches and not any(loader.direct_copy or loader.partitioned
+                               for loader in loaders):
+            return [ValidateBatch(self.zip_file, index, self.stream)
+                    for index in range(len(batches))]
+        return [loader.requires() for loader in loaders]
+
+    def loaders(self):
+        """Returns a :py:class:`ValidMessagesToDatabase` for each csv file
+        """
+        zip_file = self.zip_file if self.stream else ''
+        return [ValidMessagesToDatabase(csvfilepath, zip_file,
+                                        archive=self.zip_file)
+                for csvfilepath in list_csv_files(self.zip_file)]
+
+    def run(self):
+        loaders = self.loaders()
+        sources = [LoadCleanedAIS(loader.original_csvfile, loader.zip_file)
+                   for loader in loaders]
+
+        member_hashes = get_member_hashes(self.zip_file)
+        self.output().create_marker_table()
+        connection = self.output().connect()
+        loaded = self.find_loaded(connection, loaders + sources)
+        with connection.cursor() as cursor:
+            create_manifest_table(cursor)
+            ingested = find_ingested(cursor, member_hashes.values())
+
+        copied = set()
+        for loader in loaders:
+            if loader.task_id in loaded:
+                LOGGER.info("Skipping {}, which is already loaded".format(
+                    loader.original_csvfile))
+                continue
+            name = os.path.basename(loader.original_csvfile)
+            if member_hashes.get(name) in ingested:
+                LOGGER.info("Skipping {}, whose content is already "
+                            "loaded".format(loader.original_csvfile))
+                continue
+            LOGGER.debug("Loading {}".format(loader.original_csvfile))
+            if loader.load_once(connection):
+                copied.add(loader.task_id)
+
+        new_sources = [source.csvfile
+                       for source, loader in zip(sources, loaders)
+                       if source.task_id not in loaded and
+                       (loader.task_id in loaded or loader.task_id in copied)]
+        insert_sources(connection, new_sources)
+
+        # mark as complete in same transaction
+        self.output().touch(connection)
+        # commit and clean up
+        connection.commit()
+        connection.close()
+
+    def find_loaded(self, connection, tasks):
+        """Returns the ids of those tasks which are marked as complete
+        """
+        sql = "SELECT update_id FROM {} WHERE update_id = ANY(%s)".format(
+            self.output().marker_table)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, ([task.task_id for task in tasks],))
+            return set(row[0] for row in cursor.fetchall())
+
+
+class LoadSortedAIS(PooledConnectionMixin, CopyToTable):
+    """Loads the valid csv files of a folder of archives, sorted by MMSI and
+    Time
+
+    The csv files of all the archives are validated, and their clean rows are
+    then merged by :py:func:`~superpyrate.extsort.sort_csv_files` and piped
+    straight into a single ``COPY``, so that ``ais_clean`` is loaded in the
+    order of its clustering index.  The run files of the sort are spilled to
+    ``tmp/sort``.  All the files are added to ``ais_sources`` in the same
+    transaction.  Whether ``ais_clean`` was empty before the load, and so is
+    now wholly in order, is recorded by :py:func:`mark_loaded_in_order`.
+
+    Parameters
+    ==========
+    folder_of_zips : str
+    stream : bool
+        Read the csv files directly from the zipped archives rather than
+        extracting them first
+    buffer_rows : int, default=BUFFER_ROWS
+        The number of rows sorted in memory at once
+    """
+    folder_of_zips = luigi.Parameter()
+    stream = luigi.BoolParameter(significant=False)
+    buffer_rows = luigi.IntParameter(default=BUFFER_ROWS, significant=False)
+
+    host = get_environment_variable('DBHOSTNAME')
+    database = get_environment_variable('DBNAME')
+    user = get_environment_variable('DBUSER')
+    password = get_environment_variable('DBUSERPASS')
+    table = "ais_clean"
+    columns = ValidMessagesToDatabase.columns
+
+    def requires(self):
+        return GetFolderOfArchives(self.folder_of_zips)
+
+    def run(self):
+        csvfiles = yield from self.validate_archives()
+
+        self.output().create_marker_table()
+        connection = self.output().connect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM {});".format(
+                self.table))
+            was_empty = cursor.fetchone()[0]
+            self.copy_sorted(cursor, self.table, csvfiles)
+
+        insert_sources(connection, csvfiles)
+
+        # mark as complete in same transaction
+        self.output().touch(connection)
+        # commit and clean up
+        connection.commit()
+        connection.close()
+        mark_loaded_in_order(self.table, was_empty)
+
+    def list_archives(self):
+        filesystem = self.input().fs
+        return [archive for archive in filesystem.listdir(self.input().fn)
+                if os.path.splitext(archive)[1] == '.zip']
+
+    def validate_archives(self):
+        """Validates the csv files of all the archives
+
+        Used with ``yield from`` in :py:meth:`run`, so that the validation
+        tasks are dynamic dependencies
+
+        Returns
+        =======
+        list
+            The paths of the raw csv files
+        """
+        processed = yield [ProcessCsv(archive, self.stream)
+                           for archive in self.list_archives()]
+
+        csvfiles = []
+        for target in processed:
+            with target.open('r') as processed_file:
+                csvfiles.extend(line for line
+                                in processed_file.read().splitlines() if line)
+        return csvfiles
+
+    def copy_sorted(self, cursor, table, csvfiles, options=''):
+        """Copies the clean rows of csv files into a table, sorted by MMSI and
+        Time
+        """
+        cleanfiles = [get_clean_csv_file(csvfile).fn for csvfile in csvfiles]
+        sort_folder = os.path.join(get_working_folder(), 'tmp', 'sort')
+        pipe = BoundedPipe()
+        writer = PipeWriterThread(
+            lambda pipe: sort_csv_files(cleanfiles, pipe, sort_folder,
+                                        self.buffer_rows), pipe)
+        writer.start()
+        try:
+            sql = "COPY {} ({}) FROM STDIN WITH " \
+                  "(FORMAT csv, HEADER true{})".format(
+                      table, ",".join(self.columns), options)
+            cursor.copy_expert(sql, pipe)
+        finally:
+            pipe.abort()
+            writer.join()
+        if writer.error is not None:
+            raise writer.error
+
+
+class RebuildAisClean(LoadSortedAIS):
+    """Rebuilds ``ais_clean`` from the valid csv files of a folder of archives
+
+    For a full re-ingest, all the csv files are loaded in a single transaction
+    into a new unlogged staging table with ``COPY ... FREEZE``, which writes no
+    WAL and leaves the rows already frozen.  The indices of ``ais_clean`` are
+    then built once, the staging table is made logged, and it replaces
+    ``ais_clean`` along with the rows of ``ais_sources`` and the manifest of
+    :py:mod:`superpyrate.manifest`.  Readers keep using
+    the old table until the transaction commits, and only wait for the final
+    swap of the tables.
+
+    The staging table keeps the definition and privileges of ``ais_clean``,
+    including any primary key and other indices, see
+    :py:mod:`superpyrate.tables`.  If views or foreign keys depend on
+    ``ais_clean``, the rebuild fails before loading anything, as dropping the
+    old table would drop them too.
+
+    Parameters
+    ==========
+    folder_of_zips : str
+    stream : bool
+        Read the csv files directly from the zipped archives rather than
+        extracting them first
+    presort : bool
+        Load the rows sorted by MMSI and Time, so the rebuilt table is already
+        clustered and :py:class:`ClusterAisClean` does not rewrite it
+    buffer_rows : int, default=BUFFER_ROWS
+        The number of rows sorted in memory at once
+    """
+    presort = luigi.BoolParameter(significant=False)
+
+    def run(self):
+        csvfiles = yield from self.validate_archives()
+        staging = self.table + "_rebuild"
+        replaced = self.table + "_replaced"
+
+        self.output().create_marker_table()
+        connection = self.output().connect()
+        with connection.cursor() as cursor:
+            if is_partitioned(connection, self.table):
+                raise ValueError("A partitioned {} cannot be rebuilt".format(
+                    self.table))
+            check_replaceable(connection, self.table)
+            cursor.execute("DROP TABLE IF EXISTS {};".format(staging))
+            cursor.execute("CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING ALL "
+                           "EXCLUDING INDEXES);".format(staging, self.table))
+            copy_grants(cursor, self.table, staging)
+
+            if self.presort:
+                self.copy_sorted(cursor, staging, csvfiles, ", FREEZE true")
+            else:
+                sql = "COPY {} ({}) FROM STDIN WITH " \
+                      "(FORMAT csv, HEADER true, FREEZE true)".format(
+                          staging, ",".join(self.columns))
+                for csvfile in csvfiles:
+                    with open_intermediate(get_clean_csv_file(csvfile).fn) \
+                            as cleanfile:
+                        cursor.copy_expert(sql, cleanfile)
+
+            memory_mb, cores, min_memory_mb = get_index_resources()
+            _, build_memory_mb, workers = plan_index_builds(1, memory_mb,
+                                                            cores,
+                                                            min_memory_mb)
+            cursor.execute("SET LOCAL maintenance_work_mem = %s;",
+                           ('{}MB'.format(build_memory_mb),))
+            if connection.server_version >= 110000:
+                cursor.execute("SET LOCAL "
+                               "max_parallel_maintenance_workers = %s;",
+                               (workers,))
+            staged_indices = get_indices(self.table, on=staging)
+            for idxn, query, _ in staged_indices:
+                LOGGER.info("Building {}".format(idxn))
+                cursor.execute(query)
+            renames = copy_indices(cursor, self.table, staging,
+                                   [idxn for idxn, _, _
+                                    in get_indices(self.table)])
+            cursor.execute("ALTER TABLE {} SET LOGGED;".format(staging))
+
+            LOGGER.info("Replacing {} with {}".format(self.table, staging))
+            cursor.execute("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE;".format(
+                self.table))
+            cursor.execute("ALTER TABLE {} RENAME TO {};".format(self.table,
+                                                               replaced))
+            cursor.execute("DROP TABLE {};".format(replaced))
+            cursor.execute("ALTER TABLE {} RENAME TO {};".format(staging,
+                                                               self.table))
+            for (staged, _, _), (idxn, _, _) in zip(staged_indices,
+                                                    get_indices(self.table)):
+                cursor.execute("ALTER INDEX {} RENAME TO {};".format(staged,
+                                                                    idxn))
+            for rename in renames:
+                cursor.execute(rename)
+
+            cursor.execute("DELETE FROM ais_sources;")
+            create_manifest_table(cursor)
+            cursor.execute("DELETE FROM ais_manifest;")
+            entries = []
+            archives = self.list_archives()
+            for archive, archive_hash in zip(archives, hash_archives(
+                    archives, get_hash_folder())):
+                entries.append((archive_hash, 'archive',
+                                os.path.basename(archive)))
+                entries.extend((member_hash, 'member', name)
+                               for name, member_hash
+                               in get_member_hashes(archive).items())
+            record_ingested(cursor, entries)
+        insert_sources(connection, csvfiles)
+
+        # mark as complete in same transaction
+        self.output().touch(connection)
+        # commit and clean up
+        connection.commit()
+        connection.close()
+        mark_loaded_in_order(self.table, self.presort)
+
+
+def insert_sources(connection, csvfiles):
+    """Adds a row to ``ais_sources`` for each csv file in one statement
+    """
+    if not csvfiles:
+        return
+    rows = [get_source_data(csvfile) for csvfile in csvfiles]
+    columns = list(rows[0].keys())
+    sql = "INSERT INTO ais_sources ({}) VALUES %s".format(",".join(columns))
+    with connection.cursor() as cursor:
+        execute_values(cursor, sql,
+                       [[row[col] for col in columns] for row in rows])
+
 
-@requires(UnzippedArchive)
 class WriteCsvToDb(luigi.Task):
     """Dynamically spawns :py:class:`LoadCleanedAIS` to load valid csvs into the database
+
+    Parameters
+    ==========
+    stream : bool
+        Read the csv files directly from the zipped archive rather than
+        extracting it first
+    per_archive : bool
+        Load the whole archive over one connection and in one transaction with
+        :py:class:`LoadCleanedArchive`, rather than with a
+        :py:class:`LoadCleanedAIS` task for each csv file.  Usually set with
+        ``--WriteCsvToDb-per-archive`` or in the luigi configuration.  Always
+        the case if the csv files are validated in batches, see
+        :py:class:`ValidateBatch`
+    archive_hash : str, default=''
+        If given, the archive is added to the manifest once all its csv files
+        are loaded, see :py:mod:`superpyrate.manifest`
+
+    csv files whose content is already in the manifest are not loaded again.
+    If :py:class:`ValidMessages` writes the rejected rows, those of each csv
+    file are then loaded into ``ais_dirty`` with :py:class:`LoadDirtyAIS`
     """
+    zip_file = luigi.Parameter(description='The file path of the archive to unzip')
+    stream = luigi.BoolParameter(significant=False)
+    per_archive = luigi.BoolParameter(significant=False)
+    archive_hash = luigi.Parameter(default='', significant=False)
+
+    @property
+    def priority(self):
+        return get_archive_priority(self.zip_file)
+
+    def requires(self):
+        return GetZipArchive(self.zip_file)
+
     def run(self):
-        list_of_csvpaths = []
         LOGGER.debug("Writing csvs from {}".format(self.input().fn))
-        for csvfile in os.listdir(self.input().fn):
-            if os.path.splitext(csvfile)[1] == '.csv':
-                list_of_csvpaths.append(os.path.join(self.input().fn, csvfile))
-        yield [LoadCleanedAIS(csvfilepath) for csvfilepath in list_of_csvpaths]
+        list_of_csvpaths = list_csv_files(self.zip_file)
+        zip_file = self.zip_file if self.stream else ''
+        if self.per_archive or get_archive_batches(self.zip_file):
+            yield LoadCleanedArchive(self.zip_file, self.stream)
+        else:
+            member_hashes = get_member_hashes(self.zip_file)
+            connection = connect_to_database()
+            try:
+                with connection.cursor() as cursor:
+                    create_manifest_table(cursor)
+                    ingested = find_ingested(cursor, member_hashes.values())
+                connection.commit()
+            finally:
+                connection.close()
+            tasks = []
+            for csvfilepath in list_of_csvpaths:
+                if member_hashes.get(os.path.basename(csvfilepath)) in \
+                        ingested:
+                    LOGGER.info("Skipping {}, whose content is already "
+                                "loaded".format(csvfilepath))
+                    continue
+                tasks.append(LoadCleanedAIS(csvfilepath, zip_file,
+                                            archive=self.zip_file))
+            yield tasks
+
+        dirty_loaders = [LoadDirtyAIS(csvfilepath)
+                         for csvfilepath in list_of_csvpaths
+                         if ValidMessages(csvfilepath, zip_file).dirty and
+                         os.path.exists(get_dirty_file(csvfilepath))]
+        if dirty_loaders:
+            yield dirty_loaders
+
+        if self.archive_hash:
+            connection = connect_to_database()
+            try:
+                with connection.cursor() as cursor:
+                    record_ingested(cursor, [(
+                        self.archive_hash, 'archive',
+                        os.path.basename(self.zip_file))])
+                connection.commit()
+            finally:
+                connection.close()
 
         with self.output().open('w') as outfile:
             outfile.write("\n".join(list_of_csvpaths))
@@ -484,7 +2030,7 @@ class WriteCsvToDb(luigi.Task):
         name = os.path.splitext(filename)[0]
         rootdir = get_working_folder()
         path = os.path.join(rootdir, 'tmp','writecsv', name)
-        return luigi.file.LocalTarget(path)
+        return ListedLocalTarget(path)
 
 
 class ProcessZipArchives(luigi.Task):
@@ -494,16 +2040,27 @@ class ProcessZipArchives(luigi.Task):
     ==========
     with_db : bool
         Indicate whether a database is available for writing csv files
+    stream : bool
+        Read the csv files directly from the zipped archives rather than
+        extracting them into ``files/unzipped`` first
+    presort : bool
+        Load all the valid csv files into the database at once, sorted by
+        MMSI and Time with :py:class:`LoadSortedAIS`, so that
+        :py:class:`ClusterAisClean` need not rewrite the table
 
     Yields
     ======
     :py:class:`WriteCsvToDb`
 
+    :py:class:`LoadSortedAIS`
+
     :py:class:`ProcessCsv`
 
     """
     folder_of_zips = luigi.Parameter(significant=True)
     with_db = luigi.BoolParameter(significant=False)
+    stream = luigi.BoolParameter(significant=False)
+    presort = luigi.BoolParameter(significant=False)
 
     def requires(self):
         return GetFolderOfArchives(self.folder_of_zips)
@@ -512,6 +2069,7 @@ class ProcessZipArchives(luigi.Task):
         """
         """
         setup_working_folder()
+        start = self.get_start()
 
         archives = []
         LOGGER.warn("Database flag is {}".format(self.with_db))
@@ -524,13 +2082,130 @@ class ProcessZipArchives(luigi.Task):
             if os.path.splitext(archive)[1] == '.zip':
                 archives.append(archive)
         LOGGER.debug(archives)
-        if self.with_db is True:
-            yield [WriteCsvToDb(arc) for arc in archives]
+        self.plan_archives(archives)
+        if self.with_db is True and self.presort:
+            yield LoadSortedAIS(self.folder_of_zips, self.stream)
+        elif self.with_db is True:
+            yield [WriteCsvToDb(arc, self.stream, archive_hash=archive_hash)
+                   for arc, archive_hash in self.find_new_archives(archives)]
         else:
-            yield [ProcessCsv(arc) for arc in archives]
+            yield [ProcessCsv(arc, self.stream) for arc in archives]
+        self.report_makespan(archives, start)
         with self.output().open('w') as outfile:
             for arc in list_of_archives:
                 outfile.write("{}\n".format(arc))
+        os.remove(self.output().fn + '.start')
+
+    def get_start(self):
+        """Returns when this task first started to run
+
+        luigi runs the task again from the start each time its dynamic
+        dependencies are complete, so the time is kept in a file next to its
+        output until the task is complete.  A run resumed after a failure is
+        thus measured from the start of the run which failed
+        """
+        path = self.output().fn + '.start'
+        if os.path.exists(path):
+            with open(path, 'r') as start_file:
+                return float(start_file.read())
+        start = time.time()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as start_file:
+            start_file.write(repr(start))
+        return start
+
+    def list_archives(self):
+        """Returns the zipped archives in the folder of zips
+        """
+        filesystem = self.input().fs
+        return [archive for archive in filesystem.listdir(self.input().fn)
+                if os.path.splitext(archive)[1] == '.zip']
+
+    def plan_archives(self, archives):
+        """Reads the central directory of each archive into its plan
+
+        See :py:func:`get_archive_plan`
+        """
+        members = [member for archive in archives
+                   for member in get_archive_plan(archive)]
+        LOGGER.info("Planned {} csv files holding {} bytes in {} "
+                    "archives".format(
+                        len(members),
+                        sum(member['size'] for member in members),
+                        len(archives)))
+
+    def report_makespan(self, archives, start):
+        """Logs how long the csv files of the archives took to validate
+
+        The makespan achieved is compared with that expected of validating
+        the files largest first, see
+        :py:func:`superpyrate.planning.makespan_report`, and the report is
+        saved next to the output of this task.  Only the files validated since
+        ``start``, when this task started, are timed, so that files validated
+        by an earlier run do not stretch the makespan
+
+        Arguments
+        =========
+        archives : list
+        start : float
+            The time at which this task started, see :py:meth:`get_start`
+        """
+        timings = []
+        for archive in archives:
+            for csvfile in list_csv_files(archive):
+                timing_file = get_timing_file(csvfile)
+                if os.path.exists(timing_file):
+                    timing = load_timing(timing_file)
+                    if timing['start'] >= start:
+                        timings.append(timing)
+        if not timings:
+            return
+        report = makespan_report(timings)
+        LOGGER.info("Validated {jobs} csv files of {bytes} bytes in "
+                    "{achieved:.1f}s on {workers} workers, against "
+                    "{expected:.1f}s expected largest first (at least "
+                    "{lower_bound:.1f}s)".format(**report))
+        with open(self.output().fn + '.makespan.json', 'w') as report_file:
+            json.dump(report, report_file)
+
+    def find_new_archives(self, archives):
+        """Returns the archives whose content is not in the manifest
+
+        The archives are hashed on a pool of threads, see
+        :py:func:`superpyrate.manifest.hash_archives`.  Of several archives
+        with the same content, only the first is returned, so that the rows
+        of a copy under another name are not loaded in the same run
+
+        Returns
+        =======
+        list
+            Tuples of the path and the hash of each archive
+        """
+        hashes = list(zip(archives, hash_archives(archives,
+                                                  get_hash_folder())))
+        connection = connect_to_database()
+        try:
+            with connection.cursor() as cursor:
+                create_manifest_table(cursor)
+                ingested = find_ingested(cursor, [archive_hash
+                                                  for _, archive_hash
+                                                  in hashes])
+            connection.commit()
+        finally:
+            connection.close()
+        new_archives = []
+        seen = {}
+        for archive, archive_hash in hashes:
+            if archive_hash in ingested:
+                LOGGER.info("Skipping {}, whose content is already "
+                            "loaded".format(archive))
+            elif archive_hash in seen:
+                LOGGER.info("Skipping {}, whose content is the same as "
+                            "{}".format(archive, seen[archive_hash]))
+            else:
+                seen[archive_hash] = archive
+                new_archives.append((archive, archive_hash))
+        return new_archives
 
     def output(self):
         LOGGER.debug("Folder of zips: {} with db {}".format(self.folder_of_zips,
@@ -543,7 +2218,7 @@ class ProcessZipArchives(luigi.Task):
                                                    out_folder_name))
 
 
-class RunQueryOnTable(PostgresQuery):
+class RunQueryOnTable(PooledConnectionMixin, PostgresQuery):
     """Runs a query on a table in the database
 
     Used for passing in utility type queries to the database such as creation
@@ -566,12 +2241,137 @@ class RunQueryOnTable(PostgresQuery):
     password = get_environment_variable('DBUSERPASS')
 
 
+class BuildIndex(RunQueryOnTable):
+    """Creates an index, with the memory and parallel workers planned for it
+
+    The settings only last for the transaction of the build.  Each build
+    takes one unit of the ``index_build`` resource of luigi
+
+    Parameters
+    ==========
+    memory_mb : int
+        The ``maintenance_work_mem`` of the build
+    parallel_workers : int
+        The ``max_parallel_maintenance_workers`` of the build, which are only
+        available from postgres 11
+    priority : int, default=0
+        The priority of the build among the tasks luigi may run, see
+        :py:data:`CLUSTER_INDEX_PRIORITY`
+    """
+    memory_mb = luigi.IntParameter(default=64, significant=False)
+    parallel_workers = luigi.IntParameter(default=0, significant=False)
+    priority = luigi.IntParameter(default=0, significant=False)
+
+    resources = {'index_build': 1}
+
+    def run(self):
+        connection = self.output().connect()
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL maintenance_work_mem = %s;",
+                       ('{}MB'.format(self.memory_mb),))
+        if connection.server_version >= 110000:
+            cursor.execute("SET LOCAL max_parallel_maintenance_workers = %s;",
+                           (self.parallel_workers,))
+
+        LOGGER.info("Building index with {}MB and {} parallel workers: "
+                    "{}".format(self.memory_mb, self.parallel_workers,
+                                self.query))
+        cursor.execute(self.query)
+
+        # Update marker table
+        self.output().touch(connection)
+
+        # commit and close connection
+        connection.commit()
+        connection.close()
+
+
+def get_indices(table, on=None):
+    """Returns the indices of a table from its specification in
+    :py:mod:`pyrate`
+
+    The index over which ``ais_clean`` is clustered comes first
+
+    Arguments
+    =========
+    table : str
+        ``'ais_clean'`` or ``'ais_dirty'``
+    on : str, default=None
+        The table on which the indices are built, and after which they are
+        named, if not ``table`` itself
+
+    Returns
+    =======
+    list
+        Tuples of the name of the index, its ``CREATE INDEX`` query and the
+        update id of the task which builds it
+    """
+    if table == 'ais_clean':
+        indices = AISdb.clean_db_spec['indices']
+    elif table == 'ais_dirty':
+        indices = AISdb.dirty_db_spec['indices']
+    else:
+        raise NotImplementedError('Table not implemented or incorrect')
+
+    on = on or table
+    queries = []
+    for idx, cols in order_indices(indices):
+        idxn = on.lower() + "_" + idx
+        sql = ("CREATE INDEX \"" +
+               idxn +"\" ON \""+ on + "\" USING btree (" +
+               ','.join(["\"{}\"".format(s.lower()) for s in cols]) +")")
+        update_id = MakeAllIndices.__name__ + idxn
+        queries.append((idxn, sql, update_id))
+    return queries
+
+
+#: The priority of building the index over which ``ais_clean`` is clustered,
+#: so that luigi builds it before any other index
+CLUSTER_INDEX_PRIORITY = 100
+
+
 @requires(ProcessZipArchives)
+class MakeClusteringIndex(luigi.Task):
+    """Creates the index over which ``ais_clean`` is clustered
+
+    The index is built on its own, ahead of any other index, with all the
+    memory and cores available for building indices, so that
+    :py:class:`ClusterAisClean` can start as soon as possible
+    """
+
+    def run(self):
+        memory_mb, cores, _ = get_index_resources()
+        idxn, query, update_id = get_indices('ais_clean')[0]
+        yield BuildIndex(query, 'ais_clean', update_id,
+                         memory_mb=memory_mb,
+                         parallel_workers=max(0, cores - 1),
+                         priority=CLUSTER_INDEX_PRIORITY)
+
+        with self.output().open('w') as outfile:
+            outfile.write(idxn)
+
+    def output(self):
+        rootdir = get_working_folder()
+        path = os.path.join(rootdir, 'tmp', 'database',
+                            'create_ais_clean_cluster_index.txt')
+        return luigi.file.LocalTarget(path)
+
+
+@inherits(ProcessZipArchives)
 class MakeAllIndices(luigi.Task):
     """Creates the indices required for a specified table
 
     The list of indices are derived from the table specification in
-    :py:mod:`pyrate`
+    :py:mod:`pyrate`.  The indices of ``ais_clean`` other than that built by
+    :py:class:`MakeClusteringIndex` are built once the table has been
+    clustered by :py:class:`ClusterAisClean`, as clustering rebuilds every
+    index of the table.  So this is the task to run for a fully ingested,
+    clustered and indexed database.
+
+    All the builds are yielded at once, so luigi starts a build whenever one
+    of its workers is free, rather than waiting for a whole group of builds to
+    finish.  Each is given the memory and cores of one of as many builds at
+    once as :py:mod:`superpyrate.indexing` plans for.
 
     Parameters
     ==========
@@ -581,35 +2381,31 @@ class MakeAllIndices(luigi.Task):
     table = luigi.Parameter(default='ais_clean')
     # with_db = True
 
+    def requires(self):
+        if self.table == 'ais_clean':
+            return self.clone(ClusterAisClean)
+        return self.clone(ProcessZipArchives)
+
     def run(self):
+        """The table specifications are read from :py:class:`AISdb` itself,
+        so no connection to the database is needed
         """
-        """
-        options = {}
-        options['host'] = get_environment_variable('DBHOSTNAME')
-        options['db'] = get_environment_variable('DBNAME')
-        options['user'] = get_environment_variable('DBUSER')
-        options['pass'] = get_environment_variable('DBUSERPASS')
-
-        db = AISdb(options)
-        with db:
-            if self.table == 'ais_clean':
-                indices = db.clean_db_spec['indices']
-            elif self.table == 'ais_dirty':
-                indices = db.dirty_db_spec['indices']
-            else:
-                raise NotImplemented('Table not implemented or incorrect')
-
-        queries = []
-        for idx, cols in indices:
-            idxn = self.table.lower() + "_" + idx
-            sql = ("CREATE INDEX \"" +
-                   idxn +"\" ON \""+ self.table + "\" USING btree (" +
-                   ','.join(["\"{}\"".format(s.lower()) for s in cols]) +")")
-            update_id = self.__class__.__name__ + idxn
-            queries.append((sql, update_id))
-
-
-        yield [RunQueryOnTable(query, self.table, up_id) for query, up_id in queries]
+        queries = get_indices(self.table)
+        if self.table == 'ais_clean':
+            # Built by MakeClusteringIndex
+            queries = queries[1:]
+        memory_mb, cores, min_memory_mb = get_index_resources()
+        concurrent, build_memory_mb, workers = plan_index_builds(
+            len(queries), memory_mb, cores, min_memory_mb)
+        LOGGER.info("Building {} indices on {}, planned {} at a time with "
+                    "{}MB and {} parallel workers each".format(
+                        len(queries), self.table, concurrent, build_memory_mb,
+                        workers))
+
+        yield [BuildIndex(query, self.table, update_id,
+                          memory_mb=build_memory_mb,
+                          parallel_workers=workers)
+               for _, query, update_id in queries]
 
         with self.output().open('w') as outfile:
             outfile.write(self.table)
@@ -617,13 +2413,29 @@ class MakeAllIndices(luigi.Task):
     def output(self):
         filename = 'create_{}_indexes.txt'.format(self.table)
         rootdir = get_working_folder()
-        path = os.path.join(rootdir, 'tmp','database', filename)
+        path = os.path.join(rootdir, 'tmp', 'database', filename)
         return luigi.file.LocalTarget(path)
 
 
-@requires(MakeAllIndices)
-class ClusterAisClean(PostgresQuery):
+def get_cluster_update_id(partition):
+    """Returns the marker of the task clustering a partition of ``ais_clean``
+
+    The marker is removed when rows are copied into the partition, see
+    :py:meth:`ValidMessagesToDatabase.forget_clustered`
+    """
+    return ClusterAisClean.__name__ + partition
+
+
+@requires(MakeClusteringIndex)
+class ClusterAisClean(PooledConnectionMixin, PostgresQuery):
     """Clusters the ais_clean table over the disk on the mmsi index
+
+    When the table was empty before being loaded with ``presort``, or was
+    rebuilt with ``presort`` by :py:class:`RebuildAisClean`, its rows are
+    already in the order of the index, so it is not clustered again.  Rows
+    loaded in order after others are not, so the table is then clustered.
+    The partitions of a partitioned table are each clustered on their own
+    index.
     """
     host = get_environment_variable('DBHOSTNAME')
     database = get_environment_variable('DBNAME')
@@ -631,3 +2443,37 @@ class ClusterAisClean(PostgresQuery):
     password = get_environment_variable('DBUSERPASS')
     table = "ais_clean"
     query = 'CLUSTER VERBOSE ais_clean USING ais_clean_mmsi_idx;'
+
+    def run(self):
+        """A partitioned table is clustered a partition at a time, in tasks
+        of their own, so partitions already clustered are not rewritten
+        """
+        if self.presort and os.path.exists(get_load_order_file(self.table)):
+            LOGGER.info("Not clustering {}, which was loaded in order".format(
+                self.table))
+            self.output().touch()
+            return
+
+        connection = self.output().connect()
+        try:
+            partitions = [(partition,
+                           get_partition_index(connection,
+                                               'ais_clean_mmsi_idx',
+                                               partition))
+                          for partition in list_partitions(connection,
+                                                           self.table)]
+        finally:
+            connection.close()
+        if not partitions:
+            super().run()
+            return
+        for partition, index in partitions:
+            if index is None:
+                raise RuntimeError("{} has no mmsi index".format(partition))
+
+        yield [RunQueryOnTable("CLUSTER VERBOSE {} USING {};".format(partition,
+                                                                     index),
+                               partition,
+                               get_cluster_update_id(partition))
+               for partition, index in partitions]
+        self.output().touch()
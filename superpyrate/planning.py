@@ -0,0 +1,330 @@
+"""Plans the work on an archive from its central directory
+
+The csv files held in an archive, and their uncompressed sizes, are known
+from the central directory at the end of the archive without extracting
+anything.  :py:func:`plan_archive` reads them once and keeps them in a json
+file, so that the tasks of every csv file can be built when the graph is
+scheduled, rather than by listing the folder the archive is extracted into.
+
+The plan of an archive holds, for each csv file to be extracted (named
+without any folder, as by :py:func:`superpyrate.extract.list_members`):
+
+``name``
+    the file name of the csv file
+``member``
+    the name of the member within the archive
+``size``
+    the uncompressed size in bytes
+``compressed_size``
+    the compressed size in bytes
+
+The plan is read again from its file while the size and modification time of
+the archive are unchanged.
+
+Scheduling
+----------
+The sizes in the plans set the ``priority`` of the tasks, so that luigi starts
+the largest units of work first (longest processing time first), and a huge
+file which happens to be listed last does not stretch the whole run.  Which
+size is used is set in the ``[planning]`` section of the luigi configuration:
+
+``priority``
+    ``size`` (the default) to use the uncompressed size, ``compressed_size``
+    to use the compressed size, or empty to leave the priority of every task
+    at 0
+
+``batch_bytes``
+    if more than 0, the csv files of each archive are validated in batches of
+    up to this many (uncompressed) bytes, each by a single task, rather than
+    by a task for each file.  See :py:func:`batch_members`
+
+The priority is the size in megabytes.  As luigi raises the priority of the
+dependencies of a task to its own, the extraction of an archive is started
+as early as its largest csv file requires.
+
+:py:func:`makespan_report` compares the time taken to validate a set of csv
+files with that expected of scheduling them largest first.
+"""
+from superpyrate.extract import list_members
+import hashlib
+import heapq
+import json
+import os
+import zipfile
+import luigi
+
+
+class planning(luigi.Config):
+    priority = luigi.Parameter(default='size')
+    batch_bytes = luigi.IntParameter(default=0)
+
+
+#: The sizes which may set the priority of tasks
+PRIORITY_SIZES = ('size', 'compressed_size')
+
+#: The plans read in this process, by the path of their file
+_plans = {}
+
+#: The csv files of the plans read in this process by their name, with the
+#: list of the plan they index, by the path of the file of the plan
+_plans_by_name = {}
+
+
+def read_central_directory(zip_file, extension='.csv'):
+    """Returns the csv files of an archive as listed in its central directory
+
+    Arguments
+    ---------
+    zip_file : str
+    extension : str, default='.csv'
+
+    Returns
+    -------
+    list
+        A dict for each csv file, in the order of the archive
+    """
+    with zipfile.ZipFile(zip_file) as archive:
+        members = list_members(archive, extension)
+    return [{'name': name,
+             'member': info.filename,
+             'size': info.file_size,
+             'compressed_size': info.compress_size}
+            for name, info in members.items()]
+
+
+def get_plan_file(zip_file, plan_folder):
+    """Returns the file in which the plan of an archive is kept
+
+    The file is named by a hash of the absolute path of the archive, as for
+    the caches of :py:mod:`superpyrate.manifest`, so that archives of the
+    same name in different folders have plans of their own
+    """
+    key = hashlib.sha1(os.path.abspath(zip_file).encode('utf-8')).hexdigest()
+    return os.path.join(plan_folder, key + '.json')
+
+
+def plan_archive(zip_file, plan_folder):
+    """Returns the csv files of an archive, keeping them in a json file
+
+    Arguments
+    ---------
+    zip_file : str
+    plan_folder : str
+        The folder in which the plan is kept
+
+    Returns
+    -------
+    list
+        A dict for each csv file, see :py:func:`read_central_directory`
+    """
+    plan_file = get_plan_file(zip_file, plan_folder)
+    stat = os.stat(zip_file)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    archive = os.path.abspath(zip_file)
+    plan = _plans.get(plan_file)
+    if plan and plan['archive'] == archive and plan['stamp'] == stamp:
+        return plan['members']
+    try:
+        with open(plan_file, 'r') as cached:
+            plan = json.load(cached)
+        if plan['archive'] == archive and plan['stamp'] == stamp:
+            _plans[plan_file] = plan
+            return plan['members']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    members = read_central_directory(zip_file)
+    os.makedirs(plan_folder, exist_ok=True)
+    temporary_file = '{}.{}'.format(plan_file, os.getpid())
+    plan = {'archive': archive, 'stamp': stamp, 'members': members}
+    with open(temporary_file, 'w') as cached:
+        json.dump(plan, cached, indent=1)
+    os.replace(temporary_file, plan_file)
+    _plans[plan_file] = plan
+    return members
+
+
+def plan_by_name(zip_file, plan_folder):
+    """Returns the csv files of an archive by their name
+
+    The names are indexed once for each plan read, so looking up the files
+    of an archive one at a time takes constant time for each
+
+    Arguments
+    ---------
+    zip_file : str
+    plan_folder : str
+        The folder in which the plan is kept
+
+    Returns
+    -------
+    dict
+        The dict of each csv file, see :py:func:`read_central_directory`, by
+        its name
+    """
+    members = plan_archive(zip_file, plan_folder)
+    plan_file = get_plan_file(zip_file, plan_folder)
+    indexed = _plans_by_name.get(plan_file)
+    if indexed is None or indexed[0] is not members:
+        indexed = (members, {member['name']: member for member in members})
+        _plans_by_name[plan_file] = indexed
+    return indexed[1]
+
+
+def get_batch_bytes():
+    """Returns the most bytes validated by a batch, or 0 if not batched
+    """
+    return planning().batch_bytes
+
+
+def get_priority(members):
+    """Returns the priority of the work on some csv files
+
+    Arguments
+    ---------
+    members : list
+        The dicts of the csv files in a plan
+
+    Returns
+    -------
+    int
+        Their total size in megabytes, as configured by ``priority`` in the
+        ``[planning]`` section
+    """
+    size = planning().priority
+    if not size:
+        return 0
+    if size not in PRIORITY_SIZES:
+        raise ValueError("Unknown size for the priority of tasks: "
+                         "{}".format(size))
+    return sum(member[size] for member in members) // (1024 * 1024)
+
+
+def batch_members(members, batch_bytes):
+    """Groups the csv files of a plan into batches
+
+    The files are taken in the order of the plan, so the batches of an
+    archive are the same whenever it is planned.  A batch is closed once the
+    next file would take it over ``batch_bytes``, so a file larger than that
+    is a batch of its own.
+
+    Arguments
+    ---------
+    members : list
+        The dicts of the csv files in a plan
+    batch_bytes : int
+        The most uncompressed bytes in a batch of several files
+
+    Returns
+    -------
+    list
+        The lists of the dicts of the csv files in each batch
+    """
+    batches = []
+    batch = []
+    size = 0
+    for member in members:
+        if batch and size + member['size'] > batch_bytes:
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(member)
+        size += member['size']
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def schedule_largest_first(sizes, workers):
+    """Returns the busiest load of workers given jobs largest first
+
+    Each job is given to the worker with the least load so far
+
+    Arguments
+    ---------
+    sizes : list
+        The size (or time) of each job
+    workers : int
+
+    Returns
+    -------
+    float
+        The largest total of the jobs given to a worker
+    """
+    loads = [0] * max(1, workers)
+    for size in sorted(sizes, reverse=True):
+        heapq.heapreplace(loads, loads[0] + size)
+    return max(loads)
+
+
+def peak_concurrency(timings):
+    """Returns the most jobs which ran at the same time
+    """
+    events = sorted([(timing['start'], 1) for timing in timings] +
+                    [(timing['end'], -1) for timing in timings])
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+
+def makespan_report(timings, workers=None):
+    """Compares the makespan of jobs with that of scheduling them largest first
+
+    The expected times assume that each job takes as long per byte as the
+    jobs did on average
+
+    Arguments
+    ---------
+    timings : list
+        A dict for each job of its ``size`` in bytes and the ``start`` and
+        ``end`` times in seconds
+    workers : int, default=None
+        The number of workers, by default the most jobs which ran at once
+
+    Returns
+    -------
+    dict
+        The number of ``jobs`` and ``workers``, the total ``bytes``, the
+        ``achieved`` makespan in seconds from the first start to the last end,
+        the ``expected`` makespan of scheduling the jobs largest first and its
+        ``lower_bound``, the longer of the largest job and the total time
+        spread evenly over the workers
+    """
+    if not timings:
+        raise ValueError("No jobs were timed")
+    if workers is None:
+        workers = peak_concurrency(timings)
+    total_bytes = sum(timing['size'] for timing in timings)
+    busy = sum(timing['end'] - timing['start'] for timing in timings)
+    if total_bytes:
+        durations = [busy * timing['size'] / total_bytes for timing in timings]
+    else:
+        durations = [timing['end'] - timing['start'] for timing in timings]
+    return {'jobs': len(timings),
+            'workers': workers,
+            'bytes': total_bytes,
+            'achieved': max(timing['end'] for timing in timings) -
+                        min(timing['start'] for timing in timings),
+            'expected': schedule_largest_first(durations, workers),
+            'lower_bound': max(max(durations), sum(durations) / workers)}
+
+
+def save_timing(path, size, start, end):
+    """Writes the size of a job and when it started and ended to a json file
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    temporary_path = '{}.{}'.format(path, os.getpid())
+    with open(temporary_path, 'w') as timing_file:
+        json.dump({'size': size, 'start': start, 'end': end}, timing_file)
+    os.replace(temporary_path, path)
+
+
+def load_timing(path):
+    """Reads a timing written by :py:func:`save_timing`
+    """
+    with open(path, 'r') as timing_file:
+        return json.load(timing_file)
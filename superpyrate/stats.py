@@ -0,0 +1,169 @@
+"""Counts of the records read, rejected and written when validating a csv file
+
+The counts are kept by every validation engine as it goes, and saved alongside
+the clean csv file so that they can be written to the ``ais_sources`` table
+without reading the files again.  They follow the columns of ``ais_sources``
+as used by :py:mod:`pyrate`:
+
+``raw``
+    the records read from the csv file
+``invalid``
+    the records which could not be read or converted
+``dirty``
+    the records which were converted, but failed validation
+``clean``
+    the rows written to the clean file
+
+The records rejected are also counted by the cause of their rejection, one of
+the ``CATEGORIES``.  Rather than logging every bad row, which on a dirty file
+costs more than validating it, only the first ``max_examples`` of each
+category are logged, and the counts of each category are summarised once the
+file has been validated.
+"""
+import json
+import os
+import logging
+LOGGER = logging.getLogger('luigi-interface')
+
+#: A record which the csv reader could not read
+CSV_ERROR = 'csv'
+#: A record which could not be decoded
+UNICODE_ERROR = 'unicode'
+#: A record with more or fewer columns than the header
+COLUMN_COUNT = 'columns'
+#: A record with a value which could not be converted
+PARSE_ERROR = 'parse'
+#: A record missing a value which is required
+MISSING_VALUE = 'missing'
+#: A converted record which failed validation
+VALIDATION = 'validation'
+#: A validated record which could not be written
+WRITE_ERROR = 'write'
+
+CATEGORIES = (CSV_ERROR, UNICODE_ERROR, COLUMN_COUNT, PARSE_ERROR,
+              MISSING_VALUE, VALIDATION, WRITE_ERROR)
+
+#: The number of example records logged for each category of error
+MAX_EXAMPLES = 5
+
+
+class ValidationCounts(object):
+    """The counts of the records of a csv file as it is validated
+
+    Arguments
+    ---------
+    raw, invalid, dirty, clean : int, default=0
+    errors : dict, default=None
+        The number of records rejected for each of the ``CATEGORIES``
+    max_examples : int, default=MAX_EXAMPLES
+        The number of records logged for each category of error
+    """
+    fields = ('raw', 'invalid', 'dirty', 'clean')
+
+    def __init__(self, raw=0, invalid=0, dirty=0, clean=0, errors=None,
+                 max_examples=MAX_EXAMPLES):
+        self.raw = raw
+        self.invalid = invalid
+        self.dirty = dirty
+        self.clean = clean
+        self.errors = dict(errors or {})
+        self.max_examples = max_examples
+
+    def __iadd__(self, other):
+        for field in self.fields:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        for category, number in other.errors.items():
+            self.errors[category] = self.errors.get(category, 0) + number
+        return self
+
+    def __eq__(self, other):
+        return isinstance(other, ValidationCounts) and \
+            self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return "ValidationCounts({})".format(", ".join(
+            "{}={}".format(field, getattr(self, field))
+            for field in self.fields))
+
+    def count_raw(self, rows):
+        """Counts the rows of an iterable as they pass through
+        """
+        for row in rows:
+            self.raw += 1
+            yield row
+
+    def record_error(self, category, message, *args, number=1):
+        """Counts records with an error, logging the first few of the category
+
+        The message is only formatted with ``args`` if it is logged.  The
+        records are not counted as invalid or dirty, as those rejected while
+        being read are passed on as empty rows, which are counted as invalid
+        by the validation engines.
+
+        Arguments
+        ---------
+        category : str
+            One of the ``CATEGORIES``
+        message : str
+            A message for :py:meth:`str.format`
+        number : int, default=1
+            The number of records with the error
+        """
+        seen = self.errors.get(category, 0)
+        self.errors[category] = seen + number
+        if seen < self.max_examples:
+            LOGGER.error(message.format(*args))
+            if seen + number >= self.max_examples:
+                LOGGER.error("Further {} errors are counted but not "
+                             "logged".format(category))
+
+    def reject(self, category, message, *args, number=1):
+        """Counts records rejected as dirty if they failed validation, or
+        otherwise as invalid, as in :py:meth:`record_error`
+        """
+        if category == VALIDATION:
+            self.dirty += number
+        else:
+            self.invalid += number
+        self.record_error(category, message, *args, number=number)
+
+    def summary(self, name):
+        """Describes the counts of the records of a file
+        """
+        text = "{} records read from {}: {} invalid, {} dirty and {} " \
+               "clean".format(self.raw, name, self.invalid, self.dirty,
+                              self.clean)
+        if self.errors:
+            text += " ({})".format(", ".join(
+                "{} {}".format(self.errors[category], category)
+                for category in sorted(self.errors, key=category_order)))
+        return text
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def save(self, path):
+        """Writes the counts to a json file
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temporary_path = '{}.{}'.format(path, os.getpid())
+        with open(temporary_path, 'w') as stats_file:
+            json.dump(dict(self.as_dict(), errors=self.errors), stats_file)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Reads the counts from a json file written by :py:meth:`save`
+        """
+        with open(path, 'r') as stats_file:
+            return cls(**json.load(stats_file))
+
+
+def category_order(category):
+    """Orders categories of errors as the ``CATEGORIES``, then by name
+    """
+    if category in CATEGORIES:
+        return CATEGORIES.index(category), category
+    return len(CATEGORIES), category
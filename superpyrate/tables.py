@@ -0,0 +1,146 @@
+"""Replacing a table with a new one of the same definition
+
+A table is replaced by creating the new table, filling it, dropping the old
+one and renaming the new one in its place, as by
+:py:class:`~superpyrate.pipeline.RebuildAisClean` and
+:py:func:`~superpyrate.partitions.partition_table`.  The new table is created
+``LIKE`` the old one ``INCLUDING ALL``, so it has the same defaults,
+constraints, storage settings, statistics targets and comments.  The
+privileges granted on the old table are granted on the new one by
+:py:func:`copy_grants`.  If its indices are only built once the new table is
+filled, the primary key, unique and exclusion constraints and the other
+indices of the old table are then created by :py:func:`copy_indices`.
+
+A table on which views or the foreign keys of other tables depend cannot be
+dropped without dropping those too, which would lose them.  So
+:py:func:`check_replaceable` refuses to replace such a table before any work
+is done.
+"""
+import re
+import logging
+LOGGER = logging.getLogger('luigi-interface')
+
+#: The name of the index and of its table in a definition returned by
+#: ``pg_get_indexdef``
+INDEX_DEFINITION = re.compile(r'^(CREATE (?:UNIQUE )?INDEX )\S+'
+                              r'( ON (?:ONLY )?)\S+')
+
+
+def find_dependents(connection, table):
+    """Returns the views and tables which depend on a table
+
+    Arguments
+    ---------
+    connection : psycopg2.extensions.connection
+    table : str
+
+    Returns
+    -------
+    list
+        The names of the views whose queries read the table, and of the
+        tables with foreign keys referencing it
+    """
+    sql = "SELECT DISTINCT dependent.relname " \
+          "FROM pg_depend " \
+          "JOIN pg_rewrite ON pg_rewrite.oid = pg_depend.objid " \
+          "JOIN pg_class AS dependent " \
+          "ON dependent.oid = pg_rewrite.ev_class " \
+          "WHERE pg_depend.classid = 'pg_rewrite'::regclass " \
+          "AND pg_depend.refobjid = %s::regclass " \
+          "AND dependent.oid <> pg_depend.refobjid " \
+          "UNION " \
+          "SELECT DISTINCT conrelid::regclass::text FROM pg_constraint " \
+          "WHERE confrelid = %s::regclass AND conrelid <> confrelid " \
+          "ORDER BY 1;"
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (table, table))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def check_replaceable(connection, table):
+    """Raises an error if a table cannot be replaced without losing the views
+    and tables which depend on it
+
+    Raises
+    ------
+    ValueError
+        If any views or foreign keys depend on the table
+    """
+    dependents = find_dependents(connection, table)
+    if dependents:
+        raise ValueError("{} cannot be replaced, as dropping it would also "
+                         "drop {}, which depend on it.  Drop them first, and "
+                         "create them again once {} has been "
+                         "replaced".format(table, ", ".join(dependents),
+                                           table))
+
+
+def copy_grants(cursor, table, new_table):
+    """Grants on ``new_table`` the privileges granted on ``table``
+    """
+    cursor.execute("SELECT CASE WHEN acl.grantee = 0 THEN 'PUBLIC' "
+                   "ELSE quote_ident(pg_get_userbyid(acl.grantee)) END, "
+                   "acl.privilege_type, acl.is_grantable "
+                   "FROM pg_class, aclexplode(pg_class.relacl) AS acl "
+                   "WHERE pg_class.oid = %s::regclass;", (table,))
+    for grantee, privilege, grantable in cursor.fetchall():
+        cursor.execute("GRANT {} ON {} TO {}{};".format(
+            privilege, new_table, grantee,
+            " WITH GRANT OPTION" if grantable else ""))
+
+
+def copy_indices(cursor, table, new_table, exclude=()):
+    """Creates on ``new_table`` the constraints backed by indices and the
+    other indices of ``table``
+
+    The new constraints and indices are named after the old ones with the
+    suffix ``_new``, as the old names are still taken, so they must be
+    renamed once ``table`` is dropped
+
+    Arguments
+    ---------
+    cursor : psycopg2.extensions.cursor
+    table : str
+    new_table : str
+    exclude : iterable, default=()
+        The names of indices of ``table`` not to create, such as those built
+        on ``new_table`` already
+
+    Returns
+    -------
+    list
+        The statements which rename each constraint or index once
+        ``new_table`` has been renamed to ``table``
+    """
+    renames = []
+    cursor.execute("SELECT conname, pg_get_constraintdef(oid) "
+                   "FROM pg_constraint "
+                   "WHERE conrelid = %s::regclass "
+                   "AND contype IN ('p', 'u', 'x') "
+                   "ORDER BY conname;", (table,))
+    for name, definition in cursor.fetchall():
+        LOGGER.info("Adding {} to {}".format(name, new_table))
+        cursor.execute("ALTER TABLE {} ADD CONSTRAINT {} {};".format(
+            new_table, name + '_new', definition))
+        renames.append("ALTER TABLE {} RENAME CONSTRAINT {} TO {};".format(
+            table, name + '_new', name))
+
+    cursor.execute("SELECT idx.relname, pg_get_indexdef(pg_index.indexrelid) "
+                   "FROM pg_index "
+                   "JOIN pg_class AS idx ON idx.oid = pg_index.indexrelid "
+                   "WHERE pg_index.indrelid = %s::regclass "
+                   "AND NOT EXISTS (SELECT 1 FROM pg_constraint "
+                   "WHERE conindid = pg_index.indexrelid) "
+                   "ORDER BY idx.relname;", (table,))
+    for name, definition in cursor.fetchall():
+        if name in exclude:
+            continue
+        LOGGER.info("Building {} on {}".format(name, new_table))
+        definition = INDEX_DEFINITION.sub(
+            lambda match: '{}{}{}{}'.format(match.group(1), name + '_new',
+                                            match.group(2), new_table),
+            definition)
+        cursor.execute(definition + ';')
+        renames.append("ALTER INDEX {} RENAME TO {};".format(name + '_new',
+                                                             name))
+    return renames
@@ -0,0 +1,141 @@
+"""File targets whose existence is checked a folder at a time
+
+Before scheduling, luigi checks whether each task is complete, which for a
+task writing a file is whether the file exists.  On a re-run over hundreds of
+thousands of csv files, one ``stat`` per file of each kind (raw, clean, dirty
+and the markers in ``tmp``) adds up, especially on a network file system.
+Instead, :py:func:`file_exists` lists the folder of a file once with
+:py:func:`os.scandir`, and answers from the listing.
+
+A listing is trusted both ways: a file missing from it does not exist.  So
+the listings are kept up to date with the files the process itself writes:
+
+* the targets of :py:class:`ListedLocalTarget` opened for writing are added
+  once they are renamed into place
+* other files and folders written by this process, or by a program it runs,
+  must be added with :py:func:`add_file`
+* files removed by this process are forgotten with :py:func:`forget_file`,
+  and only these are checked on disk again, the next time they are asked for
+
+The files written by other processes are not seen.  So each process makes
+listings of its own: they are forgotten before the process forks, such as
+when luigi starts a task in a process of its own with several ``--workers``,
+and the folders are listed again by both the parent and the child once they
+are next asked for.  A file written or deleted by hand while a process runs
+is not seen by that process.
+"""
+import os
+import threading
+import luigi
+from luigi.local_target import atomic_file
+
+#: The names found in each folder listed by this process
+_listings = {}
+#: The paths forgotten since being listed, which are checked on disk again
+_forgotten = set()
+_listings_lock = threading.Lock()
+
+
+def list_folder(folder):
+    """Returns the names in a folder, listing it the first time it is asked for
+
+    Returns
+    -------
+    set
+        The names of the files and folders in ``folder``, which is empty if
+        the folder does not exist
+    """
+    folder = os.path.abspath(folder)
+    with _listings_lock:
+        names = _listings.get(folder)
+        if names is None:
+            try:
+                with os.scandir(folder) as entries:
+                    names = set(entry.name for entry in entries)
+            except (FileNotFoundError, NotADirectoryError):
+                names = set()
+            _listings[folder] = names
+        return names
+
+
+def file_exists(path):
+    """Checks whether a file or folder exists, from the listing of its folder
+    """
+    path = os.path.abspath(path)
+    folder, name = os.path.split(path)
+    names = list_folder(folder)
+    with _listings_lock:
+        if path not in _forgotten:
+            return name in names
+        _forgotten.discard(path)
+        if os.path.exists(path):
+            names.add(name)
+            return True
+        return False
+
+
+def add_file(path):
+    """Adds a file or folder written by this process to the listing of its
+    folder
+
+    If ``path`` is a folder, any listing of the files in it is forgotten, as
+    it may have been filled or replaced as a whole, so it is listed again
+    when next asked for
+    """
+    path = os.path.abspath(path)
+    folder, name = os.path.split(path)
+    with _listings_lock:
+        _forgotten.discard(path)
+        if folder in _listings:
+            _listings[folder].add(name)
+        _listings.pop(path, None)
+
+
+def forget_file(path):
+    """Removes a file from the listing of its folder, so that it is checked on
+    disk the next time it is asked for
+    """
+    path = os.path.abspath(path)
+    folder, name = os.path.split(path)
+    with _listings_lock:
+        _listings.get(folder, set()).discard(name)
+        _forgotten.add(path)
+
+
+def clear_listings():
+    """Forgets the listings of all folders
+    """
+    with _listings_lock:
+        _listings.clear()
+        _forgotten.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=clear_listings)
+
+
+class ListedAtomicFile(atomic_file):
+    """Writes to a temporary file, which is renamed to the target and added
+    to the listing of its folder when closed
+    """
+    def move_to_final_destination(self):
+        super().move_to_final_destination()
+        add_file(self.path)
+
+
+class ListedLocalTarget(luigi.LocalTarget):
+    """A :py:class:`luigi.LocalTarget` whose existence is checked with
+    :py:func:`file_exists`
+    """
+    def exists(self):
+        return file_exists(self.path)
+
+    def open(self, mode='r'):
+        if mode.replace('b', '').replace('t', '') == 'w':
+            self.makedirs()
+            return self.format.pipe_writer(ListedAtomicFile(self.path))
+        return super().open(mode)
+
+    def remove(self):
+        super().remove()
+        forget_file(self.path)
@@ -1,24 +1,33 @@
 """Holds the luigi tasks which count the number of rows in the files
 
-Records the number of clean and dirty rows in the AIS data,
+Records the number of clean, dirty and invalid rows in the AIS data,
 writing these stats to the database and finally producing a report of the
 statistics
 
-1. Count the number of rows in the raw csv files (in ``files/unzipped/<archive>``)
-2. Count the number of rows int the clean csv files (in ``files/cleancsv/``)
-3. Write the clean rows in the clean column of ais_sources
-4. Write the dirty (raw - clean) rows into the dirty column of ais_sources
+1. Gather the counts of the records of each csv file, which are saved in
+   ``tmp/stats`` by :py:class:`~superpyrate.pipeline.ValidMessages` as it
+   validates them
+2. Write the clean, dirty and invalid rows into the respective columns of
+   ais_sources
 
+Because the counts are kept during validation, the files are not read again,
+and records spanning several lines are counted correctly.
+
+The ``dirty`` rows are only those which were read but failed validation,
+while the ``invalid`` rows are the records which could not be parsed at all,
+see :py:mod:`superpyrate.stats`.  The ``coverage`` of the report is the
+fraction of all the records of a file which were rejected, whether dirty or
+invalid.
 """
 import luigi
 from luigi.util import requires
-from luigi.contrib.external_program import ExternalProgramTask
-from luigi.postgres import CopyToTable, PostgresQuery
-from superpyrate.pipeline import get_environment_variable, ProcessZipArchives, \
-                                 GetZipArchive, get_working_folder, \
-                                 RunQueryOnTable, GetCsvFile
-from plumbum.cmd import wc
-from glob import glob
+from luigi.postgres import PostgresQuery
+from superpyrate.pipeline import get_environment_variable, \
+                                 ProcessZipArchives, get_working_folder, \
+                                 list_csv_files, get_stats_file
+from superpyrate.dbpool import PooledConnectionMixin
+from superpyrate.stats import ValidationCounts
+import csv
 import os
 import logging
 LOGGER = logging.getLogger(__name__)
@@ -30,152 +39,110 @@ logging.basicConfig(filename='reporting.log',
                     datefmt='%m/%d/%Y %I:%M:%S %p')
 
 
-
 @requires(ProcessZipArchives)
 class GetCountsForAllFiles(luigi.Task):
-    """Counts the rows in all clean (validated) and raw files
+    """Gathers the counts of the records of all the validated files
+
+    Writes a csv file of the filename and the raw, invalid, dirty and clean
+    counts of each file.  The files are the csv files planned for the
+    archives in the folder of zips, see
+    :py:func:`~superpyrate.pipeline.list_csv_files`, so the counts of files
+    validated from other folders are left out
     """
     def run(self):
         """
         """
-        working_folder = get_working_folder()
-        paths_to_count = [os.path.join(working_folder, 'files', 'cleancsv')]
-        with self.input().open('r') as list_of_archives:
-
-            for archive in list_of_archives:
-                filename = os.path.basename(archive)
-                #Remove extension
-                name, ext = os.path.splitext(filename)
-                # count lines of each file in each unzipped archive stored in
-                # LUIGIWORK/files/unzipped/<name>
-                path = os.path.join(working_folder, 'files', 'unzipped', name)
-                LOGGER.debug("Input path: {}".format(path))
-                if str(ext).strip() == '.zip':
-                    paths_to_count.append(path)
-        yield [CountLines(countable_path) for countable_path in paths_to_count]
-
+        csvfiles = [csvfile
+                    for archive in self.requires().list_archives()
+                    for csvfile in list_csv_files(archive)]
+        LOGGER.debug("Gathering counts of {}".format(csvfiles))
         with self.output().open('w') as outfile:
-            for countable_path in paths_to_count:
-                outfile.write("{}\n".format(countable_path))
+            writer = csv.writer(outfile)
+            for csvfile in sorted(csvfiles, key=os.path.basename):
+                stats_file = get_stats_file(csvfile)
+                if not os.path.exists(stats_file):
+                    LOGGER.warning("No counts were saved when validating "
+                                   "{}".format(csvfile))
+                    continue
+                counts = ValidationCounts.load(stats_file)
+                writer.writerow([os.path.basename(csvfile), counts.raw,
+                                 counts.invalid, counts.dirty, counts.clean])
 
     def output(self):
         rootdir = get_working_folder()
-        output_folder = os.path.join(rootdir,'tmp', 'countraw', 'got_all_counts.txt')
+        output_folder = os.path.join(rootdir, 'tmp', 'countraw',
+                                     'got_all_counts.txt')
         return luigi.file.LocalTarget(output_folder)
 
 
-@requires(GetZipArchive)
-class CountLines(luigi.Task):
-    """Counts the number of lines for all the csvfiles in a folder
-
-    Writes all the counts and filenames to a delimited file with the name of the
-    folder
-
-    Arguments
-    =========
-    folder_name : str
-        The absolute path of the csv file
-
-    """
-
-    def run(self):
-        """Runs the bash program `wc` to count the number of lines
+class DoIt(PooledConnectionMixin, PostgresQuery):
+    """Writes the counts of all the files into ``ais_sources``
 
-        """
-        input_names = glob(self.input().fn + '/*')
-        output_name = self.output().fn
-        LOGGER.debug('Counting lines in {} and saving to {}'.format(input_names, output_name))
-        (wc['-l', input_names] > output_name)()
-
-    def output(self):
-        """Outputs the files into a folder of the same name as the zip file
-
-        The files are placed in a subdirectory of ``LUIGIWORK`` called ``tmp/countraw``
-        """
-        out_folder_name = os.path.basename(self.input().fn)
-        rootdir = get_working_folder()
-        output_folder = os.path.join(rootdir,'tmp', 'countraw', out_folder_name + ".csv")
-        return luigi.file.LocalTarget(output_folder)
-
-
-class DoIt(luigi.Task):
-    """
+    The counts are copied into a temporary table, from which all the rows of
+    ``ais_sources`` are updated in a single statement and transaction,
+    together with the marker of this task
     """
     folder_of_zips = luigi.Parameter(significant=True)
     with_db = luigi.BoolParameter(significant=False)
 
+    host = get_environment_variable('DBHOSTNAME')
+    database = get_environment_variable('DBNAME')
+    user = get_environment_variable('DBUSER')
+    password = get_environment_variable('DBUSERPASS')
+    table = 'ais_sources'
+    query = "UPDATE ais_sources " \
+            "SET clean = counts.clean, dirty = counts.dirty, " \
+            "invalid = counts.invalid " \
+            "FROM source_counts AS counts " \
+            "WHERE ais_sources.filename = counts.filename;"
+
+    @property
+    def update_id(self):
+        return self.task_id
+
     def requires(self):
         return GetCountsForAllFiles(self.folder_of_zips, self.with_db)
 
     def run(self):
-        working_folder = get_working_folder()
-        count_folder = os.path.join(working_folder, 'tmp', 'countraw')
-        clean_path = os.path.join(count_folder, 'cleancsv.csv')
-
-        countfiles = os.listdir(count_folder)
-        LOGGER.debug("Files in tmp/countraw: {}".format(countfiles))
-        filtered_countfiles = [a for a in countfiles if (a != 'cleancsv.csv' and a.endswith('.csv'))]
-        LOGGER.debug("Files in tmp/countraw after filtering: {}".format(filtered_countfiles))
-        if len(filtered_countfiles) == 0:
-            raise RuntimeError("No counted files available")
+        if os.path.getsize(self.input().fn) == 0:
             LOGGER.error("No counted files available")
+            raise RuntimeError("No counted files available")
 
-        clean_results = {}
-        raw_results = {}
-        counts = []
-        with open(clean_path, 'r') as clean_counts_file:
-            for row in clean_counts_file:
-                LOGGER.debug(row.strip().split(" "))
-                count, filename = row.strip().split(" ")
-                just_filename = os.path.basename(filename)
-                clean_results[just_filename] = int(count)
-
-        for filename in filtered_countfiles:
-            results_file = os.path.join(count_folder, filename)
-            with open(results_file, 'r') as open_results_file:
-                for row in open_results_file:
-                    LOGGER.debug(row.strip().split(" "))
-                    count, filename = row.strip().split(" ")
-                    just_filename = os.path.basename(filename)
-                    raw_results[just_filename] = int(count)
-        _ = raw_results.pop('total')
-        _ = clean_results.pop('total')
-        LOGGER.debug("Keys: {}; {}".format(raw_results.keys(), clean_results.keys()))
-        for filename in raw_results.keys():
-            clean = clean_results[filename]
-            dirty = raw_results[filename] - clean
-            # filepath = os.path.join(working_folder, 'files', 'unzipped', filename)
-            counts.append((filename, clean, dirty))
-        LOGGER.debug("Counts of file {}".format(counts))
-
-        queries = [("UPDATE ais_sources "\
-                   "SET clean = {}, dirty = {} " \
-                   "WHERE filename = '{}';".format(clean_count,
-                                                   dirty_count,
-                                                   filename), filename)
-                   for (filename, clean_count, dirty_count) in counts ]
-        table = 'ais_sources'
-        yield [RunQueryOnTable(query, table, id) for query, id in queries]
-
-        with self.output().open('w') as outfile:
-            outfile.write("Done")
+        connection = self.output().connect()
+        cursor = connection.cursor()
+        cursor.execute("CREATE TEMPORARY TABLE source_counts "
+                       "(filename text, raw integer, "
+                       "invalid integer, dirty integer, clean integer) "
+                       "ON COMMIT DROP;")
+        with self.input().open('r') as counts_file:
+            cursor.copy_expert("COPY source_counts FROM STDIN WITH "
+                               "(FORMAT csv)", counts_file)
+        cursor.execute("ANALYZE source_counts;")
+
+        LOGGER.info('Executing query from task: {name}'.format(
+            name=self.__class__))
+        cursor.execute(self.query)
+        LOGGER.info("Updated the counts of {} files in ais_sources".format(
+            cursor.rowcount))
 
-    def output(self):
-        working_folder = get_working_folder()
-        path = os.path.join(working_folder, 'tmp', 'database', 'reports.txt')
-        return luigi.file.LocalTarget(path)
+        # Update marker table
+        self.output().touch(connection)
 
+        # commit and close connection
+        connection.commit()
+        connection.close()
 
 
 @requires(DoIt)
-class ProduceStatisticsReport(PostgresQuery):
+class ProduceStatisticsReport(PooledConnectionMixin, PostgresQuery):
     """Produces a report of the data statistics
     """
     host = get_environment_variable('DBHOSTNAME')
     database = get_environment_variable('DBNAME')
     user = get_environment_variable('DBUSER')
     password = get_environment_variable('DBUSERPASS')
-    query = "SELECT filename, clean, dirty, round(1.0*dirty/(clean+dirty), 2) " \
+    query = "SELECT filename, clean, dirty, invalid, " \
+            "round(1.0*(dirty+invalid)/NULLIF(clean+dirty+invalid, 0), 2) " \
             "AS coverage FROM ais_sources ORDER BY filename ASC;"
     table = 'ais_sources'
     update_id = 'stats_report'
@@ -187,14 +154,17 @@ class ProduceStatisticsReport(PostgresQuery):
         cursor = connection.cursor()
         sql = self.query
 
-        LOGGER.info('Executing query from task: {name}'.format(name=self.__class__))
+        LOGGER.info('Executing query from task: {name}'.format(
+            name=self.__class__))
         cursor.execute(sql)
         working_folder = get_working_folder()
         path = os.path.join(working_folder, 'files', 'data_statistics.csv')
         with open(path, 'w') as report_file:
-            report_file.write("{} {} {} {}".format('filename', 'clean', 'dirty', 'coverage'))
-            for filename, clean, dirty, coverage in cursor.fetchall():
-                report_file.write("{} {} {} {}".format(filename, clean, dirty, coverage))
+            report_file.write("{} {} {} {} {}\n".format(
+                'filename', 'clean', 'dirty', 'invalid', 'coverage'))
+            for filename, clean, dirty, invalid, coverage in cursor.fetchall():
+                report_file.write("{} {} {} {} {}\n".format(
+                    filename, clean, dirty, invalid, coverage))
 
         # Update marker table
         self.output().touch(connection)
@@ -1,10 +1,33 @@
 """Contains the code for validating AIS messages
 """
+import collections
 import csv
+import hashlib
+import io
+import json
+import locale
+import multiprocessing
+import os
+import queue
+import re
+import shutil
 import sys
+import threading
+import zipfile
+from contextlib import contextmanager
+from operator import itemgetter
 from pyrate.algorithms.aisparser import parse_raw_row, \
                                         AIS_CSV_COLUMNS, \
                                         validate_row
+from superpyrate.vectorised import write_valid_blocks, CHUNKSIZE
+from superpyrate.pgcopy import BinaryCopyWriter
+from superpyrate.columnar import ParquetWriter
+from superpyrate.compact import write_valid_compact, salvage_values
+from superpyrate.stats import ValidationCounts, MAX_EXAMPLES, CSV_ERROR, \
+                              UNICODE_ERROR, COLUMN_COUNT, PARSE_ERROR, \
+                              MISSING_VALUE, VALIDATION, WRITE_ERROR
+from superpyrate.partitions import PartitionRouter
+from superpyrate.intermediates import open_intermediate, is_compressed
 # from exactVerify.ais_import.algorithms.exact_verifyparser import readcsv
 import logging
 from fuzzywuzzy import process as fuzz_proc
@@ -30,6 +53,24 @@ FORCED_COL_MAP = {'MMSI': 'MMSI',
                   'ETA_hour': 'ETA_hour',
                   'ETA_minute': 'ETA_minute'}
 
+#: Files larger than this many bytes are split and validated in parallel
+PARALLEL_THRESHOLD = 1024 ** 3
+
+#: The columns of the file of rejected rows, see
+#: :py:func:`produce_valid_csv_file`
+REJECTED_COLUMNS = AIS_CSV_COLUMNS + ['reason']
+
+#: The column indices resolved for each distinct header, by fingerprint
+HEADER_CACHE = {}
+
+#: How csv files are decoded.  Bytes which cannot be decoded are kept as lone
+#: surrogates, and the record holding them is rejected by
+#: :py:func:`unfussy_reader`, however the file was split into chunks or ranges
+DECODE_ERRORS = 'surrogateescape'
+
+#: Matches the lone surrogates which stand for bytes which could not be decoded
+UNDECODABLE = re.compile('[\udc80-\udcff]')
+
 
 def learn_columns(read_cols, required_cols, csv_or_xml='csv'):
     """Tries to match the read columns with the list given
@@ -51,105 +92,504 @@ def learn_columns(read_cols, required_cols, csv_or_xml='csv'):
         return read_cols
 
 
-def produce_valid_csv_file(inputf, outputf):
+def list_zip_members(zip_file, extension='.csv'):
+    """Lists the members of a zipped archive with the given extension
+
+    Only the central directory of the archive is read, so nothing is
+    decompressed.
+
+    Arguments
+    ---------
+    zip_file : str
+        File path to a zipped archive of AIS csv files
+    extension : str, default='.csv'
+        Only members with this file extension are returned
+
+    Returns
+    -------
+    list
+        The names of the members, as stored in the archive
+    """
+    with zipfile.ZipFile(zip_file) as archive:
+        return [info.filename for info in archive.infolist()
+                if os.path.splitext(info.filename)[1] == extension]
+
+
+class HashingReader(io.RawIOBase):
+    """Passes on the bytes read from a binary file object, updating a hash
+    with them as they are read
+
+    Arguments
+    ---------
+    raw : file object
+        An open binary file object
+    digest :
+        A hash object of :py:mod:`hashlib`
+    """
+
+    def __init__(self, raw, digest):
+        self.raw = raw
+        self.digest = digest
+
+    @property
+    def name(self):
+        return self.raw.name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.raw.readinto(buffer)
+        self.digest.update(memoryview(buffer)[:size])
+        return size
+
+
+@contextmanager
+def open_zip_member(zip_file, member_name, digest=None):
+    """Opens a member of a zipped archive as a decompressing text file object
+
+    The member is looked up by its exact name within the archive, such as the
+    ``member`` of a csv file in the plan of the archive (see
+    :py:mod:`superpyrate.planning`), which names the same member as ``7za e``
+    extracts when several in different folders share a file name.
+
+    Arguments
+    ---------
+    zip_file : str
+        File path to a zipped archive of AIS csv files
+    member_name : str
+        The name of the csv file in the archive, including any folder
+    digest : default=None
+        If given, a hash object of :py:mod:`hashlib` which is updated with the
+        uncompressed bytes of the member as they are read.  Whatever was not
+        read is hashed once the file is closed without an error, so the hash
+        is then that of the whole member
+
+    Yields
+    ------
+    TextIOWrapper
+        A text file object which decompresses the member as it is read
+    """
+    with zipfile.ZipFile(zip_file) as archive:
+        with archive.open(member_name) as member:
+            if digest is None:
+                yield io.TextIOWrapper(member, errors=DECODE_ERRORS)
+            else:
+                reader = HashingReader(member, digest)
+                yield io.TextIOWrapper(io.BufferedReader(reader),
+                                       errors=DECODE_ERRORS)
+                for block in iter(lambda: member.read(io.DEFAULT_BUFFER_SIZE),
+                                  b''):
+                    digest.update(block)
+
+
+@contextmanager
+def open_csv_file(csvfile, mode='r'):
+    """Opens ``csvfile`` if it is a file path, otherwise passes it through
+
+    Arguments
+    ---------
+    csvfile : str or file object
+        File path to a csv file, or an already open text file object.  A
+        file path ending with ``.gz`` is compressed or decompressed as it is
+        written or read, see :py:mod:`superpyrate.intermediates`
+    mode : str, default='r'
+        The mode in which to open a file path.  Files read as text are
+        decoded with ``DECODE_ERRORS``
+    """
+    if isinstance(csvfile, str):
+        kwargs = {'errors': DECODE_ERRORS} if mode == 'r' else {}
+        with open_intermediate(csvfile, mode, **kwargs) as open_file:
+            yield open_file
+    else:
+        yield csvfile
+
+
+@contextmanager
+def open_rejects(dirty_file, header=True):
+    """Opens a csv writer for the rejected rows, or yields None if no file is
+    given
+
+    Arguments
+    ---------
+    dirty_file : str or file object
+        File path of the file of rejected rows, an open text file object or
+        None
+    header : bool, default=True
+        Whether to write the header of the ``REJECTED_COLUMNS``
+    """
+    if not dirty_file:
+        yield None
+        return
+    with open_csv_file(dirty_file, 'w') as open_file:
+        rejects = csv.writer(open_file, dialect="excel")
+        if header:
+            rejects.writerow(REJECTED_COLUMNS)
+        yield rejects
+
+
+class BoundedPipe(object):
+    """A bounded in-memory pipe of text or bytes from a writing to a reading
+    thread
+
+    Text written to the pipe is gathered into chunks of ``chunk_size``
+    characters.  At most ``max_chunks`` chunks are held at once, and the writer
+    blocks until the reader catches up, so the memory used is bounded however
+    much text passes through.
+
+    The writer calls :py:meth:`close` when done, and the reader then reads
+    to the end of the pipe.  A reader which gives up calls :py:meth:`abort`,
+    after which writes raise :py:class:`BrokenPipeError`.
+
+    Arguments
+    ---------
+    chunk_size : int, default=65536
+    max_chunks : int, default=16
+    binary : bool, default=False
+        Whether bytes, rather than text, pass through the pipe
     """
+    def __init__(self, chunk_size=65536, max_chunks=16, binary=False):
+        self.chunk_size = chunk_size
+        self.empty = b'' if binary else ''
+        self.chunks = queue.Queue(max_chunks)
+        self.aborted = threading.Event()
+        self.pending = []
+        self.pending_size = 0
+        self.buffer = self.empty
+        self.position = 0
+        self.finished = False
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.chunk_size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            self.put(self.empty.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def put(self, chunk):
+        while not self.aborted.is_set():
+            try:
+                self.chunks.put(chunk, timeout=1)
+            except queue.Full:
+                continue
+            else:
+                return
+        raise BrokenPipeError("The reader of the pipe has stopped")
+
+    def close(self):
+        """Called by the writer once all text has been written
+        """
+        self.flush()
+        self.put(None)
+
+    def abort(self):
+        """Called by the reader to stop the writer
+        """
+        self.aborted.set()
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self.position == len(self.buffer):
+                if self.finished:
+                    break
+                chunk = self.chunks.get()
+                if chunk is None:
+                    self.finished = True
+                    break
+                self.buffer, self.position = chunk, 0
+            end = len(self.buffer) if size < 0 else self.position + size
+            piece = self.buffer[self.position:end]
+            self.position += len(piece)
+            if size > 0:
+                size -= len(piece)
+            pieces.append(piece)
+        return self.empty.join(pieces)
+
+
+class PipeWriterThread(threading.Thread):
+    """Runs ``target(pipe)`` in a thread, closing the pipe when it returns
+
+    Any exception raised by ``target`` is kept in ``error`` for the reading
+    thread to raise.
+    """
+    def __init__(self, target, pipe):
+        super().__init__()
+        self.target = target
+        self.pipe = pipe
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(self.pipe)
+        except BaseException as error:
+            self.error = error
+        finally:
+            try:
+                self.pipe.close()
+            except BrokenPipeError:
+                pass
+
+
+def produce_valid_csv_file(inputf, outputf, engine='row', chunksize=CHUNKSIZE,
+                           processes=1, parallel_threshold=PARALLEL_THRESHOLD,
+                           column_types=None, encoding='utf-8',
+                           stats_file=None, max_examples=MAX_EXAMPLES,
+                           dirty_file=None, output_format='csv'):
+    """Validates a csv file of AIS data, writing the valid rows
 
     Arguments
     ---------
     input_file :
-        File path to a large CSV file of AIS data
+        File path to a large CSV file of AIS data, or an open text file
+        object such as one returned by :py:func:`open_zip_member`
     output_file :
-        File path for a CSV file containing validated and cleaned data
+        File path for a CSV file containing validated and cleaned data, or
+        an open text file object such as a :py:class:`BoundedPipe`.  A
+        binary file object if ``column_types`` is given, or if
+        ``output_format`` is ``'parquet'``.  Or a
+        :py:class:`~superpyrate.partitions.PartitionRouter`, which writes the
+        rows of each month to a file of their own
+    engine : str, default='row'
+        ``'row'`` parses, validates and writes one row at a time, while
+        ``'numpy'`` does so in blocks of rows using
+        :py:mod:`superpyrate.vectorised`.  ``'compact'`` works one row at a
+        time without building dictionaries, using
+        :py:mod:`superpyrate.compact`.  All write identical files.
+    chunksize : int, default=CHUNKSIZE
+        The number of rows in each block of the ``'numpy'`` engine
+    processes : int, default=1
+        The number of processes used to validate a file larger than
+        ``parallel_threshold``, with ``None`` or ``0`` using all cores.  The
+        default of ``1`` turns off parallel validation, as luigi may already
+        be running a worker on each core.  Compressed files are always
+        validated in a single process
+    parallel_threshold : int, default=PARALLEL_THRESHOLD
+        The size in bytes above which a file path is validated in parallel
+        by :py:func:`produce_valid_csv_file_parallel`
+    column_types : list, default=None
+        The postgres type of each of the ``AIS_CSV_COLUMNS``.  If given, the
+        valid rows are written in the binary ``COPY`` format of
+        :py:mod:`superpyrate.pgcopy` rather than as csv
+    encoding : str, default='utf-8'
+        The encoding of text fields in the binary ``COPY`` format
+    stats_file : str, default=None
+        If given, the counts of the records read, rejected and written are
+        saved to this json file, see :py:mod:`superpyrate.stats`
+    max_examples : int, default=MAX_EXAMPLES
+        The number of rejected records logged for each category of error.
+        The others are only counted, and summarised once the file has been
+        validated
+    dirty_file : str, default=None
+        File path for a csv file, or an open text file object, to which the
+        rows which could be read but were rejected are written in the same
+        pass.  Each row holds the ``AIS_CSV_COLUMNS`` converted as far as
+        possible, with null in place of values which could not be, and a
+        ``reason`` which is one of the categories of
+        :py:mod:`superpyrate.stats`
+    output_format : str, default='csv'
+        ``'parquet'`` writes the valid rows to a typed and compressed
+        columnar file with :py:mod:`superpyrate.columnar`, rather than as
+        csv.  Such files are always validated in a single process
+
+    Returns
+    -------
+    superpyrate.stats.ValidationCounts
+        The counts of the records read, rejected and written
     """
-    LOGGER.info("Processing {}".format(inputf))
+    LOGGER.info("Processing {}".format(getattr(inputf, 'name', inputf)))
     # Read input_file
     # try:
     columns = AIS_CSV_COLUMNS
 
-    with open(inputf, 'rU') as input_file:
+    if engine not in ('row', 'numpy', 'compact'):
+        raise ValueError("Unknown validation engine: {}".format(engine))
+    if output_format not in ('csv', 'parquet'):
+        raise ValueError("Unknown output format: {}".format(output_format))
+    if output_format == 'parquet' and column_types is not None:
+        raise ValueError("The parquet output format cannot be used with "
+                         "column_types")
+
+    processes = processes or os.cpu_count()
+    if processes > 1 and column_types is None and output_format == 'csv' and \
+            isinstance(inputf, str) and not is_compressed(inputf) and \
+            not is_compressed(outputf) and not is_compressed(dirty_file) and \
+            isinstance(outputf, str) and \
+            (dirty_file is None or isinstance(dirty_file, str)) and \
+            os.path.getsize(inputf) > parallel_threshold:
+        counts = produce_valid_csv_file_parallel(inputf, outputf, engine,
+                                                 chunksize, processes,
+                                                 max_examples, dirty_file)
+        LOGGER.info(counts.summary(inputf))
+        if stats_file:
+            counts.save(stats_file)
+        return counts
+
+    counts = ValidationCounts(max_examples=max_examples)
+    with open_csv_file(inputf) as input_file, \
+            open_rejects(dirty_file) as rejects:
         # Do validation and write a new file of valid messages
-        with open(outputf, 'w') as output_file:
-            writer = csv.DictWriter(output_file,
-                                    dialect="excel",
-                                    fieldnames=columns)
-            writer.writeheader()
+        binary = column_types is not None or output_format == 'parquet'
+        mode = 'wb' if binary else 'w'
+        with open_csv_file(outputf, mode) as output_file:
+            if isinstance(output_file, PartitionRouter):
+                writer = output_file
+            elif output_format == 'parquet':
+                writer = ParquetWriter(output_file)
+            elif column_types is None:
+                writer = csv.writer(output_file, dialect="excel")
+                writer.writerow(columns)
+            else:
+                writer = BinaryCopyWriter(output_file, column_types, encoding)
 
             # parse and iterate lines from the current file
             LOGGER.debug("Building the reader")
-            reader = unfussy_reader(readcsv(input_file,
-                                            forced_col_map=FORCED_COL_MAP,
-                                            columns=columns))
-            LOGGER.debug("Iterating over the reader")
-            for row in reader:
-                if len(row) > 0:
-                    converted_row = {}
+            rows = readrows(input_file,
+                            forced_col_map=FORCED_COL_MAP,
+                            columns=columns,
+                            counts=counts)
+            write_valid_rows(rows, writer, engine, chunksize, counts, rejects)
+            if binary:
+                writer.finish()
+    LOGGER.info(counts.summary(getattr(inputf, 'name', inputf)))
+    if stats_file:
+        counts.save(stats_file)
+    return counts
+
+
+def write_valid_rows(rows, writer, engine='row', chunksize=CHUNKSIZE,
+                     counts=None, rejects=None):
+    """Validates rows of raw values and writes the valid rows
+
+    Arguments
+    ---------
+    rows : iterable
+        Tuples of the raw values of the ``AIS_CSV_COLUMNS``, or empty tuples
+        for rows which could not be read, as yielded by :py:func:`readrows`
+    writer : csv.writer or superpyrate.pgcopy.BinaryCopyWriter
+        The writer to which the valid rows are written as lists of the
+        ``AIS_CSV_COLUMNS``
+    engine : str, default='row'
+        One of ``'row'``, ``'numpy'`` or ``'compact'``
+    chunksize : int, default=CHUNKSIZE
+        The number of rows in each block of the ``'numpy'`` engine
+    counts : superpyrate.stats.ValidationCounts, default=None
+        Counts of the rows read, rejected and written, which are added to
+    rejects : csv.writer, default=None
+        If given, the rows which could be read but were rejected are written
+        to it, as by :py:func:`superpyrate.compact.salvage_values`, followed
+        by the reason for their rejection
+    """
+    columns = AIS_CSV_COLUMNS
+    if counts is None:
+        counts = ValidationCounts()
+    rows = counts.count_raw(rows)
+
+    if engine == 'numpy':
+        write_valid_blocks(rows, writer, chunksize, counts, rejects)
+        return
+    elif engine == 'compact':
+        write_valid_compact(rows, writer, chunksize, counts, rejects)
+        return
+
+    LOGGER.debug("Iterating over the reader")
+    for values in rows:
+        row = dict(zip(columns, values))
+        if len(row) > 0:
+            converted_row = {}
+            try:
+                converted_row = parse_raw_row(row)
+            except ValueError as e:
+                # invalid data in row. Write it to error log
+                counts.reject(PARSE_ERROR, "Invalid data in row {}: {}",
+                              values, e)
+                if rejects is not None:
+                    rejects.writerow(salvage_values(values) + [PARSE_ERROR])
+                continue
+            except KeyError as e:
+                counts.reject(MISSING_VALUE, "Missing data in row {}: {}",
+                              values, e)
+                if rejects is not None:
+                    rejects.writerow(salvage_values(values) + [MISSING_VALUE])
+                continue
+            else:
+                # validate parsed row
+                try:
+                    validated_row = validate_row(converted_row)
+                except ValueError as e:
+                    counts.reject(VALIDATION, "Error in validating the "
+                                  "converted row {}: {}", values, e)
+                    if rejects is not None:
+                        rejects.writerow(salvage_values(values) + [VALIDATION])
+                else:
                     try:
-                        converted_row = parse_raw_row(row)
-                    except ValueError as e:
-                        # invalid data in row. Write it to error log
-                        LOGGER.error("Invalid data in row: {}".format(e))
+                        # LOGGER.debug("Attempting writing validated data "
+                        #              "to file.")
+                        writer.writerow([validated_row.get(col)
+                                         for col in columns])
+                    except ValueError as ve:
+                        counts.reject(WRITE_ERROR, "Error in writing "
+                                      "validated row {} to csvfile: {}",
+                                      values, ve)
+                        if rejects is not None:
+                            rejects.writerow(salvage_values(values) +
+                                             [WRITE_ERROR])
                         continue
-                    except KeyError as e:
-                        LOGGER.error("Missing data in row: {}".format(e))
-                        continue
-                    else:
-                        # validate parsed row
-                        try:
-                            validated_row = validate_row(converted_row)
-                        except ValueError as e:
-                            LOGGER.error("Error in validating the convered row: {}".format(e))
-                        else:
-                            try:
-                                # LOGGER.debug("Attempting writing validated data to file.")
-                                writer.writerow(validated_row)
-                            except ValueError as ve:
-                                LOGGER.error("Error in writing validated row to csvfile: {}".format(ve))
-                                continue
-                else:
-                    LOGGER.info("Illegal row, so not writing to file.")
+                    counts.clean += 1
+        else:
+            # The error has been counted by category as the row was read
+            counts.invalid += 1
 
-def unfussy_reader(csv_reader):
-    """
+def unfussy_reader(csv_reader, counts=None):
+    """Yields the rows of a csv reader, or None for each record which could
+    not be read
+
+    A record is also not read if it holds bytes which could not be decoded,
+    as left by ``DECODE_ERRORS``.  So such records are rejected one by one,
+    rather than with the rest of the chunk of the file being decoded.
+
+    Arguments
+    ---------
+    csv_reader : csv.reader
+    counts : superpyrate.stats.ValidationCounts, default=None
+        The errors in reading records are counted in here by category
     """
+    if counts is None:
+        counts = ValidationCounts()
     while True:
         try:
-            yield next(csv_reader)
+            row = next(csv_reader)
+        except StopIteration:
+            return
         # Catch csv field size limit exceeded error
         except csv.Error as ce:
-            LOGGER.error('CSV Error: {} on line {}'.format(ce, csv_reader.line_num))
-            yield {}
+            counts.record_error(CSV_ERROR, 'CSV Error: {} on line {}', ce,
+                                csv_reader.line_num)
+            yield None
             continue
         # catch 'ascii' decode error
         except UnicodeDecodeError as ude:
-            LOGGER.error('CSV Error: {} on line {}'.format(ude, csv_reader.line_num))
-            yield {}
+            counts.record_error(UNICODE_ERROR, 'CSV Error: {} on line {}', ude,
+                                csv_reader.line_num)
+            yield None
             continue
+        record = ''.join(row)
+        if not record.isascii() and UNDECODABLE.search(record):
+            counts.record_error(UNICODE_ERROR,
+                                'CSV Error: undecodable bytes on line {}',
+                                csv_reader.line_num)
+            yield None
+            continue
+        yield row
 
-def readcsv(fp, forced_col_map=None, columns=None):
-    """Yields a dctionary of the subset of columns required
-
-    Reads each line in CSV file, checks if all columns are available,
-    and returns a dictionary of the subset of columns required
-    (as per AIS_CSV_COLUMNS).
-
-    If row is invalid (too few columns),
-    returns an empty dictionary.
-
-    Arguments
-    ---------
-    fp : TextIOWrapper
-        An open TextIOWrapper (returned by `open()`)
-    forced_col_map : dict
-        A dictionary mapping the keys defined in columns to
-        columns with different names
-    columns : dict, default=AIS_CSV_COLUMNS
-        A dictionary of columns
-
-    Yields
-    ------
-    rowsubset : dict
-        A dictionary of the subset of columns as per `columns`
-
+def maximise_field_size_limit():
+    """Raises the csv field size limit to the largest value the platform allows
     """
     max_int = sys.maxsize
     decrement = True
@@ -163,13 +603,28 @@ def readcsv(fp, forced_col_map=None, columns=None):
             max_int = int(max_int / 10)
             decrement = True
 
-    # first line is column headers. Use to extract indices of columns
-    # we are extracting
-    cols = fp.readline().strip('\r\n').split(',')
-    LOGGER.info("There are {} columns in {}".format(len(cols), fp.name))
+
+def map_columns(cols, columns, forced_col_map):
+    """Finds the index in the csv header of each of the required columns
+
+    Arguments
+    ---------
+    cols : list
+        The column names read from the header of the csv file
+    columns : list
+        The columns required from the csv file
+    forced_col_map : dict
+        A dictionary mapping the keys defined in columns to
+        columns with different names
+
+    Returns
+    -------
+    indices : dict
+        A dictionary of the index in ``cols`` of each of ``columns``
+    """
     indices = {}
-    auto_col_map = learn_columns(cols, columns)
-    # LOGGER.debug("{}".format(auto_col_map))
+    # Fuzzy matching is slow, so is only done if a column cannot be found
+    auto_col_map = None
     used_map = {}
 
     for col in columns:
@@ -181,6 +636,7 @@ def readcsv(fp, forced_col_map=None, columns=None):
                 LOGGER.warning("{}, {}".format(forced_col_map, col))
                 LOGGER.warning(cols)
                 LOGGER.warning("Error mapping columns: {}".format(repr(e0)))
+                auto_col_map = auto_col_map or learn_columns(cols, columns)
                 if auto_col_map[col][1] >= 95:
                     indices[col] = cols.index(auto_col_map[col][0])
                     used_map.update({col: auto_col_map[col][0]})
@@ -195,6 +651,7 @@ def readcsv(fp, forced_col_map=None, columns=None):
                 used_map.update({col: col})
             except Exception as e1:
                 LOGGER.warning("Error mapping columns: {}".format(repr(e1)))
+                auto_col_map = auto_col_map or learn_columns(cols, columns)
                 if auto_col_map[col][1] >= 95:
                     indices[col] = cols.index(auto_col_map[col][0])
                     used_map.update({col: auto_col_map[col][0]})
@@ -214,22 +671,510 @@ def readcsv(fp, forced_col_map=None, columns=None):
         "Using the following column mapping (required:read): {}".
         format(used_map))
 
-    unfussy = unfussy_reader(csv.reader(fp, delimiter=',', quotechar='"'))
+    return indices
+
+
+def get_header_cache_folder():
+    """Returns the folder ``tmp/headers`` of ``LUIGIWORK``, if it is set
+    """
+    working_folder = os.environ.get('LUIGIWORK')
+    if working_folder:
+        return os.path.join(working_folder, 'tmp', 'headers')
+    return None
+
+
+def cached_map_columns(cols, columns, forced_col_map):
+    """Finds the index of each of the required columns, caching the result
+
+    The indices found by :py:func:`map_columns` are cached by a fingerprint of
+    the header, the required columns and ``forced_col_map``, both in memory
+    and as a json file in the folder ``tmp/headers`` of ``LUIGIWORK``.  So
+    each distinct header is only mapped once, however many files share it.
+
+    Arguments
+    ---------
+    cols : list
+        The column names read from the header of the csv file
+    columns : list
+        The columns required from the csv file
+    forced_col_map : dict
+        A dictionary mapping the keys defined in columns to
+        columns with different names
+
+    Returns
+    -------
+    indices : dict
+        A dictionary of the index in ``cols`` of each of ``columns``
+    """
+    key = json.dumps([cols, columns, sorted(forced_col_map.items())])
+    fingerprint = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    if fingerprint in HEADER_CACHE:
+        return HEADER_CACHE[fingerprint]
+
+    folder = get_header_cache_folder()
+    path = os.path.join(folder, fingerprint + '.json') if folder else None
+    indices = None
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r') as cache_file:
+                indices = json.load(cache_file)
+        except (OSError, ValueError) as error:
+            LOGGER.warning("Ignoring header cache {}: {}".format(path, error))
+        if not (isinstance(indices, dict) and
+                all(isinstance(indices.get(col), int) and
+                    0 <= indices[col] < len(cols) for col in columns)):
+            indices = None
+
+    if indices is None:
+        indices = map_columns(cols, columns, forced_col_map)
+        if path:
+            os.makedirs(folder, exist_ok=True)
+            # Written under a temporary name so that other processes never
+            # read a partly written file
+            temporary_path = '{}.{}'.format(path, os.getpid())
+            with open(temporary_path, 'w') as cache_file:
+                json.dump(indices, cache_file)
+            os.replace(temporary_path, path)
+
+    HEADER_CACHE[fingerprint] = indices
+    return indices
+
+
+def readrows(fp, forced_col_map=None, columns=None, counts=None):
+    """Yields a tuple of the raw values of the subset of columns required
+
+    Reads each line in CSV file, checks if all columns are available,
+    and returns a tuple of the values of the subset of columns required
+    (as per AIS_CSV_COLUMNS), in the order given by ``columns``.
+
+    If row is invalid (too few columns),
+    returns an empty tuple.
+
+    Arguments
+    ---------
+    fp : TextIOWrapper
+        An open TextIOWrapper (returned by `open()`)
+    forced_col_map : dict
+        A dictionary mapping the keys defined in columns to
+        columns with different names
+    columns : list, default=AIS_CSV_COLUMNS
+        A list of columns
+    counts : superpyrate.stats.ValidationCounts, default=None
+        The records which cannot be read are counted in here by category
+
+    Yields
+    ------
+    values : tuple
+        The raw values of the subset of columns as per `columns`
+    """
+    maximise_field_size_limit()
+
+    # first line is column headers. Use to extract indices of columns
+    # we are extracting
+    header = fp.readline()
+    number_of_columns, column_indices = read_header(header, fp.name,
+                                                    forced_col_map, columns)
+
+    if counts is None:
+        counts = ValidationCounts()
+    unfussy = unfussy_reader(csv.reader(fp, delimiter=',', quotechar='"'),
+                             counts)
+    for values in extract_columns(unfussy, number_of_columns, column_indices,
+                                  fp.name, counts):
+        yield values
+
+
+def read_header(header, name, forced_col_map, columns):
+    """Finds the columns required from the header line of a csv file
 
-    for row in unfussy:
-        # LOGGER.info("New row")
-        rowsubset = {}
+    Arguments
+    ---------
+    header : str
+        The first line of the csv file
+    name : str
+        The name of the csv file, used in log messages
+    forced_col_map : dict
+        A dictionary mapping the keys defined in columns to
+        columns with different names
+    columns : list
+        A list of the columns required
+
+    Returns
+    -------
+    number_of_columns : int
+        The number of columns in the csv file
+    column_indices : list
+        The index of each of ``columns`` in a row of the csv file
+    """
+    cols = header.strip('\r\n').split(',')
+    LOGGER.info("There are {} columns in {}".format(len(cols), name))
+    indices = cached_map_columns(cols, columns, forced_col_map)
+    return len(cols), [indices[col] for col in columns]
+
+
+def extract_columns(csv_rows, number_of_columns, column_indices, name,
+                    counts=None):
+    """Yields the raw values of the required columns from each csv row
+
+    Arguments
+    ---------
+    csv_rows : iterable
+        The rows of the csv file, as lists of strings
+    number_of_columns : int
+        The number of columns in the header of the csv file
+    column_indices : list
+        The index of each of the required columns
+    name : str
+        The name of the csv file, used in log messages
+    counts : superpyrate.stats.ValidationCounts, default=None
+        The rows with the wrong number of columns are counted in here
+
+    Yields
+    ------
+    values : tuple
+        The raw values of the required columns, or an empty tuple if the row
+        does not have the same number of columns as the header, or could not
+        be read
+    """
+    if counts is None:
+        counts = ValidationCounts()
+    extract = make_extractor(column_indices)
+    for row in csv_rows:
         # only try to process row if all columns are available
         # changed from >= to ==
-        if len(row) == len(cols):
-            for col in columns:
-                rowsubset[col] = row[indices[col]]  # raw column data
-            # LOGGER.debug("Legal row found: {}".format(rowsubset))
-            yield rowsubset
+        if row is None:
+            # The error has already been counted as the record was read
+            yield ()
+        elif len(row) == number_of_columns:
+            yield extract(row)  # raw column data
         else:
-            LOGGER.debug("""Expected column length doesn't match row in file: {}.
-                        Row is {}, column is {}""".format(fp.name, len(row), len(cols)))
-            yield rowsubset
+            counts.record_error(COLUMN_COUNT, "Expected column length doesn't "
+                                "match row in file: {}. Row is {}, column is "
+                                "{}", name, len(row), number_of_columns)
+            yield ()
+
+
+def make_extractor(column_indices):
+    """Returns a function which picks the values at ``column_indices`` from a
+    row as a tuple, using :py:func:`operator.itemgetter`
+    """
+    if len(column_indices) == 1:
+        index = column_indices[0]
+        return lambda row: (row[index],)
+    return itemgetter(*column_indices)
+
+
+def readcsv(fp, forced_col_map=None, columns=None):
+    """Yields a dctionary of the subset of columns required
+
+    Reads each line in CSV file, checks if all columns are available,
+    and returns a dictionary of the subset of columns required
+    (as per AIS_CSV_COLUMNS).
+
+    If row is invalid (too few columns),
+    returns an empty dictionary.
+
+    Arguments
+    ---------
+    fp : TextIOWrapper
+        An open TextIOWrapper (returned by `open()`)
+    forced_col_map : dict
+        A dictionary mapping the keys defined in columns to
+        columns with different names
+    columns : dict, default=AIS_CSV_COLUMNS
+        A dictionary of columns
+
+    Yields
+    ------
+    rowsubset : dict
+        A dictionary of the subset of columns as per `columns`
+
+    """
+    for values in readrows(fp, forced_col_map, columns):
+        yield dict(zip(columns, values))
+
+class ByteRangeLines(object):
+    """Iterates over the decoded lines of a binary file from a byte offset
+
+    Keeps track of the byte offset of the start of the next line, which is
+    the start of the next record when a csv reader is between records.
+
+    Lines end, and new lines are translated to ``\\n``, and bytes which
+    cannot be decoded are kept, as in a file opened in text mode with
+    universal newlines by :py:func:`open_csv_file`.  So the records read,
+    including new lines within quoted fields, and those rejected as they
+    cannot be decoded, are the same as those read from start to end by
+    :py:func:`produce_valid_csv_file`.
+
+    Arguments
+    ---------
+    binary_file : BufferedReader
+        A csv file opened in binary mode
+    offset : int
+        The byte offset at which to start reading
+    encoding : str
+        The encoding of the csv file
+    """
+    def __init__(self, binary_file, offset, encoding):
+        self.binary_file = binary_file
+        self.binary_file.seek(offset)
+        self.offset = offset
+        self.encoding = encoding
+        self.pending = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pending:
+            line = self.binary_file.readline()
+            if not line:
+                raise StopIteration
+            self.pending.extend(split_universal_lines(line))
+        line = self.pending.popleft()
+        self.offset += len(line)
+        if line.endswith(b'\r\n'):
+            line = line[:-2] + b'\n'
+        elif line.endswith(b'\r'):
+            line = line[:-1] + b'\n'
+        return line.decode(self.encoding, DECODE_ERRORS)
+
+
+def split_universal_lines(line):
+    """Splits a line read in binary mode at any carriage return not followed
+    by a line feed, which ends a line in universal newlines mode
+
+    Arguments
+    ---------
+    line : bytes
+        A line ending in ``\\n``, or at the end of the file
+
+    Returns
+    -------
+    list
+        The lines, each ending in ``\\r\\n``, ``\\r`` or ``\\n``, except
+        perhaps the last
+    """
+    lines = []
+    start = 0
+    position = line.find(b'\r')
+    while position != -1:
+        if line[position + 1:position + 2] != b'\n':
+            lines.append(line[start:position + 1])
+            start = position + 1
+        position = line.find(b'\r', position + 1)
+    lines.append(line[start:])
+    return [part for part in lines if part]
+
+
+def split_byte_ranges(inputf, start, parts):
+    """Splits a file into ranges of bytes which start at the start of a line
+
+    The ranges are only a first guess at record boundaries, as a line may
+    start within a quoted multi-line field.  See
+    :py:func:`produce_valid_csv_file_parallel`.
+
+    Arguments
+    ---------
+    inputf : str
+        File path to a csv file
+    start : int
+        The byte offset of the first record, after the header
+    parts : int
+        The number of ranges into which to split the file
+
+    Returns
+    -------
+    list
+        A list of (start, end) byte offsets
+    """
+    size = os.path.getsize(inputf)
+    step = (size - start) // parts
+    offsets = [start]
+    with open(inputf, 'rb') as binary_file:
+        for part in range(1, parts):
+            binary_file.seek(start + part * step)
+            binary_file.readline()
+            offset = binary_file.tell()
+            if offsets[-1] < offset < size:
+                offsets.append(offset)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def validate_byte_range(inputf, start, end, outputf, number_of_columns,
+                        column_indices, engine='row', chunksize=CHUNKSIZE,
+                        max_examples=MAX_EXAMPLES, dirty_outputf=None):
+    """Validates the records which start within a range of bytes of a csv file
+
+    Run in a worker process by :py:func:`produce_valid_csv_file_parallel`.
+    ``start`` must be the start of a record.  Records are read until the
+    first one which starts at or after ``end``, and the offset of that
+    record is returned.
+
+    Arguments
+    ---------
+    inputf : str
+        File path to a large CSV file of AIS data
+    start : int
+        The byte offset of the first record to validate
+    end : int
+        The byte offset at which to stop validating
+    outputf : str
+        File path to which the valid rows are written, without a header
+    number_of_columns : int
+        The number of columns in the header of the csv file
+    column_indices : list
+        The index of each of the ``AIS_CSV_COLUMNS`` in the csv file
+    engine : str, default='row'
+    chunksize : int, default=CHUNKSIZE
+    max_examples : int, default=MAX_EXAMPLES
+    dirty_outputf : str, default=None
+        If given, the file path to which the rejected rows are written,
+        without a header
+
+    Returns
+    -------
+    offset : int
+        The byte offset of the first record which was not validated
+    counts : superpyrate.stats.ValidationCounts
+        The counts of the records validated
+    """
+    maximise_field_size_limit()
+    encoding = locale.getpreferredencoding(False)
+    with open(inputf, 'rb') as binary_file:
+        lines = ByteRangeLines(binary_file, start, encoding)
+        counts = ValidationCounts(max_examples=max_examples)
+        unfussy = unfussy_reader(csv.reader(lines, delimiter=',',
+                                            quotechar='"'), counts)
+
+        def records_in_range():
+            while lines.offset < end:
+                try:
+                    yield next(unfussy)
+                except StopIteration:
+                    return
+
+        rows = extract_columns(records_in_range(), number_of_columns,
+                               column_indices, inputf, counts)
+        with open(outputf, 'w') as output_file, \
+                open_rejects(dirty_outputf, header=False) as rejects:
+            writer = csv.writer(output_file, dialect="excel")
+            write_valid_rows(rows, writer, engine, chunksize, counts, rejects)
+        return lines.offset, counts
+
+
+def produce_valid_csv_file_parallel(inputf, outputf, engine='row',
+                                    chunksize=CHUNKSIZE, processes=None,
+                                    max_examples=MAX_EXAMPLES,
+                                    dirty_file=None):
+    """Validates a large csv file by splitting it into ranges of bytes
+
+    Each range is validated in a pool of processes and the valid rows are
+    concatenated in order.  The ranges are split at the start of a line,
+    which may fall within a quoted multi-line field.  So each process also
+    reports where the first record after its range starts.  If the next range
+    did not start there, that range is validated again from the correct
+    offset, so that the output is the same as if the file had been read
+    from start to end.
+
+    Arguments
+    ---------
+    inputf : str
+        File path to a large CSV file of AIS data
+    outputf : str
+        File path for a CSV file containing validated and cleaned data
+    engine : str, default='row'
+    chunksize : int, default=CHUNKSIZE
+    processes : int, default=None
+        The number of processes, and ranges.  Defaults to the number of cores
+    max_examples : int, default=MAX_EXAMPLES
+        The number of rejected records logged for each category of error by
+        each process
+    dirty_file : str, default=None
+        File path for a csv file of the rejected rows, which are gathered
+        from the processes in order as the valid rows are
+
+    Returns
+    -------
+    superpyrate.stats.ValidationCounts
+        The counts of the records read, rejected and written
+    """
+    processes = processes or os.cpu_count()
+    maximise_field_size_limit()
+    encoding = locale.getpreferredencoding(False)
+    with open(inputf, 'rb') as binary_file:
+        lines = ByteRangeLines(binary_file, 0, encoding)
+        header = next(lines)
+    number_of_columns, column_indices = read_header(header, inputf,
+                                                    FORCED_COL_MAP,
+                                                    AIS_CSV_COLUMNS)
+
+    ranges = split_byte_ranges(inputf, lines.offset, processes)
+    part_files = ['{}.part{}'.format(outputf, part)
+                  for part in range(len(ranges))]
+    if dirty_file:
+        dirty_part_files = ['{}.part{}'.format(dirty_file, part)
+                            for part in range(len(ranges))]
+    else:
+        dirty_part_files = [None] * len(ranges)
+    LOGGER.info("Validating {} in {} parts".format(inputf, len(ranges)))
+
+    with open(outputf, 'w') as output_file:
+        csv.writer(output_file, dialect="excel").writerow(AIS_CSV_COLUMNS)
+    if dirty_file:
+        with open(dirty_file, 'w') as output_file:
+            csv.writer(output_file, dialect="excel").writerow(REJECTED_COLUMNS)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = [pool.apply_async(validate_byte_range,
+                                    (inputf, start, end, part_file,
+                                     number_of_columns, column_indices,
+                                     engine, chunksize, max_examples,
+                                     dirty_part_file))
+                   for (start, end), part_file, dirty_part_file
+                   in zip(ranges, part_files, dirty_part_files)]
+        boundary = ranges[0][0]
+        counts = ValidationCounts(max_examples=max_examples)
+        for (start, end), part_file, dirty_part_file, result in zip(
+                ranges, part_files, dirty_part_files, results):
+            next_record, part_counts = result.get()
+            if start != boundary:
+                # The range started within a multi-line record
+                LOGGER.debug("Revalidating {} from byte {}".format(
+                    inputf, boundary))
+                if boundary >= end:
+                    remove_parts(part_file, dirty_part_file)
+                    continue
+                next_record, part_counts = validate_byte_range(
+                    inputf, boundary, end, part_file, number_of_columns,
+                    column_indices, engine, chunksize, max_examples,
+                    dirty_part_file)
+            boundary = next_record
+            counts += part_counts
+            append_part(outputf, part_file)
+            if dirty_part_file:
+                append_part(dirty_file, dirty_part_file)
+    finally:
+        pool.terminate()
+        pool.join()
+    return counts
+
+
+def append_part(outputf, part_file):
+    """Appends a part file to the output file, then removes it
+    """
+    with open(outputf, 'ab') as output_file, open(part_file, 'rb') as part:
+        shutil.copyfileobj(part, output_file)
+    os.remove(part_file)
+
+
+def remove_parts(*part_files):
+    for part_file in part_files:
+        if part_file:
+            os.remove(part_file)
+
 
 if __name__ == "__main__":
     an_input_file = sys.argv[0]
@@ -0,0 +1,386 @@
+"""Vectorised validation of AIS messages using NumPy
+
+An alternative engine for :py:func:`superpyrate.tasks.produce_valid_csv_file`.
+Rather than parsing, validating and writing one row at a time, the rows are
+read in blocks of ``chunksize`` rows and each of the ``AIS_CSV_COLUMNS`` is
+converted and range checked as a whole NumPy array.  The surviving rows of a
+block are then written to the csv file in bulk.
+
+The conversions and checks mirror
+:py:func:`pyrate.algorithms.aisparser.parse_raw_row` and
+:py:func:`pyrate.algorithms.aisparser.validate_row`, so that the engine
+writes exactly the same rows as the row-by-row engine:
+
+* rows with an MMSI, Time, or integer or float field which cannot be converted
+  are dropped
+* rows with an invalid MMSI, Message_ID or IMO are dropped
+* position messages with an invalid Longitude or Latitude are dropped, while
+  the position is set to null for all other messages
+* Navigational_status, SOG, COG, Heading and the ETA fields are set to null
+  when out of range
+
+NumPy is an optional dependency, and is only needed if this engine is used.
+"""
+from datetime import datetime
+from pyrate.algorithms.aisparser import AIS_CSV_COLUMNS
+from superpyrate.stats import ValidationCounts, PARSE_ERROR, VALIDATION
+import logging
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LOGGER = logging.getLogger('luigi-interface')
+LOGGER.setLevel(logging.INFO)
+
+#: The number of rows read into each block
+CHUNKSIZE = 50000
+
+INT_COLUMNS = ['MMSI', 'Message_ID', 'Navigational_status', 'IMO',
+               'ETA_month', 'ETA_day', 'ETA_hour', 'ETA_minute']
+FLOAT_COLUMNS = ['SOG', 'Longitude', 'Latitude', 'COG', 'Heading', 'Draught']
+STRING_COLUMNS = ['Destination', 'Vessel_Name']
+
+MAX_STRING_LENGTH = 255
+VALID_MESSAGE_IDS = range(1, 28)
+VALID_NAVIGATIONAL_STATUSES = [0, 1, 2, 3, 4, 5, 6, 7, 8, 11, 12, 14, 15]
+POSITION_MESSAGES = [1, 2, 3, 4, 9, 11, 17, 18, 19, 21, 27]
+#: Inclusive ranges outside of which a field is set to null
+ETA_RANGES = {'ETA_month': (0, 12),
+              'ETA_day': (0, 31),
+              'ETA_hour': (0, 24),
+              'ETA_minute': (0, 60)}
+DAYS_IN_MONTH = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+#: Stands in for integers too large to hold in an int64, all of which are
+#: invalid for the AIS integer fields
+INT_OVERFLOW = -2 ** 63
+
+
+def check_numpy():
+    """Raises an error if NumPy, required by this engine, is not installed
+    """
+    if np is None:
+        raise RuntimeError("The numpy validation engine requires numpy, "
+                           "which is not installed")
+
+
+def convert_int_column(values):
+    """Converts a column of raw strings to integers
+
+    Arguments
+    ---------
+    values : list
+        The raw strings of the column
+
+    Returns
+    -------
+    converted : numpy.ndarray
+        The int64 values, with zero in place of nulls and invalid values
+    null : numpy.ndarray
+        Boolean mask of the empty values
+    bad : numpy.ndarray
+        Boolean mask of the values which could not be converted
+    """
+    raw = np.array(values, dtype=str)
+    null = raw == ''
+    converted = np.zeros(len(raw), dtype=np.int64)
+    bad = np.zeros(len(raw), dtype=bool)
+    try:
+        converted[~null] = raw[~null].astype(np.int64)
+    except (ValueError, OverflowError):
+        # Fall back to element by element conversion for this block
+        for index in np.flatnonzero(~null):
+            try:
+                value = int(raw[index])
+            except ValueError:
+                bad[index] = True
+            else:
+                if not -2 ** 63 < value < 2 ** 63:
+                    value = INT_OVERFLOW
+                converted[index] = value
+    return converted, null, bad
+
+
+def convert_float_column(values):
+    """Converts a column of raw strings to floats
+
+    Both empty strings and ``'None'`` are treated as null
+
+    Arguments
+    ---------
+    values : list
+        The raw strings of the column
+
+    Returns
+    -------
+    converted : numpy.ndarray
+        The float64 values, with NaN in place of nulls and invalid values
+    null : numpy.ndarray
+        Boolean mask of the null values
+    bad : numpy.ndarray
+        Boolean mask of the values which could not be converted
+    """
+    raw = np.array(values, dtype=str)
+    null = (raw == '') | (raw == 'None')
+    converted = np.full(len(raw), np.nan)
+    bad = np.zeros(len(raw), dtype=bool)
+    try:
+        converted[~null] = raw[~null].astype(np.float64)
+    except ValueError:
+        for index in np.flatnonzero(~null):
+            try:
+                converted[index] = float(raw[index])
+            except ValueError:
+                bad[index] = True
+    return converted, null, bad
+
+
+def convert_time_column(values):
+    """Converts a column of ``%Y%m%d_%H%M%S`` timestamps to output strings
+
+    Timestamps in the canonical fifteen character form are decoded and checked
+    as an array of character codes.  Any others are left to
+    :py:func:`datetime.strptime`.
+
+    Arguments
+    ---------
+    values : list
+        The raw strings of the column
+
+    Returns
+    -------
+    converted : numpy.ndarray
+        The timestamps formatted as ``%Y-%m-%d %H:%M:%S``
+    bad : numpy.ndarray
+        Boolean mask of the timestamps which could not be converted
+    """
+    raw = np.array(values, dtype=str)
+    converted = np.full(len(raw), '', dtype='U19')
+    bad = np.zeros(len(raw), dtype=bool)
+
+    canonical = np.char.str_len(raw) == 15
+    codes = np.ascontiguousarray(raw[canonical].astype('U15'))
+    codes = codes.view(np.uint32).reshape(-1, 15)
+    digit_positions = [x for x in range(15) if x != 8]
+    digits = codes[:, digit_positions]
+    shape = (((digits >= 48) & (digits <= 57)).all(axis=1) &
+             (codes[:, 8] == ord('_')))
+    canonical[canonical] = shape
+    codes = codes[shape]
+
+    numbers = codes.astype(np.int64) - 48
+    year = (numbers[:, 0] * 1000 + numbers[:, 1] * 100 +
+            numbers[:, 2] * 10 + numbers[:, 3])
+    month = numbers[:, 4] * 10 + numbers[:, 5]
+    day = numbers[:, 6] * 10 + numbers[:, 7]
+    hour = numbers[:, 9] * 10 + numbers[:, 10]
+    minute = numbers[:, 11] * 10 + numbers[:, 12]
+    second = numbers[:, 13] * 10 + numbers[:, 14]
+
+    valid_month = (month >= 1) & (month <= 12)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    days = np.array(DAYS_IN_MONTH)[np.clip(month, 1, 12) - 1]
+    days = days + (leap & (month == 2))
+    valid = (valid_month & (year >= 1) & (day >= 1) & (day <= days) &
+             (hour <= 23) & (minute <= 59) & (second <= 59))
+
+    out = np.empty((len(codes), 19), dtype=np.uint32)
+    out[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]] = \
+        codes[:, digit_positions]
+    out[:, [4, 7]] = ord('-')
+    out[:, 10] = ord(' ')
+    out[:, [13, 16]] = ord(':')
+    converted[canonical] = out.view('U19').ravel()
+    bad[canonical] = ~valid
+
+    for index in np.flatnonzero(~canonical):
+        try:
+            converted[index] = str(datetime.strptime(raw[index],
+                                                     '%Y%m%d_%H%M%S'))
+        except ValueError:
+            bad[index] = True
+    return converted, bad
+
+
+def valid_mmsi(mmsi):
+    """Checks that the MMSI numbers are nine characters long when printed
+
+    Arguments
+    ---------
+    mmsi : numpy.ndarray
+        int64 MMSI numbers
+    """
+    return (((mmsi >= 100000000) & (mmsi <= 999999999)) |
+            ((mmsi >= -99999999) & (mmsi <= -10000000)))
+
+
+def valid_imo(imo):
+    """Checks the seven digit IMO numbers using the check digit
+
+    Arguments
+    ---------
+    imo : numpy.ndarray
+        int64 IMO numbers
+    """
+    seven_digits = (imo >= 1000000) & (imo <= 9999999)
+    digits = (imo[:, None] // 10 ** np.arange(6, -1, -1)) % 10
+    checksum = (digits[:, :6] * np.arange(7, 1, -1)).sum(axis=1)
+    return seven_digits & (checksum % 10 == digits[:, 6])
+
+
+def validate_block(block, counts=None, rejects=None):
+    """Converts and validates a block of raw rows
+
+    Arguments
+    ---------
+    block : list
+        A list of rows, each a list of the raw strings of the
+        ``AIS_CSV_COLUMNS``
+    counts : superpyrate.stats.ValidationCounts, default=None
+        Counts of the rows which fail to convert or validate, which are
+        added to
+    rejects : list, default=None
+        If given, the rows which fail to convert or validate are appended to
+        it, as by :py:func:`superpyrate.compact.salvage_values`, followed by
+        the reason for their rejection
+
+    Returns
+    -------
+    rows : list
+        The validated rows which survived validation, as tuples of the
+        ``AIS_CSV_COLUMNS`` ready for writing
+    """
+    raw = dict(zip(AIS_CSV_COLUMNS, zip(*block)))
+    size = len(block)
+    keep = np.ones(size, dtype=bool)
+    null = {}
+    values = {}
+    # The values of rejected rows which are null, or could not be converted
+    unconverted = {}
+
+    for col in INT_COLUMNS:
+        values[col], null[col], bad = convert_int_column(raw[col])
+        keep &= ~bad
+        unconverted[col] = null[col] | bad | (values[col] == INT_OVERFLOW)
+    for col in FLOAT_COLUMNS:
+        values[col], null[col], bad = convert_float_column(raw[col])
+        keep &= ~bad
+        unconverted[col] = null[col] | bad
+    values['Time'], bad = convert_time_column(raw['Time'])
+    keep &= ~bad
+    unconverted['Time'] = bad
+    null['Time'] = np.zeros(size, dtype=bool)
+    for col in STRING_COLUMNS:
+        values[col] = [x[:MAX_STRING_LENGTH] for x in raw[col]]
+        null[col] = np.zeros(size, dtype=bool)
+        unconverted[col] = null[col]
+    parsed = keep.copy()
+    parse_failures = size - keep.sum()
+
+    # Rows with invalid identifiers are rejected
+    keep &= ~null['MMSI'] & valid_mmsi(values['MMSI'])
+    keep &= ~null['Message_ID'] & np.isin(values['Message_ID'],
+                                          VALID_MESSAGE_IDS)
+    keep &= null['IMO'] | valid_imo(values['IMO'])
+
+    # Position messages must have a valid position, others have it removed
+    position = np.isin(values['Message_ID'], POSITION_MESSAGES)
+    lon, lat = values['Longitude'], values['Latitude']
+    with np.errstate(invalid='ignore'):
+        valid_position = ((lon >= -180) & (lon <= 180) &
+                          (lat >= -90) & (lat <= 90))
+    keep &= ~position | valid_position
+    null['Longitude'] = null['Longitude'] | ~position
+    null['Latitude'] = null['Latitude'] | ~position
+
+    # Other fields are set to null if out of range
+    null['Navigational_status'] |= ~np.isin(values['Navigational_status'],
+                                            VALID_NAVIGATIONAL_STATUSES)
+    sog, cog, heading = values['SOG'], values['COG'], values['Heading']
+    with np.errstate(invalid='ignore'):
+        null['SOG'] |= ~((sog >= 0) & (sog <= 102.2))
+        null['COG'] |= ~((cog >= 0) & (cog < 360))
+        null['Heading'] |= ~(((heading >= 0) & (heading < 360)) |
+                             (heading == 511))
+    for col, (lower, upper) in ETA_RANGES.items():
+        null[col] |= ~((values[col] >= lower) & (values[col] <= upper))
+
+    validation_failures = size - parse_failures - keep.sum()
+    LOGGER.debug("{} of {} rows failed to parse and {} failed "
+                 "validation".format(parse_failures, size,
+                                     validation_failures))
+    if counts is not None:
+        if parse_failures:
+            counts.reject(PARSE_ERROR, "{} of {} rows in a block had invalid "
+                          "data", parse_failures, size,
+                          number=int(parse_failures))
+        if validation_failures:
+            counts.reject(VALIDATION, "{} of {} rows in a block failed "
+                          "validation", validation_failures, size,
+                          number=int(validation_failures))
+
+    if rejects is not None and not keep.all():
+        rejected = np.flatnonzero(~keep)
+        reasons = np.where(parsed[rejected], VALIDATION, PARSE_ERROR)
+        rejected_columns = []
+        for col in AIS_CSV_COLUMNS:
+            column = np.array(values[col], dtype=object)[rejected]
+            column[unconverted[col][rejected]] = None
+            rejected_columns.append(column.tolist())
+        rejected_columns.append(reasons.tolist())
+        rejects.extend(list(row) for row in zip(*rejected_columns))
+
+    output_columns = []
+    for col in AIS_CSV_COLUMNS:
+        column = np.array(values[col], dtype=object)
+        column[null[col]] = None
+        output_columns.append(column[keep].tolist())
+    return list(zip(*output_columns))
+
+
+def write_valid_blocks(rows, writer, chunksize=CHUNKSIZE, counts=None,
+                       rejects=None):
+    """Validates rows in blocks and writes those which are valid
+
+    Arguments
+    ---------
+    rows : iterable
+        Sequences of the raw strings of the ``AIS_CSV_COLUMNS``, or empty ones
+        for rows which could not be read
+    writer : csv.writer or superpyrate.pgcopy.BinaryCopyWriter
+        The writer for the output file
+    chunksize : int, default=CHUNKSIZE
+        The number of rows validated together as a block
+    counts : superpyrate.stats.ValidationCounts, default=None
+        Counts of the rows rejected and written, which are added to
+    rejects : csv.writer, default=None
+        If given, the rows which could be read but were rejected are written
+        to it, followed by the reason for their rejection
+    """
+    check_numpy()
+    if counts is None:
+        counts = ValidationCounts()
+    block = []
+    for row in rows:
+        if len(row) > 0:
+            block.append(row)
+        else:
+            # The error has been counted by category as the row was read
+            counts.invalid += 1
+        if len(block) >= chunksize:
+            write_block(block, writer, counts, rejects)
+            block = []
+    if block:
+        write_block(block, writer, counts, rejects)
+
+
+def write_block(block, writer, counts, rejects=None):
+    """Validates a block of rows, writing the valid and the rejected rows
+    """
+    rejected_rows = None if rejects is None else []
+    valid_rows = validate_block(block, counts, rejected_rows)
+    writer.writerows(valid_rows)
+    counts.clean += len(valid_rows)
+    if rejected_rows:
+        rejects.writerows(rejected_rows)
@@ -0,0 +1,59 @@
+from superpyrate.tasks import produce_valid_csv_file
+from superpyrate import columnar
+from pyrate.algorithms.aisparser import AIS_CSV_COLUMNS
+from datetime import datetime
+import csv
+import os
+import pytest
+
+
+def test_pyarrow_is_required(monkeypatch):
+    monkeypatch.setattr(columnar, 'pa', None)
+    with pytest.raises(RuntimeError):
+        columnar.get_schema()
+
+
+def test_time_from_numpy_engine():
+    assert columnar.to_datetime('2013-09-01 04:00:07') == \
+        datetime(2013, 9, 1, 4, 0, 7)
+
+
+@pytest.mark.parametrize("engine", ['row', 'numpy', 'compact'])
+def test_parquet_holds_the_valid_rows(set_tmpdir_environment, engine):
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    tmpdir = str(set_tmpdir_environment)
+    input_file = 'tests/fixtures/unicode_error_multiline.csv'
+    csv_file = os.path.join(tmpdir, 'expected.csv')
+    parquet_file = os.path.join(tmpdir, 'actual.parquet')
+    produce_valid_csv_file(input_file, csv_file, engine=engine)
+    counts = produce_valid_csv_file(input_file, parquet_file, engine=engine,
+                                    output_format='parquet')
+
+    table = pq.read_table(parquet_file)
+    assert table.column_names == AIS_CSV_COLUMNS
+    assert table.num_rows == counts.clean == 10
+    assert pa.types.is_timestamp(table.schema.field('Time').type)
+    assert pa.types.is_int32(table.schema.field('MMSI').type)
+    with open(csv_file, 'r') as expected_file:
+        expected = list(csv.DictReader(expected_file))
+    actual = table.to_pylist()
+    assert [str(row['Time']) for row in actual] == \
+        [row['Time'] for row in expected]
+    assert [row['MMSI'] for row in actual] == \
+        [int(row['MMSI']) for row in expected]
+
+
+def test_row_groups(set_tmpdir_environment):
+    pq = pytest.importorskip('pyarrow.parquet')
+    parquet_file = os.path.join(str(set_tmpdir_environment), 'groups.parquet')
+    row = [431602153, datetime(2013, 2, 8, 12, 59, 19), 1, 0, 23.1,
+           133.427716667, 32.6470833333, 54.0, 50.0, None, None, None, None,
+           None, None, None, None]
+    with open(parquet_file, 'wb') as output_file:
+        writer = columnar.ParquetWriter(output_file, row_group_size=4)
+        writer.writerows([row] * 10)
+        writer.finish()
+    parquet = pq.ParquetFile(parquet_file)
+    assert parquet.num_row_groups == 3
+    assert parquet.metadata.num_rows == 10
@@ -0,0 +1,213 @@
+from superpyrate.dbpool import ConnectionPool, PooledPostgresTarget, \
+                             clear_markers
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+
+class FakeConnection():
+    """Stands in for a :py:class:`superpyrate.dbpool.PooledConnection`
+    """
+    pool = None
+
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.in_transaction = False
+        self.broken = False
+
+    def get_transaction_status(self):
+        if self.in_transaction:
+            return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+        self.in_transaction = False
+
+    def cursor(self):
+        connection = self
+
+        class Cursor():
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql):
+                if connection.broken:
+                    raise psycopg2.OperationalError(
+                        "server closed the connection")
+        return Cursor()
+
+    def close(self):
+        self.pool.putconn(self)
+
+    def discard(self):
+        self.closed = 1
+
+
+class TestConnectionPool():
+
+    def test_connections_are_reused(self):
+        pool = ConnectionPool(FakeConnection)
+        connection = pool.getconn()
+        connection.close()
+        assert pool.getconn() is connection
+
+    def test_uncommitted_work_is_rolled_back(self):
+        pool = ConnectionPool(FakeConnection)
+        connection = pool.getconn()
+        connection.in_transaction = True
+        connection.autocommit = True
+        connection.close()
+        assert not connection.in_transaction
+        assert not connection.autocommit
+
+    def test_maximum_size(self):
+        pool = ConnectionPool(FakeConnection, max_connections=2, timeout=0.1)
+        first = pool.getconn()
+        pool.getconn()
+        with pytest.raises(RuntimeError):
+            pool.getconn()
+        first.close()
+        assert pool.getconn() is first
+
+    def test_closing_twice_frees_one_slot(self):
+        pool = ConnectionPool(FakeConnection, max_connections=1, timeout=0.1)
+        connection = pool.getconn()
+        connection.close()
+        connection.close()
+        pool.getconn()
+        with pytest.raises(RuntimeError):
+            pool.getconn()
+
+    def test_unhealthy_connections_are_replaced(self):
+        pool = ConnectionPool(FakeConnection, check_interval=0)
+        connection = pool.getconn()
+        connection.close()
+        connection.broken = True
+        replacement = pool.getconn()
+        assert replacement is not connection
+        assert connection.closed
+
+    def test_broken_connections_are_not_returned(self):
+        pool = ConnectionPool(FakeConnection)
+        connection = pool.getconn()
+        connection.in_transaction = True
+        connection.broken = True
+        connection.close()
+        assert connection.closed
+        assert pool.getconn() is not connection
+
+
+class MarkerConnection():
+    """Stands in for a connection to a database with a marker table
+    """
+    def __init__(self, markers):
+        self.markers = markers
+        self.queries = []
+        self.autocommit = False
+
+    def cursor(self):
+        connection = self
+
+        class Cursor():
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql, params):
+                connection.queries.append(sql)
+                if 'target_table' in sql:
+                    self.rows = [(update_id,) for update_id, table
+                                 in connection.markers if table == params[0]]
+                else:
+                    self.rows = [(1,) for update_id, _ in connection.markers
+                                 if update_id == params[0]]
+
+            def fetchall(self):
+                return self.rows
+
+            def fetchone(self):
+                return self.rows[0] if self.rows else None
+        return Cursor()
+
+    def close(self):
+        pass
+
+
+class TestMarkers():
+
+    def test_markers_are_read_in_bulk(self, monkeypatch):
+        connection = MarkerConnection([('a', 'ais_clean'), ('b', 'ais_clean'),
+                                       ('c', 'ais_sources')])
+        monkeypatch.setattr(PooledPostgresTarget, 'connect',
+                            lambda self: connection)
+        clear_markers()
+
+        def target(update_id):
+            return PooledPostgresTarget('localhost', 'test_aisdb', 'user', '',
+                                        'ais_clean', update_id)
+        try:
+            assert target('a').exists()
+            assert target('b').exists()
+            assert len(connection.queries) == 1
+            assert not target('e').exists()
+            assert len(connection.queries) == 2
+
+            connection.markers.append(('d', 'ais_clean'))
+            assert target('d').exists()
+            assert target('d').exists()
+            assert len(connection.queries) == 3
+        finally:
+            clear_markers()
+
+
+class TouchConnection():
+    """Records the statements of marking a task complete
+    """
+    def __init__(self, marker_table):
+        self.marker_table = marker_table
+        self.statements = []
+
+    def cursor(self):
+        connection = self
+
+        class Cursor():
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql, params=None):
+                connection.statements.append(sql.split()[0])
+
+            def fetchone(self):
+                return (connection.marker_table,)
+        return Cursor()
+
+
+class TestTouch():
+
+    @pytest.mark.parametrize("marker_table", ['table_updates', None])
+    def test_touch_borrows_no_connection(self, monkeypatch, marker_table):
+        """ The marker table is created on the connection being touched
+        """
+        def connect(self):
+            raise AssertionError("Borrowed a second connection")
+        monkeypatch.setattr(PooledPostgresTarget, 'connect', connect)
+        connection = TouchConnection(marker_table)
+        target = PooledPostgresTarget('localhost', 'test_aisdb', 'user', '',
+                                      'ais_clean', 'a')
+        target.touch(connection)
+        if marker_table:
+            assert connection.statements == ['SELECT', 'INSERT']
+        else:
+            assert connection.statements == ['SELECT', 'SAVEPOINT', 'CREATE',
+                                             'RELEASE', 'INSERT']
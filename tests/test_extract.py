@@ -0,0 +1,64 @@
+from superpyrate import extract
+from superpyrate.extract import extract_archive, can_extract
+from superpyrate.intermediates import open_intermediate
+import os
+import zipfile
+import pytest
+
+ZIP_FILE = 'tests/fixtures/testais/abc.zip'
+
+
+def read_members(zip_file):
+    with zipfile.ZipFile(zip_file) as archive:
+        return {os.path.basename(name): archive.read(name)
+                for name in archive.namelist() if name.endswith('.csv')}
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_extract_archive(tmpdir, workers):
+    folder = str(tmpdir.join('abc'))
+    paths = extract_archive(ZIP_FILE, folder, workers=workers)
+    expected = read_members(ZIP_FILE)
+    assert sorted(os.listdir(folder)) == sorted(expected)
+    assert paths == [os.path.join(folder, name) for name in sorted(expected)]
+    for name, contents in expected.items():
+        with open(os.path.join(folder, name), 'rb') as extracted:
+            assert extracted.read() == contents
+
+
+def test_extract_compressed(tmpdir):
+    folder = str(tmpdir.join('abc'))
+    extract_archive(ZIP_FILE, folder, workers=2, compression='gzip')
+    expected = read_members(ZIP_FILE)
+    assert sorted(os.listdir(folder)) == sorted(name + '.gz'
+                                                for name in expected)
+    for name, contents in expected.items():
+        with open_intermediate(os.path.join(folder, name + '.gz'),
+                               'rb') as extracted:
+            assert extracted.read() == contents
+
+
+def test_bad_crc(tmpdir):
+    zip_file = str(tmpdir.join('corrupt.zip'))
+    contents = b'MMSI,Time\n' + b'431602153,20130208_125919\n' * 100
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('good.csv', b'MMSI,Time\n')
+        archive.writestr('corrupt.csv', contents)
+    with open(zip_file, 'rb') as archive_file:
+        data = archive_file.read()
+    data = data.replace(b'431602153,20130208_125919\n' * 2,
+                        b'431602154,20130208_125919\n' * 2, 1)
+    with open(zip_file, 'wb') as archive_file:
+        archive_file.write(data)
+
+    folder = str(tmpdir.join('corrupt'))
+    with pytest.raises(zipfile.BadZipFile):
+        extract_archive(zip_file, folder, workers=2)
+    assert not os.path.exists(folder)
+    assert os.listdir(str(tmpdir)) == ['corrupt.zip']
+
+
+def test_unsupported_method(monkeypatch):
+    assert can_extract(ZIP_FILE)
+    monkeypatch.setattr(extract, 'SUPPORTED_METHODS', {zipfile.ZIP_STORED})
+    assert not can_extract(ZIP_FILE)
@@ -0,0 +1,63 @@
+from superpyrate.extsort import sort_csv_files, sort_key
+from superpyrate.tasks import produce_valid_csv_file, list_zip_members, \
+                              open_zip_member
+from pyrate.algorithms.aisparser import AIS_CSV_COLUMNS
+import csv
+import io
+import os
+import pytest
+
+
+@pytest.fixture
+def clean_files(tmpdir):
+    zip_file = 'tests/fixtures/testais/abc.zip'
+    cleanfiles = []
+    for member in list_zip_members(zip_file):
+        cleanfile = os.path.join(str(tmpdir), os.path.basename(member))
+        with open_zip_member(zip_file, member) as infile:
+            produce_valid_csv_file(infile, cleanfile)
+        cleanfiles.append(cleanfile)
+    return cleanfiles
+
+
+def read_rows(csvfile):
+    with open(csvfile, 'r', newline='') as open_file:
+        reader = csv.reader(open_file)
+        assert next(reader) == AIS_CSV_COLUMNS
+        return list(reader)
+
+
+class TestExternalSort():
+
+    @pytest.mark.parametrize("buffer_rows,max_open", [(1000000, 256),
+                                                      (50, 256),
+                                                      (7, 3)])
+    def test_rows_are_sorted(self, tmpdir, clean_files, buffer_rows, max_open):
+        folder = os.path.join(str(tmpdir), 'sort')
+        outfile = io.StringIO(newline='')
+        sort_csv_files(clean_files, outfile, folder, buffer_rows, max_open)
+
+        outfile.seek(0)
+        reader = csv.reader(outfile)
+        assert next(reader) == AIS_CSV_COLUMNS
+        actual = list(reader)
+        expected = [row for cleanfile in clean_files
+                    for row in read_rows(cleanfile)]
+        assert len(actual) > 0
+        assert sorted(actual) == sorted(expected)
+        keys = [sort_key(row) for row in actual]
+        assert keys == sorted(keys)
+        assert os.listdir(folder) == []
+
+    def test_multiline_values_survive(self, tmpdir):
+        cleanfile = os.path.join(str(tmpdir), 'multiline.csv')
+        rows = [['355999000', '2013-07-15 08:19:57'] + ['a\nb'] * 15,
+                ['255999000', '2013-07-15 08:18:57'] + ['c,d'] * 15]
+        with open(cleanfile, 'w', newline='') as open_file:
+            writer = csv.writer(open_file)
+            writer.writerow(AIS_CSV_COLUMNS)
+            writer.writerows(rows)
+        outfile = io.StringIO(newline='')
+        sort_csv_files([cleanfile], outfile, str(tmpdir), buffer_rows=1)
+        outfile.seek(0)
+        assert list(csv.reader(outfile))[1:] == rows[::-1]
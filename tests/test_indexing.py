@@ -0,0 +1,47 @@
+from superpyrate.indexing import plan_index_builds, order_indices, \
+                                 get_index_resources, get_physical_memory_mb
+import luigi
+import pytest
+
+
+class TestPlanIndexBuilds():
+
+    def test_one_index_gets_everything(self):
+        assert plan_index_builds(1, 8192, 8) == (1, 8192, 7)
+
+    def test_limited_by_memory(self):
+        assert plan_index_builds(5, 2048, 16) == (2, 1024, 7)
+
+    def test_limited_by_cores(self):
+        assert plan_index_builds(5, 65536, 4) == (2, 32768, 1)
+
+    def test_limited_by_number_of_indices(self):
+        assert plan_index_builds(2, 65536, 32) == (2, 32768, 15)
+
+    @pytest.mark.parametrize("memory_mb,cores", [(100, 1), (0, 0)])
+    def test_always_builds_one(self, memory_mb, cores):
+        concurrent, memory, workers = plan_index_builds(5, memory_mb, cores)
+        assert concurrent == 1
+        assert memory >= 1
+        assert workers == 0
+
+
+def test_clustering_index_first():
+    indices = [('dt_idx', ['Time']), ('imo_idx', ['IMO']),
+               ('mmsi_idx', ['MMSI']), ('msg_idx', ['Message_ID'])]
+    assert [idx for idx, _ in order_indices(indices)] == \
+        ['mmsi_idx', 'dt_idx', 'imo_idx', 'msg_idx']
+
+
+def test_memory_fraction_is_opt_in():
+    assert get_index_resources()[0] == 4096
+    config = luigi.configuration.get_config()
+    if not config.has_section('index_build'):
+        config.add_section('index_build')
+    try:
+        config.set('index_build', 'memory_fraction', '0.5')
+        physical_memory_mb = get_physical_memory_mb()
+        if physical_memory_mb:
+            assert get_index_resources()[0] == physical_memory_mb // 2
+    finally:
+        config.remove_option('index_build', 'memory_fraction')
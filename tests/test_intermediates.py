@@ -0,0 +1,58 @@
+from superpyrate.tasks import produce_valid_csv_file
+from superpyrate.intermediates import open_intermediate, find_intermediate, \
+                                      uncompressed_name, get_compression
+from superpyrate.targets import add_file
+import luigi
+import os
+import pytest
+
+
+@pytest.fixture
+def gzip_intermediates():
+    config = luigi.configuration.get_config()
+    if not config.has_section('intermediates'):
+        config.add_section('intermediates')
+    config.set('intermediates', 'compression', 'gzip')
+    yield
+    config.remove_option('intermediates', 'compression')
+
+
+def test_roundtrip(tmpdir):
+    path = str(tmpdir.join('roundtrip.csv.gz'))
+    with open_intermediate(path, 'w', newline='') as output_file:
+        output_file.write('MMSI,Time\r\n1,2\r\n')
+    with open(path, 'rb') as compressed_file:
+        assert compressed_file.read(2) == b'\x1f\x8b'
+    with open_intermediate(path, 'r', newline='') as input_file:
+        assert input_file.read() == 'MMSI,Time\r\n1,2\r\n'
+
+
+def test_names(tmpdir, gzip_intermediates):
+    assert get_compression() == 'gzip'
+    assert uncompressed_name('a.csv.gz') == 'a.csv'
+    assert uncompressed_name('a.csv') == 'a.csv'
+    plain = tmpdir.join('a.csv')
+    assert find_intermediate(str(plain)) == str(plain) + '.gz'
+    plain.write('')
+    add_file(str(plain))
+    assert find_intermediate(str(plain)) == str(plain)
+
+
+@pytest.mark.parametrize("engine", ['row', 'numpy', 'compact'])
+def test_compressed_validation(set_tmpdir_environment, engine):
+    tmpdir = str(set_tmpdir_environment)
+    input_file = 'tests/fixtures/unicode_error_multiline.csv'
+    compressed_input = os.path.join(tmpdir, engine + '_input.csv.gz')
+    with open(input_file, 'rb') as raw_file, \
+            open_intermediate(compressed_input, 'wb') as output_file:
+        output_file.write(raw_file.read())
+    expected_file = os.path.join(tmpdir, engine + '_expected.csv')
+    actual_file = os.path.join(tmpdir, engine + '_actual.csv.gz')
+    expected = produce_valid_csv_file(input_file, expected_file, engine=engine)
+    actual = produce_valid_csv_file(compressed_input, actual_file,
+                                    engine=engine, processes=2)
+    assert actual == expected
+    with open(expected_file, 'r', newline='') as plain_file, \
+            open_intermediate(actual_file, 'r', newline='') as compressed_file:
+        assert compressed_file.read() == plain_file.read()
+
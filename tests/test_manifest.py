@@ -0,0 +1,85 @@
+from superpyrate.manifest import hash_archive, hash_archives, hash_members, \
+                                 save_member_hash, read_member_hashes
+from superpyrate.extract import extract_archive
+from superpyrate.tasks import list_zip_members, open_zip_member
+import hashlib
+import os
+import shutil
+import zipfile
+
+
+class TestContentHashes():
+
+    def test_renamed_archive_has_same_hash(self, tmpdir):
+        renamed = os.path.join(str(tmpdir), 'renamed.zip')
+        shutil.copy('tests/fixtures/testais/abc.zip', renamed)
+        assert hash_archive(renamed) == \
+            hash_archive('tests/fixtures/testais/abc.zip')
+        assert hash_archive(renamed) != \
+            hash_archive('tests/fixtures/testais/efg.zip')
+
+    def test_cached_hash(self, tmpdir):
+        cache_folder = os.path.join(str(tmpdir), 'hashes')
+        archive = os.path.join(str(tmpdir), 'abc.zip')
+        shutil.copy('tests/fixtures/testais/abc.zip', archive)
+        expected = hash_archive(archive, cache_folder)
+        assert len(os.listdir(cache_folder)) == 1
+        assert hash_archive(archive, cache_folder) == expected
+
+        shutil.copy('tests/fixtures/testais/efg.zip', archive)
+        assert hash_archive(archive, cache_folder) == \
+            hash_archive('tests/fixtures/testais/efg.zip')
+
+    def test_member_hashes_match_contents(self):
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        hashes = hash_members(zip_file)
+        members = list_zip_members(zip_file)
+        assert sorted(hashes) == sorted(os.path.basename(member)
+                                        for member in members)
+        with zipfile.ZipFile(zip_file) as archive:
+            for member in members:
+                contents = archive.read(member)
+                expected = 'sha256:' + hashlib.sha256(contents).hexdigest()
+                assert hashes[os.path.basename(member)] == expected
+
+    def test_same_crc_different_contents(self, tmpdir):
+        """ Files of the same size and CRC-32 hold different rows
+        """
+        archive = os.path.join(str(tmpdir), 'collision.zip')
+        with zipfile.ZipFile(archive, 'w') as collision:
+            collision.writestr('a.csv', b'MMSI\n6560b14c')
+            collision.writestr('b.csv', b'MMSI\n5b54c124')
+            first, second = collision.infolist()
+        assert (first.CRC, first.file_size) == (second.CRC, second.file_size)
+        hashes = hash_members(archive)
+        assert hashes['a.csv'] != hashes['b.csv']
+
+    def test_hashes_kept_when_extracted(self, tmpdir):
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        cache_folder = os.path.join(str(tmpdir), 'hashes')
+        extract_archive(zip_file, os.path.join(str(tmpdir), 'abc'),
+                        workers=2, cache_folder=cache_folder)
+        assert len(os.listdir(cache_folder)) == 1
+        assert hash_members(zip_file, cache_folder=cache_folder) == \
+            hash_members(zip_file)
+
+    def test_archives_hashed_in_parallel(self):
+        archives = ['tests/fixtures/testais/abc.zip',
+                    'tests/fixtures/testais/efg.zip']
+        assert hash_archives(archives, workers=2) == \
+            [hash_archive(archive) for archive in archives]
+
+    def test_member_hashed_as_streamed(self, tmpdir):
+        """ A streamed member is hashed whole, however much of it is read
+        """
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        cache_folder = os.path.join(str(tmpdir), 'hashes')
+        member = list_zip_members(zip_file)[0]
+        name = os.path.basename(member)
+        digest = hashlib.sha256()
+        with open_zip_member(zip_file, member, digest) as infile:
+            infile.readline()
+        save_member_hash(zip_file, cache_folder, name,
+                         'sha256:' + digest.hexdigest())
+        assert read_member_hashes(zip_file, cache_folder, [name, 'x.csv']) == \
+            {name: hash_members(zip_file)[name]}
@@ -0,0 +1,50 @@
+from superpyrate.partitions import partition_name, month_bounds, \
+                                   PartitionRouter
+from superpyrate.tasks import produce_valid_csv_file
+from datetime import datetime
+import os
+import pytest
+
+
+@pytest.mark.parametrize("year,month,expected", [
+    (2013, 9, ('2013-09-01', '2013-10-01')),
+    (2013, 12, ('2013-12-01', '2014-01-01'))])
+def test_month_bounds(year, month, expected):
+    assert month_bounds(year, month) == expected
+
+
+def test_partition_name():
+    assert partition_name('ais_clean', 2013, 9) == 'ais_clean_y2013m09'
+
+
+class TestPartitionRouter():
+
+    def test_rows_routed_by_month(self, tmpdir):
+        router = PartitionRouter(str(tmpdir))
+        rows = [[355999000, datetime(2013, 9, 30, 23, 59, 59)],
+                [355999000, datetime(2013, 10, 1, 0, 0, 0)],
+                [255999000, datetime(2013, 9, 1, 0, 0, 0)]]
+        router.writerows(rows)
+        router.close()
+        partitions = router.partitions()
+        assert sorted(partitions) == [(2013, 9), (2013, 10)]
+        with open(partitions[(2013, 9)], 'r') as partition_file:
+            assert partition_file.read().splitlines() == \
+                ['355999000,2013-09-30 23:59:59',
+                 '255999000,2013-09-01 00:00:00']
+        assert os.path.basename(partitions[(2013, 10)]) == \
+            'ais_clean_y2013m10.csv'
+
+    @pytest.mark.parametrize("engine", ['row', 'numpy', 'compact'])
+    def test_matches_clean_file(self, tmpdir, engine):
+        input_file = 'tests/fixtures/error.csv'
+        clean_file = os.path.join(str(tmpdir), 'clean.csv')
+        produce_valid_csv_file(input_file, clean_file)
+        router = PartitionRouter(str(tmpdir))
+        produce_valid_csv_file(input_file, router, engine=engine)
+        router.close()
+        assert list(router.partitions()) == [(2013, 7)]
+        with open(clean_file, 'r') as expected_file:
+            expected_file.readline()
+            with open(router.partitions()[(2013, 7)], 'r') as actual_file:
+                assert actual_file.read() == expected_file.read()
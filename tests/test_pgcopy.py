@@ -0,0 +1,85 @@
+from superpyrate.pgcopy import BinaryCopyWriter, HEADER, TRAILER, \
+                               encode_timestamp, encode_numeric, get_encoder
+from superpyrate.tasks import produce_valid_csv_file, open_zip_member
+from datetime import datetime
+import io
+import os
+import struct
+import pytest
+
+COLUMN_TYPES = ['integer', 'timestamp without time zone', 'smallint',
+                'smallint', 'double precision', 'double precision',
+                'double precision', 'double precision', 'double precision',
+                'integer', 'double precision', 'character varying(255)',
+                'character varying(255)', 'smallint', 'smallint', 'smallint',
+                'smallint']
+
+
+def test_header_and_trailer():
+    binary_file = io.BytesIO()
+    writer = BinaryCopyWriter(binary_file, ['integer'])
+    writer.finish()
+    assert binary_file.getvalue() == \
+        b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8 + b'\xff\xff'
+
+
+def test_write_row_with_null():
+    binary_file = io.BytesIO()
+    writer = BinaryCopyWriter(binary_file, ['integer', 'text', 'real'])
+    writer.writerow([7, None, 1.5])
+    expected = struct.pack('>h', 3) + struct.pack('>ii', 4, 7) + \
+        struct.pack('>i', -1) + struct.pack('>if', 4, 1.5)
+    assert binary_file.getvalue() == HEADER + expected
+
+
+def test_encode_text_uses_encoding():
+    encoder = get_encoder('character varying(255)', 'latin-1')
+    assert encoder('caf\xe9') == struct.pack('>i', 4) + b'caf\xe9'
+
+
+def test_encode_timestamp():
+    expected = struct.pack('>iq', 8, 86400 * 1000000 + 1000000)
+    assert encode_timestamp(datetime(2000, 1, 2, 0, 0, 1)) == expected
+    assert encode_timestamp('2000-01-02 00:00:01') == expected
+
+
+@pytest.mark.parametrize('value,expected', [
+    (68.0, (1, 0, 0, 1, [68])),
+    (0.001, (1, -1, 0, 3, [10])),
+    (12345.6789, (3, 1, 0, 4, [1, 2345, 6789])),
+    (-3.5, (2, 0, 0x4000, 1, [3, 5000])),
+    (0.0, (0, 0, 0, 1, [])),
+])
+def test_encode_numeric(value, expected):
+    ndigits, weight, sign, dscale, digits = expected
+    encoded = encode_numeric(value)
+    assert encoded[4:12] == struct.pack('>hhHh', ndigits, weight, sign, dscale)
+    assert list(struct.unpack('>{}h'.format(ndigits), encoded[12:])) == digits
+
+
+def test_unknown_type():
+    with pytest.raises(ValueError):
+        get_encoder('point')
+
+
+@pytest.mark.parametrize('member', ['exactEarth_historical_data_20130901.csv',
+                                    'exactEarth_historical_data_20130902.csv'])
+def test_engines_write_identical_binary(set_tmpdir_environment, member):
+    tmpdir = str(set_tmpdir_environment)
+    zip_file = 'tests/fixtures/testais/abc.zip'
+    expected_output = os.path.join(tmpdir, 'row_output.bin')
+    actual_output = os.path.join(tmpdir, 'numpy_output.bin')
+    with open_zip_member(zip_file, member) as infile:
+        produce_valid_csv_file(infile, expected_output, engine='row',
+                               column_types=COLUMN_TYPES)
+    with open_zip_member(zip_file, member) as infile:
+        produce_valid_csv_file(infile, actual_output, engine='numpy',
+                               column_types=COLUMN_TYPES)
+    with open(expected_output, 'rb') as expected_file:
+        expected = expected_file.read()
+    with open(actual_output, 'rb') as actual_file:
+        actual = actual_file.read()
+    assert expected.startswith(HEADER)
+    assert expected.endswith(TRAILER)
+    assert len(expected) > len(HEADER) + len(TRAILER)
+    assert actual == expected
@@ -3,9 +3,19 @@
 """ Tests the three tasks in the prototype pipeline
 """
 import pytest
-from superpyrate.pipeline import ClusterAisClean
+from superpyrate.pipeline import ClusterAisClean, ValidMessagesToDatabase, \
+                                 LoadCleanedArchive, ValidMessages, \
+                                 LoadDirtyAIS, mark_loaded_in_order, \
+                                 ProcessZipArchives
+from superpyrate.tasks import list_zip_members
+from superpyrate.db_setup import make_options
 from conftest import set_env_vars, setup_clean_db, setup_working_folder
+from pyrate.repositories.aisdb import AISdb
+import json
 import luigi
+import os
+import shutil
+import threading
 
 
 __author__ = "Will Usher"
@@ -44,10 +54,57 @@ class TestCopyFrom():
         """
         pass
 
-    def test_dirty_database_ingest(self, set_env_vars):
+    def test_direct_copy_ingest(self, setup_clean_db, set_env_vars,
+                                setup_working_folder):
+        """ Rows validated straight into the copy stream are ingested without
+        writing a clean csv file
+        """
+        task = ValidMessagesToDatabase(
+            original_csvfile='tests/fixtures/error.csv', direct_copy=True)
+        assert luigi.build([task], local_scheduler=True)
+        cleancsv = os.path.join(os.environ['LUIGIWORK'], 'files', 'cleancsv',
+                                'error.csv')
+        assert not os.path.exists(cleancsv)
+        db = AISdb(make_options())
+        with db:
+            with db.conn.cursor() as cur:
+                cur.execute("SELECT mmsi, imo FROM ais_clean")
+                assert cur.fetchall() == [(355999000, 8514083)]
+
+    def test_archive_ingest(self, setup_clean_db, set_env_vars,
+                            setup_working_folder):
+        """ All the files of an archive are loaded in one transaction, and
+        each is added to the ais_sources table
+        """
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        task = LoadCleanedArchive(zip_file=zip_file, stream=True)
+        assert luigi.build([task], local_scheduler=True)
+        db = AISdb(make_options())
+        with db:
+            with db.conn.cursor() as cur:
+                cur.execute("SELECT filename FROM ais_sources")
+                actual = sorted(row[0] for row in cur.fetchall())
+        expected = sorted(os.path.basename(member)
+                          for member in list_zip_members(zip_file))
+        assert actual == expected
+
+    def test_dirty_database_ingest(self, setup_clean_db, set_env_vars,
+                                   setup_working_folder):
         """ Test ingest of dirty rows from dirty csv file into the ais_dirty table
         """
-        pass
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        member = list_zip_members(zip_file)[0]
+        validator = ValidMessages(csvfile=member, zip_file=zip_file,
+                                  dirty=True)
+        assert luigi.build([validator], local_scheduler=True)
+        assert luigi.build([LoadDirtyAIS(csvfile=member)],
+                           local_scheduler=True)
+        db = AISdb(make_options())
+        with db:
+            with db.conn.cursor() as cur:
+                cur.execute("SELECT reason, count(*) FROM ais_dirty "
+                            "GROUP BY reason")
+                assert cur.fetchall() == [('validation', 12)]
 
     def test_successful_ingest_filename_ais_source(self, set_env_vars):
         """ Once successfully ingested, the filename of the file should populate
@@ -62,3 +119,293 @@ class TestCreateIndices():
         """
         """
         pass
+
+    def test_clustering_index_first(self, monkeypatch, setup_working_folder):
+        """ Clustering waits only for its own index, which is built first
+        """
+        import superpyrate.pipeline as pipeline
+        indices = [('ais_clean_mmsi_idx', 'CREATE mmsi', 'mmsi'),
+                   ('ais_clean_time_idx', 'CREATE time', 'time')]
+        monkeypatch.setattr(pipeline, 'get_indices', lambda table: indices)
+        task = pipeline.MakeAllIndices(folder_of_zips='tests/fixtures/testais')
+        cluster = task.requires()
+        assert isinstance(cluster, ClusterAisClean)
+        assert isinstance(cluster.requires(), pipeline.MakeClusteringIndex)
+
+        first = next(cluster.requires().run())
+        assert first.update_id == 'mmsi'
+        assert first.priority == pipeline.CLUSTER_INDEX_PRIORITY
+        rest = next(task.run())
+        assert [build.update_id for build in rest] == ['time']
+        assert all(build.priority < first.priority for build in rest)
+
+
+class FakeCopyConnection():
+    """Records the rows copied into each partition
+    """
+    def __init__(self):
+        self.copied = {}
+        self.forgotten = []
+        self.closed = False
+
+    def cursor(self):
+        connection = self
+
+        class Cursor():
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql, arguments=None):
+                if sql.startswith('DELETE'):
+                    connection.forgotten.extend(arguments[0])
+
+            def fetchone(self):
+                return ('table_updates',)
+
+            def copy_expert(self, sql, copy_file):
+                partition = sql.split()[1]
+                connection.copied[partition] = copy_file.read()
+        return Cursor()
+
+    def close(self):
+        self.closed = True
+
+
+class TestPartitionedCopy():
+
+    @pytest.mark.parametrize("engine", ['row', 'numpy', 'compact'])
+    def test_every_engine(self, monkeypatch, setup_working_folder, engine):
+        """ The rows of each engine are copied into the partition of their
+        month
+        """
+        import superpyrate.pipeline as pipeline
+        monkeypatch.setattr(pipeline, 'create_partitions',
+                            lambda connection, table, months: None)
+        task = ValidMessagesToDatabase(
+            original_csvfile='tests/fixtures/error.csv', partitioned=True)
+        monkeypatch.setattr(task, 'validator', lambda: ValidMessages(
+            'tests/fixtures/error.csv', engine=engine))
+        connection = FakeCopyConnection()
+        monkeypatch.setattr(ValidMessagesToDatabase, 'output',
+                            lambda self: FakeCopyTarget(connection))
+        task.copy_partitioned(connection)
+        assert list(connection.copied) == ['ais_clean_y2013m07']
+        assert connection.copied['ais_clean_y2013m07'].startswith(
+            '355999000,2013-07-')
+        assert connection.forgotten == \
+            [pipeline.get_cluster_update_id('ais_clean_y2013m07')]
+
+
+class FakeSavepointConnection():
+    """Records the statements executed to load a file
+    """
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self):
+        connection = self
+
+        class Cursor():
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql, arguments=None):
+                connection.statements.append(sql)
+        return Cursor()
+
+
+class TestLoadOnce():
+
+    @pytest.mark.parametrize("added", [True, False])
+    def test_rolled_back_if_ingested(self, monkeypatch, added):
+        """ The rows are rolled back if their content was already loaded
+        """
+        import superpyrate.pipeline as pipeline
+        monkeypatch.setattr(pipeline, 'get_csv_hash',
+                            lambda csvfile, zip_file: 'sha256:abc')
+        monkeypatch.setattr(pipeline, 'create_manifest_table',
+                            lambda cursor: None)
+        monkeypatch.setattr(pipeline, 'record_ingested',
+                            lambda cursor, entries:
+                            set(entry[0] for entry in entries if added))
+        monkeypatch.setattr(ValidMessagesToDatabase, 'load',
+                            lambda self, connection:
+                            connection.statements.append('COPY'))
+        task = ValidMessagesToDatabase(
+            original_csvfile='tests/fixtures/error.csv',
+            archive='tests/fixtures/testais/abc.zip')
+        connection = FakeSavepointConnection()
+        assert task.load_once(connection) == added
+        expected = ['SAVEPOINT load_once;', 'COPY']
+        if not added:
+            expected.append('ROLLBACK TO SAVEPOINT load_once;')
+        assert connection.statements == expected
+
+    def test_order_forgotten(self, monkeypatch, setup_working_folder):
+        """ A table is no longer in order once any rows are loaded unsorted
+        """
+        import superpyrate.pipeline as pipeline
+        monkeypatch.setattr(pipeline, 'get_csv_hash',
+                            lambda csvfile, zip_file: '')
+        monkeypatch.setattr(ValidMessagesToDatabase, 'load',
+                            lambda self, connection: None)
+        mark_loaded_in_order('ais_clean', True)
+        task = ValidMessagesToDatabase(
+            original_csvfile='tests/fixtures/error.csv')
+        task.load_once(FakeSavepointConnection())
+        assert not os.path.exists(pipeline.get_load_order_file('ais_clean'))
+
+
+class TestFailedCopy():
+
+    def test_connection_closed(self, monkeypatch):
+        """ The connection is returned to the pool when loading fails
+        """
+        connection = FakeCopyConnection()
+        monkeypatch.setattr(ValidMessagesToDatabase, 'output',
+                            lambda self: FakeCopyTarget(connection))
+
+        def fail(self, connection):
+            raise RuntimeError("COPY failed")
+        monkeypatch.setattr(ValidMessagesToDatabase, 'load', fail)
+        task = ValidMessagesToDatabase(
+            original_csvfile='tests/fixtures/error.csv')
+        with pytest.raises(RuntimeError):
+            task.run()
+        assert connection.closed
+
+    def test_writer_joined(self, monkeypatch, setup_working_folder):
+        """ The thread validating into the pipe is joined when the copy fails
+        """
+        task = ValidMessagesToDatabase(
+            original_csvfile='tests/fixtures/error.csv', direct_copy=True)
+        monkeypatch.setattr(task, 'validator', lambda: ValidMessages(
+            'tests/fixtures/error.csv'))
+
+        def fail(connection, pipe):
+            pipe.read(10)
+            raise RuntimeError("COPY failed")
+        monkeypatch.setattr(task, 'copy_with_retry', fail)
+        threads = threading.active_count()
+        with pytest.raises(RuntimeError):
+            task.copy_validated(FakeCopyConnection())
+        assert threading.active_count() == threads
+
+
+class FakeCopyTarget():
+    marker_table = 'table_updates'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def connect(self):
+        return self.connection
+
+
+class FakeClusterTarget():
+    """Records whether the task was marked complete, and fails on connecting
+    """
+    touched = False
+
+    def touch(self, connection=None):
+        FakeClusterTarget.touched = True
+
+    def connect(self):
+        raise RuntimeError("Clustering")
+
+
+class TestClusterAfterPresort():
+
+    @pytest.mark.parametrize("was_empty", [True, False])
+    def test_cluster_unless_loaded_in_order(self, monkeypatch,
+                                            setup_working_folder, was_empty):
+        """ A table loaded in order is only left unclustered if it held no
+        other rows
+        """
+        monkeypatch.setattr(ClusterAisClean, 'output',
+                            lambda self: FakeClusterTarget())
+        monkeypatch.setattr(FakeClusterTarget, 'touched', False)
+        mark_loaded_in_order('ais_clean', was_empty)
+        task = ClusterAisClean(folder_of_zips='tests/fixtures/testais',
+                               with_db=True, presort=True)
+        if was_empty:
+            assert list(task.run()) == []
+            assert FakeClusterTarget.touched
+        else:
+            with pytest.raises(RuntimeError):
+                list(task.run())
+            assert not FakeClusterTarget.touched
+
+
+class FakeManifestConnection():
+    """A database whose manifest is empty
+    """
+    def cursor(self):
+        class Cursor():
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql, arguments=None):
+                pass
+
+            def fetchall(self):
+                return []
+        return Cursor()
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestNewArchives():
+
+    def test_copies_loaded_once(self, monkeypatch, setup_working_folder,
+                                tmpdir):
+        """ Of two archives with the same content, only the first is loaded
+        """
+        import superpyrate.pipeline as pipeline
+        monkeypatch.setattr(pipeline, 'connect_to_database',
+                            FakeManifestConnection)
+        archives = [str(tmpdir.join(name))
+                    for name in ['abc.zip', 'copy.zip', 'efg.zip']]
+        shutil.copy('tests/fixtures/testais/abc.zip', archives[0])
+        shutil.copy('tests/fixtures/testais/abc.zip', archives[1])
+        shutil.copy('tests/fixtures/testais/efg.zip', archives[2])
+        task = ProcessZipArchives(folder_of_zips=str(tmpdir), with_db=True)
+        new_archives = task.find_new_archives(archives)
+        assert [archive for archive, _ in new_archives] == \
+            [archives[0], archives[2]]
+
+
+class TestMakespan():
+
+    def test_only_this_run_is_timed(self, monkeypatch, setup_working_folder,
+                                    tmpdir):
+        """ Files validated before the task started are not timed
+        """
+        import superpyrate.pipeline as pipeline
+        archive = 'tests/fixtures/testais/abc.zip'
+        csvfiles = pipeline.list_csv_files(archive)
+        pipeline.save_timing(pipeline.get_timing_file(csvfiles[0]), 10,
+                             50.0, 60.0)
+        pipeline.save_timing(pipeline.get_timing_file(csvfiles[1]), 10,
+                             100.0, 101.0)
+        output = luigi.LocalTarget(str(tmpdir.join('archives')))
+        monkeypatch.setattr(ProcessZipArchives, 'output', lambda self: output)
+        task = ProcessZipArchives(folder_of_zips='tests/fixtures/testais')
+        task.report_makespan([archive], 100.0)
+        with open(output.fn + '.makespan.json', 'r') as report_file:
+            report = json.load(report_file)
+        assert report['jobs'] == 1
+        assert report['achieved'] == 1.0
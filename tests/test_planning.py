@@ -0,0 +1,127 @@
+from superpyrate.planning import plan_archive, read_central_directory, \
+                                 get_plan_file, get_priority, \
+                                 schedule_largest_first, makespan_report, \
+                                 batch_members, plan_by_name
+from superpyrate.manifest import hash_members
+import json
+import luigi
+import os
+import shutil
+import zipfile
+
+
+class TestPlanning():
+
+    def test_central_directory(self):
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        members = read_central_directory(zip_file)
+        with zipfile.ZipFile(zip_file) as archive:
+            for member in members:
+                contents = archive.read(member['member'])
+                assert member['name'] == os.path.basename(member['member'])
+                assert member['size'] == len(contents)
+        assert sorted(member['name'] for member in members) == \
+            sorted(hash_members(zip_file))
+
+    def test_plan_is_kept(self, tmpdir):
+        plan_folder = os.path.join(str(tmpdir), 'archives')
+        archive = os.path.join(str(tmpdir), 'abc.zip')
+        shutil.copy('tests/fixtures/testais/abc.zip', archive)
+        expected = plan_archive(archive, plan_folder)
+        plan_file = get_plan_file(archive, plan_folder)
+        assert os.listdir(plan_folder) == [os.path.basename(plan_file)]
+        with open(plan_file, 'r') as cached:
+            assert json.load(cached)['members'] == expected
+        assert plan_archive(archive, plan_folder) == expected
+
+        shutil.copy('tests/fixtures/testais/efg.zip', archive)
+        assert plan_archive(archive, plan_folder) == \
+            read_central_directory('tests/fixtures/testais/efg.zip')
+
+    def test_archives_of_the_same_name(self, tmpdir):
+        plan_folder = os.path.join(str(tmpdir), 'archives')
+        archives = []
+        for folder, fixture in [('2013', 'abc.zip'), ('2014', 'efg.zip')]:
+            os.mkdir(os.path.join(str(tmpdir), folder))
+            archive = os.path.join(str(tmpdir), folder, 'ais.zip')
+            shutil.copy(os.path.join('tests/fixtures/testais', fixture),
+                        archive)
+            archives.append(archive)
+        first, second = [plan_archive(archive, plan_folder)
+                         for archive in archives]
+        assert get_plan_file(archives[0], plan_folder) != \
+            get_plan_file(archives[1], plan_folder)
+        assert first == \
+            read_central_directory('tests/fixtures/testais/abc.zip')
+        assert second == \
+            read_central_directory('tests/fixtures/testais/efg.zip')
+        assert len(os.listdir(plan_folder)) == 2
+
+    def test_plan_by_name(self, tmpdir):
+        plan_folder = os.path.join(str(tmpdir), 'archives')
+        archive = os.path.join(str(tmpdir), 'abc.zip')
+        shutil.copy('tests/fixtures/testais/abc.zip', archive)
+        members = plan_archive(archive, plan_folder)
+        by_name = plan_by_name(archive, plan_folder)
+        assert by_name == {member['name']: member for member in members}
+        assert plan_by_name(archive, plan_folder) is by_name
+
+        shutil.copy('tests/fixtures/testais/efg.zip', archive)
+        assert sorted(plan_by_name(archive, plan_folder)) == \
+            sorted(member['name'] for member in
+                   read_central_directory('tests/fixtures/testais/efg.zip'))
+
+    def test_folders_are_flattened(self, tmpdir):
+        archive = os.path.join(str(tmpdir), 'nested.zip')
+        with zipfile.ZipFile(archive, 'w') as nested:
+            nested.writestr('a/one.csv', b'MMSI\n')
+            nested.writestr('b/one.csv', b'MMSI\n1\n')
+            nested.writestr('readme.txt', b'')
+        members = read_central_directory(archive)
+        assert [(member['name'], member['member'], member['size'])
+                for member in members] == [('one.csv', 'b/one.csv', 7)]
+
+
+class TestScheduling():
+
+    def test_largest_first(self):
+        assert schedule_largest_first([3, 3, 2, 2, 2], 2) == 7
+        assert schedule_largest_first([5, 1, 1], 3) == 5
+        assert schedule_largest_first([], 2) == 0
+
+    def test_priority(self):
+        members = [{'size': 3 * 1024 * 1024, 'compressed_size': 1024 * 1024},
+                   {'size': 1024 * 1024, 'compressed_size': 0}]
+        assert get_priority(members) == 4
+        config = luigi.configuration.get_config()
+        if not config.has_section('planning'):
+            config.add_section('planning')
+        try:
+            config.set('planning', 'priority', 'compressed_size')
+            assert get_priority(members) == 1
+            config.set('planning', 'priority', '')
+            assert get_priority(members) == 0
+        finally:
+            config.remove_option('planning', 'priority')
+
+    def test_makespan_report(self):
+        timings = [{'size': 400, 'start': 0.0, 'end': 4.0},
+                   {'size': 100, 'start': 0.0, 'end': 1.0},
+                   {'size': 100, 'start': 1.0, 'end': 2.0},
+                   {'size': 400, 'start': 4.0, 'end': 8.0}]
+        report = makespan_report(timings)
+        assert report['workers'] == 2
+        assert report['jobs'] == 4
+        assert report['bytes'] == 1000
+        assert report['achieved'] == 8.0
+        assert report['expected'] == 5.0
+        assert report['lower_bound'] == 5.0
+
+    def test_batches(self):
+        members = [{'name': name, 'size': size} for name, size
+                   in [('a', 40), ('b', 50), ('c', 30), ('d', 200), ('e', 10)]]
+        batches = batch_members(members, 100)
+        assert [[member['name'] for member in batch] for batch in batches] == \
+            [['a', 'b'], ['c'], ['d'], ['e']]
+        assert batch_members(members, 1000) == [members]
+        assert batch_members([], 100) == []
@@ -0,0 +1,76 @@
+from superpyrate.tables import check_replaceable, copy_grants, copy_indices
+import pytest
+
+
+class FakeCatalogCursor():
+    """Returns the given rows for each query of the catalog, in order
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, args=None):
+        self.executed.append(sql)
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+class FakeCatalogConnection():
+
+    def __init__(self, results):
+        self.catalog = FakeCatalogCursor(results)
+
+    def cursor(self):
+        return self.catalog
+
+
+class TestCheckReplaceable():
+
+    def test_refused_if_views_depend(self):
+        connection = FakeCatalogConnection([[('recent_ships',)]])
+        with pytest.raises(ValueError) as error:
+            check_replaceable(connection, 'ais_clean')
+        assert 'recent_ships' in str(error.value)
+
+    def test_replaceable_without_dependents(self):
+        check_replaceable(FakeCatalogConnection([[]]), 'ais_clean')
+
+
+def test_grants_copied():
+    cursor = FakeCatalogCursor([[('PUBLIC', 'SELECT', False),
+                                 ('analyst', 'INSERT', True)]])
+    copy_grants(cursor, 'ais_clean', 'ais_clean_staging')
+    assert cursor.executed[1:] == [
+        "GRANT SELECT ON ais_clean_staging TO PUBLIC;",
+        "GRANT INSERT ON ais_clean_staging TO analyst WITH GRANT OPTION;"]
+
+
+def test_indices_copied_under_new_names():
+    cursor = FakeCatalogCursor([
+        [('ais_clean_pkey', 'PRIMARY KEY (mmsi, "time")')],
+        [('ais_clean_idx_mmsi',
+          'CREATE INDEX ais_clean_idx_mmsi ON public.ais_clean '
+          'USING btree (mmsi)'),
+         ('ais_clean_sog', 'CREATE INDEX ais_clean_sog ON public.ais_clean '
+          'USING btree (sog)')]])
+    renames = copy_indices(cursor, 'ais_clean', 'ais_clean_staging',
+                           exclude=['ais_clean_idx_mmsi'])
+    assert cursor.executed[1] == \
+        'ALTER TABLE ais_clean_staging ADD CONSTRAINT ais_clean_pkey_new ' \
+        'PRIMARY KEY (mmsi, "time");'
+    assert cursor.executed[3] == \
+        'CREATE INDEX ais_clean_sog_new ON ais_clean_staging ' \
+        'USING btree (sog);'
+    assert len(cursor.executed) == 4
+    assert renames == [
+        'ALTER TABLE ais_clean RENAME CONSTRAINT ais_clean_pkey_new '
+        'TO ais_clean_pkey;',
+        'ALTER INDEX ais_clean_sog_new RENAME TO ais_clean_sog;']
@@ -0,0 +1,66 @@
+from superpyrate import targets
+from superpyrate.targets import file_exists, add_file, forget_file, \
+                                ListedLocalTarget
+import os
+import pytest
+
+
+@pytest.fixture
+def listings():
+    targets.clear_listings()
+    yield
+    targets.clear_listings()
+
+
+def test_folder_is_listed_once(tmpdir, listings, monkeypatch):
+    tmpdir.join('a.csv').write('')
+    assert file_exists(str(tmpdir.join('a.csv')))
+    assert not file_exists(str(tmpdir.join('b.csv')))
+
+    def no_stat(path):
+        raise AssertionError("{} was checked on disk".format(path))
+    monkeypatch.setattr(os.path, 'exists', no_stat)
+    assert file_exists(str(tmpdir.join('a.csv')))
+
+
+def test_missing_files_are_not_checked(tmpdir, listings, monkeypatch):
+    assert not file_exists(str(tmpdir.join('missing', 'b.csv')))
+    assert not ListedLocalTarget(str(tmpdir.join('b.csv'))).exists()
+
+    def no_stat(path):
+        raise AssertionError("{} was checked on disk".format(path))
+    monkeypatch.setattr(os.path, 'exists', no_stat)
+    tmpdir.join('b.csv').write('')
+    assert not ListedLocalTarget(str(tmpdir.join('b.csv'))).exists()
+
+
+def test_files_written_later_are_found(tmpdir, listings):
+    target = ListedLocalTarget(str(tmpdir.join('output', 'b.csv')))
+    assert not target.exists()
+    with target.open('w') as output_file:
+        output_file.write('b')
+    assert target.exists()
+
+    folder = tmpdir.join('unzipped')
+    assert not file_exists(str(folder.join('c.csv')))
+    folder.mkdir()
+    folder.join('c.csv').write('')
+    add_file(str(folder))
+    assert file_exists(str(folder))
+    assert file_exists(str(folder.join('c.csv')))
+
+
+def test_forgotten_files(tmpdir, listings):
+    path = tmpdir.join('c.csv')
+    path.write('')
+    assert file_exists(str(path))
+    path.remove()
+    forget_file(str(path))
+    assert not file_exists(str(path))
+
+    path.write('')
+    add_file(str(path))
+    target = ListedLocalTarget(str(path))
+    assert target.exists()
+    target.remove()
+    assert not target.exists()
@@ -1,12 +1,24 @@
-from superpyrate.tasks import produce_valid_csv_file
+from superpyrate.tasks import produce_valid_csv_file, list_zip_members, \
+                              open_zip_member, split_byte_ranges, \
+                              BoundedPipe, PipeWriterThread, \
+                              cached_map_columns, FORCED_COL_MAP, HEADER_CACHE
+from superpyrate import tasks
+from superpyrate.extract import extract_archive
+from superpyrate.planning import read_central_directory
+from superpyrate.compact import parse_timestamp
+from datetime import datetime
 from superpyrate.pipeline import ClusterAisClean
-from superpyrate.task_countfiles import CountLines, GetCountsForAllFiles, \
+from superpyrate.task_countfiles import GetCountsForAllFiles, \
                                         ProduceStatisticsReport, DoIt
+from superpyrate.stats import ValidationCounts
 from conftest import set_env_vars, setup_clean_db, setup_working_folder
+import io
 import os
 import tempfile
+import zipfile
 import csv
 from pytest import fixture
+import pytest
 import luigi
 from pyrate.algorithms.aisparser import readcsv, parse_raw_row, \
                                         AIS_CSV_COLUMNS, \
@@ -60,28 +72,6 @@ class TestUnicodeError:
 class TestCountFiles():
     """
     """
-    def test_countlines(self, setup_clean_db, set_env_vars, setup_working_folder):
-        """
-        """
-        working_folder = os.environ['LUIGIWORK']
-        # Setup existing workflow
-        luigi.build([ClusterAisClean('tests/fixtures/testais')],
-                                     local_scheduler=True)
-
-        extracted_files = os.path.join(working_folder, 'files', 'unzipped', 'abc')
-        task = CountLines(zip_file=extracted_files)
-        luigi.build([task], local_scheduler=True)
-
-        path = os.path.join(working_folder, 'tmp', 'countraw', 'abc.csv')
-        assert os.path.exists(path)
-        with open(path, 'r') as actual_file:
-            for index, line in enumerate(actual_file.readlines()):
-                if index <= 5:
-                    expected = "100 {}/files/unzipped/abc/exactEarth_historical_data_2013090{}.csv".format(working_folder, index + 1)
-                else:
-                    expected = "600 total"
-                assert line.strip() == expected
-
     def test_GetCountsForAllFiles(self, setup_clean_db, set_env_vars,
                                   setup_working_folder):
         """
@@ -92,27 +82,17 @@ class TestCountFiles():
                                      local_scheduler=True)
         task = GetCountsForAllFiles('tests/fixtures/testais', with_db=True)
         luigi.build([task], local_scheduler=True)
-        expected = os.path.join(working_folder, 'tmp', 'countraw',
-                                'got_all_counts.txt')
-        assert os.path.exists(expected)
-        path = os.path.join(working_folder, 'tmp','countraw', 'abc.csv')
+        path = os.path.join(working_folder, 'tmp', 'countraw',
+                            'got_all_counts.txt')
         assert os.path.exists(path)
         with open(path, 'r') as actual_file:
-            for index, line in enumerate(actual_file.readlines()):
-                if index <= 5:
-                    expected = "100 {}/files/unzipped/abc/exactEarth_historical_data_2013090{}.csv".format(working_folder, index + 1)
-                else:
-                    expected = "600 total"
-                assert line.strip() == expected
-        path = os.path.join(working_folder, 'tmp', 'countraw', 'efg.csv')
-        assert os.path.exists(path)
-        with open(path, 'r') as actual_file:
-            for index, line in enumerate(actual_file.readlines()):
-                if index <= 5:
-                    expected = "100 {}/files/unzipped/efg/exactEarth_historical_data_201309{:02}.csv".format(working_folder, index + 7)
-                else:
-                    expected = "600 total"
-                assert line.strip() == expected
+            rows = list(csv.reader(actual_file))
+        assert [row[0] for row in rows] == \
+            ['exactEarth_historical_data_201309{:02}.csv'.format(day)
+             for day in range(1, 13)]
+        for filename, raw, invalid, dirty, clean in rows:
+            assert int(raw) == 99
+            assert int(raw) == int(invalid) + int(dirty) + int(clean)
 
     def test_DoIt(self, setup_clean_db, set_env_vars,
                   setup_working_folder):
@@ -138,22 +118,24 @@ class TestCountFiles():
         expected_file = os.path.join(working_folder, 'files', 'data_statistics.csv')
         assert os.path.exists(expected_file)
         assert os.path.getsize(expected_file) > 0
-        expected_contents = [('exactEarth_historical_data_20130901.csv',  '88', '12', '0.12'),
-                             ('exactEarth_historical_data_20130902.csv', '100',  '0', '0.00'),
-                             ('exactEarth_historical_data_20130903.csv',  '94',  '6', '0.06'),
-                             ('exactEarth_historical_data_20130904.csv', '100',  '0', '0.00'),
-                             ('exactEarth_historical_data_20130905.csv',  '94',  '6', '0.06'),
-                             ('exactEarth_historical_data_20130906.csv', '100',  '0', '0.00'),
-                             ('exactEarth_historical_data_20130907.csv',  '88', '12', '0.12'),
-                             ('exactEarth_historical_data_20130908.csv', '100',  '0', '0.00'),
-                             ('exactEarth_historical_data_20130909.csv', '100',  '0', '0.00'),
-                             ('exactEarth_historical_data_20130910.csv',  '94',  '6', '0.06'),
-                             ('exactEarth_historical_data_20130911.csv', '100',  '0', '0.00'),
-                             ('exactEarth_historical_data_20130912.csv',  '94',  '6', '0.06')]
+        name = 'exactEarth_historical_data_201309{}.csv'
+        expected_contents = [
+            (name.format('01'), '87', '12', '0', '0.12'),
+            (name.format('02'), '99', '0', '0', '0.00'),
+            (name.format('03'), '93', '6', '0', '0.06'),
+            (name.format('04'), '99', '0', '0', '0.00'),
+            (name.format('05'), '93', '6', '0', '0.06'),
+            (name.format('06'), '99', '0', '0', '0.00'),
+            (name.format('07'), '87', '12', '0', '0.12'),
+            (name.format('08'), '99', '0', '0', '0.00'),
+            (name.format('09'), '99', '0', '0', '0.00'),
+            (name.format('10'), '93', '6', '0', '0.06'),
+            (name.format('11'), '99', '0', '0', '0.00'),
+            (name.format('12'), '93', '6', '0', '0.06')]
         with open(expected_file, 'r') as actual_file:
             actual_file.readline()
             for actual_row, expected_row in zip(actual_file, expected_contents):
-                assert actual_row == " ".join(expected_row)
+                assert actual_row.rstrip('\n') == " ".join(expected_row)
 
 
 class TestGenerationOfValidCsv():
@@ -186,14 +168,467 @@ class TestGenerationOfValidCsv():
         """
         pass
 
-    def test_dirty_files_produced(self):
+    @pytest.mark.parametrize("engine", ['row', 'numpy', 'compact'])
+    def test_dirty_files_produced(self, set_tmpdir_environment, engine):
         """ Check that data which doesn't pass validation goes into a dirty
         folder
         """
-        pass
+        tmpdir = str(set_tmpdir_environment)
+        output_file = os.path.join(tmpdir, 'output.csv')
+        dirty_file = os.path.join(tmpdir, 'dirty.csv')
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        member = list_zip_members(zip_file)[0]
+        with open_zip_member(zip_file, member) as infile:
+            counts = produce_valid_csv_file(infile, output_file, engine=engine,
+                                            dirty_file=dirty_file)
+        with open(dirty_file, 'r') as actual_file:
+            rows = list(csv.reader(actual_file))
+        assert rows[0] == AIS_CSV_COLUMNS + ['reason']
+        assert len(rows) - 1 == counts.dirty == 12
+        assert all(row[-1] == 'validation' for row in rows[1:])
+
+    @pytest.mark.parametrize("engine", ['row', 'numpy', 'compact'])
+    def test_unparsed_values_are_null_in_dirty_file(self,
+                                                    set_tmpdir_environment,
+                                                    engine):
+        tmpdir = str(set_tmpdir_environment)
+        output_file = os.path.join(tmpdir, 'output.csv')
+        dirty_file = os.path.join(tmpdir, 'dirty.csv')
+        input_file = 'tests/fixtures/unicode_error_multiline.csv'
+        produce_valid_csv_file(input_file, output_file, engine=engine,
+                               dirty_file=dirty_file)
+        expected = ['', '2013-02-08 12:59:19', '1', '0', '23.1',
+                    '133.427716667', '32.6470833333', '54.0', '50.0', '', '',
+                    '', '', '', '', '', '', 'parse']
+        with open(dirty_file, 'r') as actual_file:
+            assert list(csv.reader(actual_file))[1:] == [expected]
 
     def test_invalid_data_triggers_log_entry(self):
         """ Rows which are invalid, i.e. cannot be read, should trigger an
         entry in the logfile
         """
         pass
+
+
+class TestValidationCounts():
+    """Records are counted as they are validated, rather than in another pass
+    """
+
+    @pytest.mark.parametrize("engine", ['row', 'numpy', 'compact'])
+    def test_counts_add_up(self, set_tmpdir_environment, engine):
+        tmpdir = str(set_tmpdir_environment)
+        output_file = os.path.join(tmpdir, 'test_output.csv')
+        stats_file = os.path.join(tmpdir, 'stats', 'test_output.csv.json')
+        counts = produce_valid_csv_file('tests/fixtures/error.csv',
+                                        output_file, engine=engine,
+                                        stats_file=stats_file)
+        with open(output_file, 'r') as actual_file:
+            assert counts.clean == len(actual_file.readlines()) - 1
+        assert counts.raw == counts.invalid + counts.dirty + counts.clean
+        assert ValidationCounts.load(stats_file) == counts
+
+    def test_engines_count_alike(self, set_tmpdir_environment):
+        output_file = os.path.join(str(set_tmpdir_environment), 'output.csv')
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        for member in list_zip_members(zip_file):
+            counts = []
+            for engine in ['row', 'numpy', 'compact']:
+                with open_zip_member(zip_file, member) as infile:
+                    counts.append(produce_valid_csv_file(infile, output_file,
+                                                         engine=engine))
+            assert counts[0].raw == 99
+            assert counts[0] == counts[1] == counts[2]
+
+    def test_parallel_counts_match_sequential(self, set_tmpdir_environment):
+        tmpdir = str(set_tmpdir_environment)
+        output_file = os.path.join(tmpdir, 'output.csv')
+        input_file = 'tests/fixtures/unicode_error_multiline.csv'
+        expected = produce_valid_csv_file(input_file, output_file, processes=1)
+        actual = produce_valid_csv_file(input_file, output_file, processes=3,
+                                        parallel_threshold=0)
+        assert actual == expected
+
+    @pytest.mark.parametrize("engine", ['row', 'numpy', 'compact'])
+    def test_errors_counted_by_category(self, set_tmpdir_environment, engine):
+        tmpdir = str(set_tmpdir_environment)
+        output_file = os.path.join(tmpdir, 'output.csv')
+        stats_file = os.path.join(tmpdir, 'stats', 'output.csv.json')
+        input_file = 'tests/fixtures/unicode_error_multiline.csv'
+        counts = produce_valid_csv_file(input_file, output_file, engine=engine,
+                                        stats_file=stats_file)
+        assert counts.errors == {'columns': 4, 'parse': 1}
+        assert sum(counts.errors.values()) == counts.invalid + counts.dirty
+        assert ValidationCounts.load(stats_file).errors == counts.errors
+
+    def test_only_examples_are_logged(self, set_tmpdir_environment, caplog):
+        output_file = os.path.join(str(set_tmpdir_environment), 'output.csv')
+        input_file = 'tests/fixtures/unicode_error.csv'
+        with caplog.at_level(logging.ERROR, logger='luigi-interface'):
+            counts = produce_valid_csv_file(input_file, output_file,
+                                            max_examples=2)
+        assert counts.errors == {'columns': 16}
+        messages = [record.getMessage() for record in caplog.records]
+        assert len([message for message in messages
+                    if message.startswith("Expected column length")]) == 2
+        assert "Further columns errors are counted but not logged" in messages
+
+    def test_error_counts_add(self):
+        counts = ValidationCounts(raw=3, invalid=2, errors={'columns': 2})
+        counts += ValidationCounts(raw=2, invalid=1, dirty=1,
+                                   errors={'columns': 1, 'validation': 1})
+        assert counts.errors == {'columns': 3, 'validation': 1}
+        assert counts.summary('a.csv') == \
+            "5 records read from a.csv: 3 invalid, 1 dirty and 0 clean " \
+            "(3 columns, 1 validation)"
+
+
+class TestStreamFromZip():
+    """Validation of csv files read directly out of the zipped archives
+    """
+
+    def test_list_zip_members(self):
+        actual = list_zip_members('tests/fixtures/testais/abc.zip')
+        expected = ['exactEarth_historical_data_2013090{}.csv'.format(x)
+                    for x in range(1, 7)]
+        assert sorted(actual) == expected
+
+    def test_streamed_file_matches_extracted(self, set_tmpdir_environment):
+        """ Validating a member streamed from the archive gives the same clean
+        file as validating the extracted csv file
+        """
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        member = 'exactEarth_historical_data_20130901.csv'
+        tmpdir = str(set_tmpdir_environment)
+        with zipfile.ZipFile(zip_file) as archive:
+            extracted = archive.extract(member,
+                                        os.path.join(tmpdir, 'extracted'))
+        expected_output = os.path.join(tmpdir, 'expected_output.csv')
+        produce_valid_csv_file(extracted, expected_output)
+
+        actual_output = os.path.join(tmpdir, 'streamed_output.csv')
+        with open_zip_member(zip_file, member) as infile:
+            produce_valid_csv_file(infile, actual_output)
+
+        with open(expected_output, 'r') as expected_file:
+            with open(actual_output, 'r') as actual_file:
+                assert actual_file.read() == expected_file.read()
+
+    def test_streamed_member_is_extracted_member(self, tmpdir):
+        """ Of members sharing a file name, the one streamed is the one
+        extracted, as named in the plan of the archive
+        """
+        zip_file = str(tmpdir.join('nested.zip'))
+        with zipfile.ZipFile(zip_file, 'w') as nested:
+            nested.writestr('a/one.csv', 'MMSI\n1\n')
+            nested.writestr('b/one.csv', 'MMSI\n2\n')
+        folder = str(tmpdir.join('nested'))
+        extract_archive(zip_file, folder, workers=1)
+        member, = read_central_directory(zip_file)
+        with open_zip_member(zip_file, member['member']) as infile:
+            with open(os.path.join(folder, 'one.csv'), 'r') as extracted:
+                assert infile.read() == extracted.read()
+
+
+class TestNumpyEngine():
+    """The vectorised engine writes the same files as the row-by-row engine
+    """
+
+    @pytest.mark.parametrize('input_file', [
+        'tests/fixtures/simple.csv', 'tests/fixtures/error.csv',
+        'tests/fixtures/unicode_error.csv',
+        'tests/fixtures/unicode_error_multiline.csv'])
+    def test_engines_byte_identical(self, set_tmpdir_environment, input_file):
+        tmpdir = str(set_tmpdir_environment)
+        expected_output = os.path.join(tmpdir, 'row_output.csv')
+        actual_output = os.path.join(tmpdir, 'numpy_output.csv')
+        produce_valid_csv_file(input_file, expected_output, engine='row')
+        produce_valid_csv_file(input_file, actual_output, engine='numpy')
+        with open(expected_output, 'rb') as expected_file:
+            with open(actual_output, 'rb') as actual_file:
+                assert actual_file.read() == expected_file.read()
+
+    def test_archive_members_byte_identical(self, set_tmpdir_environment):
+        """Small blocks so that every file is validated in several of them
+        """
+        tmpdir = str(set_tmpdir_environment)
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        for member in list_zip_members(zip_file):
+            expected_output = os.path.join(tmpdir, 'row_output.csv')
+            actual_output = os.path.join(tmpdir, 'numpy_output.csv')
+            with open_zip_member(zip_file, member) as infile:
+                produce_valid_csv_file(infile, expected_output, engine='row')
+            with open_zip_member(zip_file, member) as infile:
+                produce_valid_csv_file(infile, actual_output, engine='numpy',
+                                       chunksize=16)
+            with open(expected_output, 'rb') as expected_file:
+                with open(actual_output, 'rb') as actual_file:
+                    assert actual_file.read() == expected_file.read()
+
+
+class TestCompactEngine():
+    """The compact engine writes the same files as the row-by-row engine
+    """
+
+    @pytest.mark.parametrize('input_file', [
+        'tests/fixtures/simple.csv', 'tests/fixtures/error.csv',
+        'tests/fixtures/unicode_error.csv',
+        'tests/fixtures/unicode_error_multiline.csv'])
+    def test_engines_byte_identical(self, set_tmpdir_environment, input_file):
+        tmpdir = str(set_tmpdir_environment)
+        expected_output = os.path.join(tmpdir, 'row_output.csv')
+        actual_output = os.path.join(tmpdir, 'compact_output.csv')
+        produce_valid_csv_file(input_file, expected_output, engine='row')
+        produce_valid_csv_file(input_file, actual_output, engine='compact')
+        with open(expected_output, 'rb') as expected_file:
+            with open(actual_output, 'rb') as actual_file:
+                assert actual_file.read() == expected_file.read()
+
+    def test_archive_members_byte_identical(self, set_tmpdir_environment):
+        tmpdir = str(set_tmpdir_environment)
+        zip_file = 'tests/fixtures/testais/abc.zip'
+        for member in list_zip_members(zip_file):
+            expected_output = os.path.join(tmpdir, 'row_output.csv')
+            actual_output = os.path.join(tmpdir, 'compact_output.csv')
+            with open_zip_member(zip_file, member) as infile:
+                produce_valid_csv_file(infile, expected_output, engine='row')
+            with open_zip_member(zip_file, member) as infile:
+                produce_valid_csv_file(infile, actual_output, engine='compact',
+                                       chunksize=16)
+            with open(expected_output, 'rb') as expected_file:
+                with open(actual_output, 'rb') as actual_file:
+                    assert actual_file.read() == expected_file.read()
+
+    @pytest.mark.parametrize('timestamp', [
+        '20130715_081857', '20120229_235959', '20130229_000000',
+        '20131301_000000', '20130101_240000', '20130101_000060',
+        '00000101_000000', '2013715_81857', '2013071５_081857', ''])
+    def test_parse_timestamp(self, timestamp):
+        try:
+            expected = datetime.strptime(timestamp, '%Y%m%d_%H%M%S')
+        except ValueError:
+            with pytest.raises(ValueError):
+                parse_timestamp(timestamp)
+        else:
+            assert parse_timestamp(timestamp) == expected
+
+
+class TestParallelValidation():
+    """Large files are split into ranges of bytes and validated in parallel
+    """
+
+    def test_split_byte_ranges(self):
+        input_file = 'tests/fixtures/unicode_error_multiline.csv'
+        with open(input_file, 'rb') as binary_file:
+            start = len(binary_file.readline())
+        ranges = split_byte_ranges(input_file, start, 4)
+        assert ranges[0][0] == start
+        assert ranges[-1][1] == os.path.getsize(input_file)
+        for (_, end), (next_start, _) in zip(ranges[:-1], ranges[1:]):
+            assert end == next_start
+
+    def test_multiline_records_match_sequential(self, set_tmpdir_environment):
+        """ Vessel names containing new lines mean that most of the ranges
+        start in the middle of a record
+        """
+        tmpdir = str(set_tmpdir_environment)
+        input_file = os.path.join(tmpdir, 'multiline.csv')
+        with open('tests/fixtures/error.csv', 'r') as fixture:
+            header = fixture.readline()
+            row = next(csv.reader(fixture))
+        vessel_name = header.strip().split(',').index('Vessel_Name')
+        with open(input_file, 'w') as csvfile:
+            csvfile.write(header)
+            writer = csv.writer(csvfile, quoting=csv.QUOTE_ALL,
+                                lineterminator='\n')
+            for index in range(200):
+                row[vessel_name] = "\n".join(['PYXIS'] * (index % 7))
+                writer.writerow(row)
+
+        expected_output = os.path.join(tmpdir, 'sequential_output.csv')
+        actual_output = os.path.join(tmpdir, 'parallel_output.csv')
+        produce_valid_csv_file(input_file, expected_output, processes=1)
+        produce_valid_csv_file(input_file, actual_output, processes=5,
+                               parallel_threshold=0)
+        with open(expected_output, 'rb') as expected_file:
+            with open(actual_output, 'rb') as actual_file:
+                expected = expected_file.read()
+                assert len(expected.splitlines()) > 200
+                assert actual_file.read() == expected
+        assert os.listdir(tmpdir).count('parallel_output.csv.part0') == 0
+
+    def test_undecodable_record_matches_sequential(self,
+                                                   set_tmpdir_environment):
+        """ Only the record holding a byte which cannot be decoded is
+        rejected, whether the file is read in parallel or from start to end
+        """
+        tmpdir = str(set_tmpdir_environment)
+        input_file = os.path.join(tmpdir, 'bad_byte.csv')
+        with open('tests/fixtures/error.csv', 'r') as fixture:
+            header = fixture.readline()
+            row = next(csv.reader(fixture))
+        vessel_name = header.strip().split(',').index('Vessel_Name')
+        text = io.StringIO()
+        writer = csv.writer(text, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        for index in range(2000):
+            row[vessel_name] = 'BAD' if index == 1000 else 'PYXIS'
+            writer.writerow(row)
+        with open(input_file, 'wb') as csvfile:
+            csvfile.write(header.encode())
+            csvfile.write(text.getvalue().encode().replace(b'BAD', b'B\xffD'))
+
+        expected_output = os.path.join(tmpdir, 'sequential_output.csv')
+        actual_output = os.path.join(tmpdir, 'parallel_output.csv')
+        expected_counts = produce_valid_csv_file(input_file, expected_output,
+                                                 processes=1)
+        actual_counts = produce_valid_csv_file(input_file, actual_output,
+                                               processes=5,
+                                               parallel_threshold=0)
+        assert expected_counts.errors == {'unicode': 1}
+        assert expected_counts.clean == 1999
+        assert actual_counts == expected_counts
+        with open(expected_output, 'rb') as expected_file:
+            with open(actual_output, 'rb') as actual_file:
+                assert actual_file.read() == expected_file.read()
+
+    @pytest.mark.parametrize("newline", ['\r\n', '\r'])
+    def test_newlines_are_translated(self, set_tmpdir_environment, newline):
+        """ New lines within quoted fields are translated as when the file is
+        read in text mode from start to end
+        """
+        tmpdir = str(set_tmpdir_environment)
+        input_file = os.path.join(tmpdir, 'crlf.csv')
+        with open('tests/fixtures/error.csv', 'r') as fixture:
+            header = fixture.readline()
+            row = next(csv.reader(fixture))
+        vessel_name = header.strip().split(',').index('Vessel_Name')
+        with open(input_file, 'w', newline='') as csvfile:
+            csvfile.write(header.strip() + newline)
+            writer = csv.writer(csvfile, quoting=csv.QUOTE_ALL,
+                                lineterminator=newline)
+            for index in range(200):
+                row[vessel_name] = newline.join(['PYXIS'] * (index % 7))
+                writer.writerow(row)
+
+        expected_output = os.path.join(tmpdir, 'sequential_output.csv')
+        actual_output = os.path.join(tmpdir, 'parallel_output.csv')
+        expected_counts = produce_valid_csv_file(input_file, expected_output,
+                                                 processes=1)
+        actual_counts = produce_valid_csv_file(input_file, actual_output,
+                                               processes=5,
+                                               parallel_threshold=0)
+        assert actual_counts == expected_counts
+        with open(expected_output, 'rb') as expected_file:
+            with open(actual_output, 'rb') as actual_file:
+                expected = expected_file.read()
+                assert b'PYXIS\nPYXIS' in expected
+                assert actual_file.read() == expected
+
+
+class TestBoundedPipe():
+    """Validated rows can be read from a pipe while they are being written
+    """
+
+    def test_pipe_passes_all_text(self):
+        lines = ["{},row\n".format(x) for x in range(10000)]
+
+        def write_lines(pipe):
+            for line in lines:
+                pipe.write(line)
+
+        pipe = BoundedPipe(chunk_size=100, max_chunks=2)
+        writer = PipeWriterThread(write_lines, pipe)
+        writer.start()
+        actual = []
+        while True:
+            text = pipe.read(8192)
+            if not text:
+                break
+            actual.append(text)
+        writer.join()
+        assert writer.error is None
+        assert "".join(actual) == "".join(lines)
+
+    def test_binary_pipe(self):
+        pipe = BoundedPipe(chunk_size=4, binary=True)
+        writer = PipeWriterThread(lambda pipe: pipe.write(b'PGCOPY\n'), pipe)
+        writer.start()
+        assert pipe.read() == b'PGCOPY\n'
+        writer.join()
+        assert writer.error is None
+
+    def test_validation_into_pipe(self, set_tmpdir_environment):
+        input_file = 'tests/fixtures/error.csv'
+        expected_output = os.path.join(str(set_tmpdir_environment),
+                                       'expected_output.csv')
+        produce_valid_csv_file(input_file, expected_output)
+
+        pipe = BoundedPipe()
+        writer = PipeWriterThread(
+            lambda output: produce_valid_csv_file(input_file, output), pipe)
+        writer.start()
+        actual = pipe.read()
+        writer.join()
+        with open(expected_output, 'r', newline='') as expected_file:
+            assert actual == expected_file.read()
+
+    def test_abort_stops_writer(self):
+        def write_forever(pipe):
+            while True:
+                pipe.write("row\n")
+
+        pipe = BoundedPipe(chunk_size=10, max_chunks=1)
+        writer = PipeWriterThread(write_forever, pipe)
+        writer.start()
+        pipe.read(100)
+        pipe.abort()
+        writer.join()
+        assert isinstance(writer.error, BrokenPipeError)
+
+
+class TestHeaderCache():
+    """Columns are only mapped once for each distinct header
+    """
+
+    cols = ['Extra'] + list(reversed(AIS_CSV_COLUMNS))
+
+    def test_cached_in_memory_and_on_disk(self, setup_working_folder,
+                                          monkeypatch):
+        HEADER_CACHE.clear()
+        expected = cached_map_columns(self.cols, AIS_CSV_COLUMNS,
+                                      FORCED_COL_MAP)
+        assert expected['ETA_minute'] == 1
+        cache_folder = os.path.join(str(setup_working_folder), 'tmp',
+                                    'headers')
+        assert len(os.listdir(cache_folder)) == 1
+
+        def fail(*args):
+            raise AssertionError("Columns mapped again")
+        monkeypatch.setattr(tasks, 'map_columns', fail)
+        assert cached_map_columns(self.cols, AIS_CSV_COLUMNS,
+                                  FORCED_COL_MAP) == expected
+        HEADER_CACHE.clear()
+        assert cached_map_columns(self.cols, AIS_CSV_COLUMNS,
+                                  FORCED_COL_MAP) == expected
+
+    def test_corrupt_cache_file_is_replaced(self, setup_working_folder):
+        HEADER_CACHE.clear()
+        expected = cached_map_columns(self.cols, AIS_CSV_COLUMNS,
+                                      FORCED_COL_MAP)
+        cache_folder = os.path.join(str(setup_working_folder), 'tmp',
+                                    'headers')
+        cache_file = os.path.join(cache_folder, os.listdir(cache_folder)[0])
+        with open(cache_file, 'w') as corrupt_file:
+            corrupt_file.write('{"MMSI": 500')
+        HEADER_CACHE.clear()
+        assert cached_map_columns(self.cols, AIS_CSV_COLUMNS,
+                                  FORCED_COL_MAP) == expected
+        with open(cache_file, 'r') as replaced_file:
+            assert replaced_file.read().startswith('{"MMSI": 17')
+
+    def test_different_headers_are_mapped_separately(self):
+        HEADER_CACHE.clear()
+        first = cached_map_columns(self.cols, AIS_CSV_COLUMNS, FORCED_COL_MAP)
+        second = cached_map_columns(AIS_CSV_COLUMNS, AIS_CSV_COLUMNS,
+                                    FORCED_COL_MAP)
+        assert first != second
+        assert len(HEADER_CACHE) == 2